@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+基准测试用的合成语料。
+近似重复的比例和bucket的倾斜程度都可以控制，同样的seed生成同样的语料，
+不同机器、不同版本之间的结果才能比较。
+bucket倾斜：真实文本的simhash并不是均匀分布的，部分bit经常取同样的值，
+导致少数bucket特别大(见README)。这里让一部分simhash的低hot_bits位取自少数几个热点值。
+"""
+import random
+
+from simhash.sim_hash import JIEBA_IDF_DIC
+
+
+def flip_bits(value, n, f, rnd):
+    """flip n distinct random bits of value"""
+    for i in rnd.sample(range(f), n):
+        value ^= 1 << i
+    return value
+
+
+def make_fingerprints(n, f=64, dup_rate=0.2, max_flips=3, skew=0.0,
+                      hot_bits=16, n_hot=8, seed=0):
+    """random simhash values with near duplications and bucket skew
+
+    :param n: {int} the number of values
+    :param dup_rate: {float} the probability that a value is a near
+        duplication of an earlier one, 0 to max_flips bits flipped
+    :param skew: {float} the probability that the lowest hot_bits bits of a
+        new value are one of the n_hot hot patterns, which makes the
+        buckets of those bits big
+    :return: {list} int simhash values
+    """
+    rnd = random.Random(seed)
+    hot_mask = (1 << hot_bits) - 1
+    hot = [rnd.getrandbits(hot_bits) for _ in range(n_hot)]
+    values = []
+    for _ in range(n):
+        if values and rnd.random() < dup_rate:
+            value = flip_bits(rnd.choice(values), rnd.randint(0, max_flips),
+                              f, rnd)
+        else:
+            value = rnd.getrandbits(f)
+            if rnd.random() < skew:
+                value = value & ~hot_mask | rnd.choice(hot)
+        values.append(value)
+    return values
+
+
+def make_texts(n, length=200, dup_rate=0.2, max_edits=5, vocab_size=20000,
+               seed=0):
+    """random texts of the words in the idf dict, with near duplications
+
+    :param n: {int} the number of texts
+    :param length: {int} words per text
+    :param dup_rate: {float} the probability that a text is an earlier one
+        with up to max_edits words replaced
+    :param vocab_size: {int} the number of distinct words
+    :return: {list} str texts
+    """
+    rnd = random.Random(seed)
+    words = sorted(JIEBA_IDF_DIC)
+    vocab = rnd.sample(words, min(vocab_size, len(words)))
+    docs = []
+    for _ in range(n):
+        if docs and rnd.random() < dup_rate:
+            doc = list(rnd.choice(docs))
+            for _ in range(rnd.randint(0, max_edits)):
+                doc[rnd.randrange(len(doc))] = rnd.choice(vocab)
+        else:
+            doc = [rnd.choice(vocab) for _ in range(length)]
+        docs.append(doc)
+    return [''.join(doc) for doc in docs]
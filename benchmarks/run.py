@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+可复现的基准测试：文本的tokenize和Simhash构造，以及不同k、key_func、storage下
+SimhashIndex的add、get_near_dups、get_near_dups2，和numpy全量扫描的对比。
+结果写成json，可以和保存的baseline比较，中位数变慢超过tolerance时返回非0。
+
+用法（在仓库根目录下）：
+    python -m benchmarks.run --quick --output baseline.json
+    python -m benchmarks.run --quick --baseline baseline.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from simhash.key_funcs import get_int_keys, get_keys0, get_keys, get_keys2
+from simhash.sim_hash import Simhash, SimhashIndex, get_numpy
+from simhash.storage import (MemoryStorage, MemoryMapStorage, ArrayStorage,
+                             ArrayMapStorage, RedisStorage, RedisMapStorage)
+from simhash.tokenizer import tokenize
+
+from .corpus import flip_bits, make_fingerprints, make_texts
+
+KEY_FUNCS = {
+    'get_int_keys': get_int_keys,
+    'get_keys0': get_keys0,
+    'get_keys': get_keys,
+    'get_keys2': get_keys2,
+}
+
+
+def summary(times_ns):
+    """statistics of the per operation times, in µs"""
+    times = sorted(t / 1000 for t in times_ns)
+    return {
+        'ops': len(times),
+        'mean_us': statistics.fmean(times),
+        'median_us': times[len(times) // 2],
+        'p95_us': times[min(len(times) - 1, int(len(times) * 0.95))],
+    }
+
+
+def measure(func, args_list, repeat=1):
+    """time func(*args) for every args
+
+    :param repeat: {int} call func repeat times for every args and keep the
+        fastest, only for the functions without side effects
+    :return: ({dict} summary, {list} the return values)
+    """
+    times = []
+    outs = []
+    # 和timeit一样关闭gc，否则gc的停顿会随机地落在某些操作上
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for args in args_list:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter_ns()
+                out = func(*args)
+                t = time.perf_counter_ns() - start
+                best = t if best is None else min(best, t)
+            outs.append(out)
+            times.append(best)
+    finally:
+        if enabled:
+            gc.enable()
+    return summary(times), outs
+
+
+def measure_once(func, *args):
+    """time one call with gc left as it is, for the bulk operations whose
+    gc cost is part of what is measured
+
+    :return: {dict} summary
+    """
+    gc.collect()
+    start = time.perf_counter_ns()
+    func(*args)
+    return summary([time.perf_counter_ns() - start])
+
+
+def result_id(result):
+    params = ','.join(f'{k}={v}' for k, v in sorted(result['params'].items()))
+    return f"{result['name']}[{params}]"
+
+
+class Suite(object):
+
+    def __init__(self, n=20000, n_queries=500, n_texts=500, ks=(3, 5, 8, 11),
+                 key_funcs=tuple(KEY_FUNCS), storages=('memory', 'array'),
+                 dup_rate=0.2, skew=0.0, f=64, seed=0, repeat=3,
+                 redis_url=None, log=print):
+        """
+        :param n: {int} simhashes in every index
+        :param n_queries: {int} queries per benchmark
+        :param n_texts: {int} texts for tokenize and Simhash
+        :param ks: {tuple} the tolerances
+        :param key_funcs: {tuple} names in KEY_FUNCS
+        :param storages: {tuple} 'memory', 'array' or 'redis'
+        :param dup_rate: {float} near duplication rate of the corpus
+        :param skew: {float} bucket skew of the corpus, see make_fingerprints
+        :param repeat: {int} times every read-only query is repeated
+        :param redis_url: {str} the redis for the 'redis' storage
+        """
+        self.n = n
+        self.n_queries = n_queries
+        self.n_texts = n_texts
+        self.ks = ks
+        self.key_funcs = key_funcs
+        self.storages = storages
+        self.dup_rate = dup_rate
+        self.skew = skew
+        self.f = f
+        self.seed = seed
+        self.repeat = repeat
+        self.redis_url = redis_url
+        self.log = log
+        self.results = []
+
+    def record(self, name, stats, **params):
+        result = dict(name=name, params=params, **stats)
+        self.results.append(result)
+        self.log('%-64s %10.1f µs (p95 %.1f µs)' % (
+            result_id(result), result['median_us'], result['p95_us']))
+
+    def make_storages(self, name):
+        """:return: (storage, map_storage, key_pre)"""
+        if name == 'memory':
+            return MemoryStorage(), MemoryMapStorage(), ''
+        if name == 'array':
+            return ArrayStorage(), ArrayMapStorage(), ''
+        if name == 'redis':
+            import redis
+
+            r = redis.Redis.from_url(self.redis_url)
+            pre = f'simhash_bench:{os.getpid()}:'
+            return (RedisStorage(r, keys_key=f'{pre}bucket_keys'),
+                    RedisMapStorage(r, f'{pre}hash2id'), pre)
+        raise ValueError(f'unknown storage: {name}')
+
+    def queries(self, values, k):
+        """near duplications of indexed values, 0 to k bits flipped"""
+        rnd = random.Random(self.seed + k)
+        return [Simhash(flip_bits(rnd.choice(values), rnd.randint(0, k),
+                                  self.f, rnd), self.f)
+                for _ in range(self.n_queries)]
+
+    def bench_text(self):
+        texts = make_texts(self.n_texts, dup_rate=self.dup_rate,
+                           seed=self.seed)
+        # 加载jieba、停用词和idf词典，不计入时间
+        Simhash(texts[0])
+        stats, _ = measure(tokenize, [(text,) for text in texts],
+                           self.repeat)
+        self.record('tokenize', stats, n=len(texts))
+        stats, _ = measure(Simhash, [(text, self.f) for text in texts])
+        self.record('simhash_text', stats, n=len(texts))
+
+    def bench_index(self, storage, key_func, k, values):
+        if storage == 'redis' and key_func == 'get_int_keys':
+            return  # int key没有key_pre，只用于内存存储
+        buckets, hash2id, key_pre = self.make_storages(storage)
+        index = SimhashIndex(storage=buckets, map_storage=hash2id,
+                             key_pre=key_pre, f=self.f, k=k,
+                             key_func=KEY_FUNCS[key_func])
+        params = dict(storage=storage, key_func=key_func, k=k, n=self.n)
+        objs = [(i, Simhash(v, self.f)) for i, v in enumerate(values)]
+        stats, _ = measure(index.add, objs)
+        self.record('add', stats, **params)
+
+        queries = self.queries(values, k)
+        stats, found = measure(index.get_near_dups,
+                               [(q,) for q in queries], self.repeat)
+        stats['mean_results'] = statistics.fmean(map(len, found))
+        self.record('get_near_dups', stats, **params)
+
+        stats, _ = measure(index.get_near_dups2,
+                           [(q, len(values) + i)
+                            for i, q in enumerate(queries)])
+        self.record('get_near_dups2', stats, **params)
+        if key_pre:
+            for key in buckets.r.scan_iter(f'{key_pre}*'):
+                buckets.r.delete(key)
+            return
+
+        # 暂停gc是build的可选参数，分别报告两种情况，区分gc和批量写入带来的提升
+        for pause_gc in (False, True):
+            buckets, hash2id, _ = self.make_storages(storage)
+            index = SimhashIndex(storage=buckets, map_storage=hash2id,
+                                 f=self.f, k=k, key_func=KEY_FUNCS[key_func])
+            stats = measure_once(index.build, objs, 100000, pause_gc)
+            self.record('build', stats, pause_gc=pause_gc, **params)
+
+    def bench_scan(self, k, values):
+        from simhash.scan_index import ScanSimhashIndex
+
+        with ScanSimhashIndex(enumerate(values), f=self.f, k=k,
+                              capacity=len(values)) as index:
+            stats, _ = measure(index.get_near_dups,
+                               [(q,) for q in self.queries(values, k)],
+                               self.repeat)
+        self.record('scan_get_near_dups', stats, k=k, n=self.n)
+
+    def run(self):
+        self.bench_text()
+        values = make_fingerprints(self.n, self.f, dup_rate=self.dup_rate,
+                                   skew=self.skew, seed=self.seed)
+        for k in self.ks:
+            for storage in self.storages:
+                for key_func in self.key_funcs:
+                    self.bench_index(storage, key_func, k, values)
+            if get_numpy() is not None:
+                self.bench_scan(k, values)
+        return self.results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results, baseline, tolerance=0.2, metric='median_us'):
+    """compare the results with a baseline run
+
+    :param results: {list} results of Suite.run
+    :param baseline: {list} results of the baseline run
+    :param tolerance: {float} a result is a regression if it is slower
+        than (1 + tolerance) times the baseline, an improvement if faster
+        than 1 / (1 + tolerance) times
+    :return: {list} (result id, baseline, current, ratio, status) tuples,
+        status is one of 'ok', 'regression', 'improvement', 'new', 'missing'
+    """
+    base = {result_id(r): r[metric] for r in baseline}
+    rows = []
+    for r in results:
+        rid = result_id(r)
+        if rid not in base:
+            rows.append((rid, None, r[metric], None, 'new'))
+            continue
+        old = base.pop(rid)
+        ratio = r[metric] / old if old else float('inf')
+        if ratio > 1 + tolerance:
+            status = 'regression'
+        elif ratio < 1 / (1 + tolerance):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((rid, old, r[metric], ratio, status))
+    for rid, old in base.items():
+        rows.append((rid, old, None, None, 'missing'))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='simhash benchmarks, see benchmarks/run.py')
+    parser.add_argument('--n', type=int, default=20000,
+                        help='simhashes in every index')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--texts', type=int, default=500)
+    parser.add_argument('--k', type=int, nargs='+', default=[3, 5, 8, 11])
+    parser.add_argument('--key-funcs', nargs='+', default=list(KEY_FUNCS),
+                        choices=list(KEY_FUNCS))
+    parser.add_argument('--storages', nargs='+', default=['memory', 'array'],
+                        choices=['memory', 'array', 'redis'])
+    parser.add_argument('--redis', default='redis://localhost:6379/0',
+                        help='redis url for the redis storage')
+    parser.add_argument('--dup-rate', type=float, default=0.2)
+    parser.add_argument('--skew', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times every read-only query is repeated')
+    parser.add_argument('--quick', action='store_true',
+                        help='a small run, n=2000, 100 queries, k=3 and 8')
+    parser.add_argument('--output', help='write the results to a json file')
+    parser.add_argument('--baseline', help='compare with a json file '
+                                           'written by --output')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    if parser.parse_args(argv).quick:  # 只改变默认值，显式给出的参数优先
+        parser.set_defaults(n=2000, queries=100, texts=100, k=[3, 8])
+    args = parser.parse_args(argv)
+
+    suite = Suite(n=args.n, n_queries=args.queries, n_texts=args.texts,
+                  ks=args.k, key_funcs=args.key_funcs,
+                  storages=args.storages, dup_rate=args.dup_rate,
+                  skew=args.skew, seed=args.seed, repeat=args.repeat,
+                  redis_url=args.redis)
+    results = suite.run()
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'numpy': getattr(get_numpy(), '__version__', None),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['results']
+        rows = compare(results, baseline, args.tolerance)
+        print()
+        for rid, old, new, ratio, status in rows:
+            if ratio is None:
+                print('%-64s %s' % (rid, status))
+            else:
+                print('%-64s %10.1f -> %10.1f µs  x%.2f  %s' % (
+                    rid, old, new, ratio, status))
+        if any(row[-1] == 'regression' for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
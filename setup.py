@@ -17,11 +17,15 @@ setup(
     include_package_data=True,
     platforms='any',
     install_requires=['redis', 'jieba'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     tests_require=[
         'nose',
         'numpy',
         'scipy',
         'scikit-learn',
+        'fakeredis',
     ],
     test_suite="nose.collector",
 )
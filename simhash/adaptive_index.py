@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+自适应拆分大桶的索引。
+按get_keys0的方式拆为k+1份分桶后，依旧会有部分桶的数据量巨大（数据倾斜），
+get_keys2对所有的桶都做二次拆分，查询的桶数量翻倍，在不倾斜的桶上反而是浪费。
+这里只对超过阈值的桶做二次拆分：桶内的simhash已有一份完全相同，
+把剩余的位再均匀拆为k+1份，每个simhash存入k+1个子桶（抽屉原理保证不漏），
+子桶依旧过大时继续递归拆分。查询时按照同样的路径路由到对应的子桶。
+"""
+import collections
+import time
+
+from .key_funcs import split_offsets
+from .sim_hash import SimhashIndex, F, K
+from .storage import Storage, MemoryStorage, MemoryMapStorage, RedisStorage
+
+
+def split_mask(mask, f, k):
+    """将mask之外剩余的位均匀拆为k+1组，返回每个子桶的mask，剩余的位不够拆时返回None"""
+    left = [i for i in range(f) if not mask >> i & 1]
+    if len(left) < k + 1:
+        return None
+    masks = []
+    start = 0
+    for _, size in split_offsets(len(left), k + 1):
+        group = 0
+        for i in left[start:start + size]:
+            group |= 1 << i
+        masks.append(mask | group)
+        start += size
+    return masks
+
+
+class AdaptiveSimhashIndex(SimhashIndex):
+
+    def __init__(self, objs=None, storage: Storage = None,
+                 map_storage: Storage = None, key_pre='',
+                 f=F, k=K, log=None, with_id=True, threshold=2000,
+                 split_storage: Storage = None, refresh_interval=1.0):
+        """index whose buckets are split again once they exceed `threshold`.
+
+        The keys of the split buckets are kept in `split_storage` as a set
+        under `key_pre + 'adaptive_splits'`, an index reopened with the same
+        storage and split_storage routes to the same sub-buckets.
+
+        :param threshold: {int} split a bucket when it holds more simhashes
+        :param split_storage: {Storage} the registry of the split buckets,
+            its members are bucket keys, not simhashes. Defaults to a
+            RedisStorage on the same redis if storage is a RedisStorage,
+            otherwise a MemoryStorage
+        :param refresh_interval: {float} reload the split buckets from
+            split_storage every so many seconds, so that the splits made
+            by the other instances sharing it are followed. None to never
+            reload, if the storages are not shared
+        other params are the same with SimhashIndex, except that the keys
+        are always generated by the index itself
+        """
+        if storage is None:
+            storage = MemoryStorage()
+        if map_storage is None:
+            map_storage = MemoryMapStorage()
+        if split_storage is None:
+            if isinstance(storage, RedisStorage):
+                split_storage = RedisStorage(storage.r, expire=storage.expire,
+                                             keys_key=storage.keys_key)
+            else:
+                split_storage = MemoryStorage()
+        self.split_storage = split_storage
+        self.threshold = threshold
+        self.root_masks = [((1 << size) - 1) << start
+                           for start, size in split_offsets(f, k + 1)]
+        self.children = dict()  # mask -> masks of the sub-buckets
+        self.counts = collections.Counter()  # approximate size of the buckets
+        self.splits_key = key_pre + 'adaptive_splits'
+        self.refresh_interval = refresh_interval
+        self.refresh_splits()
+        super().__init__(objs, storage=storage, map_storage=map_storage,
+                         key_pre=key_pre, f=f, k=k, log=log, with_id=with_id)
+        self.get_keys = self.get_query_keys = self.get_leaf_keys
+
+    def refresh_splits(self):
+        """reload the keys of the split buckets from split_storage"""
+        self.splits = set(
+            key.decode() if isinstance(key, bytes) else key
+            for key in (self.split_storage.get(self.splits_key) or ()))
+        self.splits_loaded = time.monotonic()
+
+    def make_key(self, value, mask):
+        return '%s%x:a%x' % (self.key_pre, value & mask, mask)
+
+    def get_children(self, mask):
+        if mask not in self.children:
+            self.children[mask] = split_mask(mask, self.f, self.k)
+        return self.children[mask]
+
+    def route(self, value):
+        """yield the (key, mask) of the leaf buckets of value"""
+        if (self.refresh_interval is not None and time.monotonic() -
+                self.splits_loaded >= self.refresh_interval):
+            self.refresh_splits()
+        stack = list(self.root_masks)
+        while stack:
+            mask = stack.pop()
+            key = self.make_key(value, mask)
+            if key in self.splits:
+                stack.extend(self.get_children(mask))
+            else:
+                yield key, mask
+
+    def get_leaf_keys(self, simhash):
+        return [key for key, _ in self.route(simhash.value)]
+
+    def add(self, obj_id, simhash):
+        """adding the simhash to the storage, split the buckets grown too big"""
+        assert simhash.f == self.f, f"index's f={self.f},simhash's f={simhash.f}"
+
+        v = self.storage.encode(simhash.value & self.mask)
+        if self.with_id:
+            self.hash2id.add(v, obj_id)
+        for key, mask in list(self.route(simhash.value)):
+            self.storage.add(key, v)
+            self.counts[key] += 1
+            if (self.counts[key] > self.threshold and
+                    self.get_children(mask) is not None):
+                self.split(key, mask)
+
+    def add_many(self, objs):
+        """adding one by one, the buckets may be split in between"""
+        for obj_id, simhash in objs:
+            self.add(obj_id, simhash)
+
+    def remove(self, simhash):
+        """remove the simhash from the storage"""
+        assert simhash.f == self.f
+
+        v = self.storage.encode(simhash.value & self.mask)
+        if self.with_id:
+            self.hash2id.remove(v, 0)
+        for key, _ in list(self.route(simhash.value)):
+            self.storage.remove(key, v)
+            if self.counts[key] > 0:
+                self.counts[key] -= 1
+
+    def split(self, key, mask):
+        """move the members of bucket `key` into its k+1 sub-buckets"""
+        masks = self.get_children(mask)
+        members = list(self.storage.get(key) or ())
+        # counts只是估计值（重复add会多算），拆分前以真实数量为准
+        self.counts[key] = len(members)
+        if masks is None or len(members) <= self.threshold:
+            return
+        self.log.info('Splitting big bucket. key:%s, len:%s', key,
+                      len(members))
+
+        child_keys = dict()  # key -> mask
+        for member in members:
+            value = self.storage.decode(member)
+            for child in masks:
+                child_key = self.make_key(value, child)
+                self.storage.add(child_key, member)
+                self.counts[child_key] += 1
+                child_keys[child_key] = child
+        self.splits.add(key)
+        self.split_storage.add(self.splits_key, key)
+        for member in members:
+            self.storage.remove(key, member)
+        del self.counts[key]
+
+        for child_key, child in child_keys.items():
+            if self.counts[child_key] > self.threshold:
+                self.split(child_key, child)
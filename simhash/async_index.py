@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+asyncio版本的SimhashIndex。
+在asyncio的web服务中，每次调用RedisStorage都会阻塞事件循环k+1到3(k+1)次网络往返。
+AsyncSimhashIndex通过AsyncStorage（aget, aadd, aget_many, ...）访问存储，
+一次查询的所有bucket并发获取（redis为一次pipeline），多个查询共享redis的连接池。
+"""
+import asyncio
+import collections
+
+from .sim_hash import BaseSimhashIndex, bit_count, F, K
+from .storage import AsyncStorage, AsyncMemoryStorage, AsyncMemoryMapStorage
+
+
+class AsyncSimhashIndex(BaseSimhashIndex):
+
+    def __init__(self, storage: AsyncStorage = None,
+                 map_storage: AsyncStorage = None, key_pre='',
+                 f=F, k=K, log=None, key_func=None, with_id=True,
+                 query_key_func=None):
+        """the same as SimhashIndex, but all the methods are coroutines.
+        Use `await index.add_many(objs)` instead of the `objs` param.
+        Only the key functions and the bucket matching are shared with
+        SimhashIndex (BaseSimhashIndex), none of its sync methods.
+
+        get_near_dups2 is not atomic between concurrent tasks, two near
+        duplications in flight at the same time may both be added.
+
+        :param storage: {AsyncStorage} defaults to a new AsyncMemoryStorage
+        :param map_storage: {AsyncStorage} defaults to a new
+            AsyncMemoryMapStorage
+        other params are the same with SimhashIndex
+        """
+        if storage is None:
+            storage = AsyncMemoryStorage()
+        if map_storage is None:
+            map_storage = AsyncMemoryMapStorage()
+        super().__init__(storage, map_storage,
+                         key_pre=key_pre, f=f, k=k, log=log,
+                         key_func=key_func, with_id=with_id,
+                         query_key_func=query_key_func)
+
+    async def search(self, simhash, first_only=False):
+        """fetch all the buckets of simhash concurrently
+
+        :return: a {int simhash: distance} dict
+        """
+        assert simhash.f == self.f
+
+        v = simhash.value & self.mask
+        k = self.k
+        found = dict()
+        keys = list(self.get_query_keys(simhash))
+        for key, dups in zip(keys, await self.storage.aget_many(keys)):
+            self.log.debug('key:%s', key)
+            if len(dups) > 2000:
+                self.log.warning('Big bucket found. key:%s, len:%s', key,
+                                 len(dups))
+            for dup in self.decode(dups):
+                d = bit_count(v ^ dup)
+                if d <= k:
+                    found[dup] = d
+                    if first_only:
+                        return found
+        return found
+
+    async def results(self, found):
+        """the async version of SimhashIndex.results"""
+        if not self.with_id:
+            return [[('%x' % dup, d) for dup, d in dups.items()]
+                    for dups in found]
+        values = list(set(dup for dups in found for dup in dups))
+        ids = await self.hash2id.aget_many(
+            [self.storage.encode(v) for v in values])
+        value2id = dict(zip(values, ids))
+        return [[(int(value2id[dup]), d) for dup, d in dups.items()]
+                for dups in found]
+
+    async def get_one_near_dup(self, simhash):
+        """find one near duplication under the distance tolerance k
+
+        :return: a (obj_id, distance) tuple if self.with_id set to True
+            else a (hex simhash, distance) tuple, (None, None) if not found
+        """
+        found = await self.search(simhash, first_only=True)
+        for result in (await self.results([found]))[0]:
+            return result
+        return None, None
+
+    async def get_near_dups(self, simhash):
+        """find all near duplication under the distance tolerance k"""
+        return (await self.results([await self.search(simhash)]))[0]
+
+    async def get_near_dups2(self, simhash, cur_id):
+        """find all near duplication under the distance tolerance k,
+        add current simhash if no exact duplication found"""
+        found = await self.search(simhash)
+        if 0 not in found.values():
+            await self.add(cur_id, simhash)
+        return (await self.results([found]))[0]
+
+    async def get_near_dups_many(self, simhashes):
+        """batched get_near_dups, every bucket is fetched once"""
+        simhashes = list(simhashes)
+        key2queries = collections.defaultdict(list)
+        values = []
+        for i, simhash in enumerate(simhashes):
+            assert simhash.f == self.f
+            values.append(simhash.value & self.mask)
+            for key in self.get_query_keys(simhash):
+                key2queries[key].append(i)
+
+        found = [dict() for _ in values]
+        keys = list(key2queries)
+        for key, dups in zip(keys, await self.storage.aget_many(keys)):
+            if not dups:
+                continue
+            queries = key2queries[key]
+            for i, dup, d in self.match([values[q] for q in queries], dups):
+                found[queries[i]][dup] = d
+        return await self.results(found)
+
+    async def add(self, obj_id, simhash):
+        """adding the simhash to the storage"""
+        await self.add_many([(obj_id, simhash)])
+
+    async def add_many(self, objs):
+        """adding several (obj_id, simhash) to the storage"""
+        id_pairs = []
+        key_pairs = []
+        for obj_id, simhash in objs:
+            assert simhash.f == self.f, f"index's f={self.f},simhash's f={simhash.f}"
+            v = self.storage.encode(simhash.value & self.mask)
+            id_pairs.append((v, obj_id))
+            key_pairs.extend((key, v) for key in self.get_keys(simhash))
+        if self.with_id:
+            await self.hash2id.aadd_many(id_pairs)
+        await self.storage.aadd_many(key_pairs)
+
+    async def remove(self, simhash):
+        """remove the simhash from the storage"""
+        assert simhash.f == self.f
+
+        v = self.storage.encode(simhash.value & self.mask)
+        # 所有bucket的删除为一次pipeline，与hash2id的删除并发
+        removing = [self.storage.aremove_many(
+            (key, v) for key in self.get_keys(simhash))]
+        if self.with_id:
+            removing.append(self.hash2id.aremove_many([(v, 0)]))
+        await asyncio.gather(*removing)
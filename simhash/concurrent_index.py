@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+多线程共享的SimhashIndex。
+SimhashIndex没有任何同步：get_near_dups2先查询再add，两个线程同时处理两篇相同的文本时，
+可能都查不到对方，结果都被插入；MemoryStorage的set在查询遍历时也可能被其他线程修改。
+这里按bucket的key分段加锁(striped lock)：每个操作持有它涉及的所有bucket所在的段，
+不同bucket上的查询和插入可以并行，get_near_dups2持有查询和插入的所有bucket，
+查重和插入是原子的，任何能查到它的插入都至少与它共用一个bucket。
+"""
+import contextlib
+import threading
+
+from .sim_hash import SimhashIndex, F, K
+from .storage import Storage
+
+
+class StripedLock(object):
+
+    def __init__(self, n_stripes=1024):
+        """n_stripes RLocks, a key is guarded by the lock hash(key) % n_stripes
+
+        :param n_stripes: {int} the number of locks, more stripes, fewer
+            unrelated buckets sharing a lock
+        """
+        self.locks = [threading.RLock() for _ in range(n_stripes)]
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        """hold the locks of all the keys, acquired in order so that two
+        threads never wait for each other"""
+        n = len(self.locks)
+        stripes = sorted(set(hash(key) % n for key in keys))
+        for i in stripes:
+            self.locks[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(stripes):
+                self.locks[i].release()
+
+    @contextlib.contextmanager
+    def hold_all(self):
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+
+class ThreadSafeSimhashIndex(SimhashIndex):
+
+    def __init__(self, objs=None, storage: Storage = None,
+                 map_storage: Storage = None, key_pre='',
+                 f=F, k=K, log=None, key_func=None, with_id=True,
+                 query_key_func=None, n_stripes=1024):
+        """SimhashIndex that can be shared by several threads.
+        Every method holds the locks of the buckets it reads or writes,
+        get_near_dups2 and get_near_dups2_many hold the buckets of both the
+        query and the insert, so the duplication check and the insert are
+        atomic.
+
+        :param n_stripes: {int} the number of bucket locks
+        other params are the same with SimhashIndex
+        """
+        self.lock = StripedLock(n_stripes)
+        super().__init__(objs=objs, storage=storage, map_storage=map_storage,
+                         key_pre=key_pre, f=f, k=k, log=log,
+                         key_func=key_func, with_id=with_id,
+                         query_key_func=query_key_func)
+
+    def keys_of(self, simhashes, query=True, add=True):
+        keys = []
+        for simhash in simhashes:
+            if query:
+                keys.extend(self.get_query_keys(simhash))
+            if add:
+                keys.extend(self.get_keys(simhash))
+        return keys
+
+    def get_one_near_dup(self, simhash):
+        with self.lock.hold(self.keys_of([simhash], add=False)):
+            return super().get_one_near_dup(simhash)
+
+    def get_near_dups(self, simhash):
+        with self.lock.hold(self.keys_of([simhash], add=False)):
+            return super().get_near_dups(simhash)
+
+    def get_near_dups2(self, simhash, cur_id):
+        with self.lock.hold(self.keys_of([simhash])):
+            return super().get_near_dups2(simhash, cur_id)
+
+    def get_near_dups_many(self, simhashes):
+        simhashes = list(simhashes)
+        with self.lock.hold(self.keys_of(simhashes, add=False)):
+            return super().get_near_dups_many(simhashes)
+
+    def get_near_dups2_many(self, simhashes, cur_ids):
+        simhashes = list(simhashes)
+        with self.lock.hold(self.keys_of(simhashes)):
+            return super().get_near_dups2_many(simhashes, cur_ids)
+
+    def add(self, obj_id, simhash):
+        with self.lock.hold(self.keys_of([simhash], query=False)):
+            super().add(obj_id, simhash)
+
+    def add_many(self, objs):
+        objs = list(objs)
+        keys = self.keys_of((simhash for _, simhash in objs), query=False)
+        with self.lock.hold(keys):
+            super().add_many(objs)
+
+    def remove(self, simhash):
+        with self.lock.hold(self.keys_of([simhash], query=False)):
+            super().remove(simhash)
+
+    def items(self):
+        """a snapshot of the (int simhash, obj_id) pairs, taken while no
+        other thread is writing"""
+        with self.lock.hold_all():
+            return iter(list(super().items()))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+这里存放的是token的hash函数，hash函数接收utf-8编码的bytes，返回至少f位的无符号整数。
+摘要直接用int.from_bytes转为整数，省去hexdigest再int(..., 16)解析回来的开销。
+语料中的词高度重复，所以默认的hash函数外面包了一层LRU缓存，所有Simhash实例共享。
+"""
+import functools
+import hashlib
+
+HASH_CACHE_SIZE = 2 ** 17  # token -> hash 缓存的最大条目数
+
+
+def md5_hash(x):
+    """md5，结果与int(hashlib.md5(x).hexdigest(), 16)完全一致"""
+    return int.from_bytes(hashlib.md5(x).digest(), 'big')
+
+
+def blake2b_hash(x, digest_size=8):
+    """blake2b，digest_size为摘要的字节数，需要满足digest_size * 8 >= f"""
+    return int.from_bytes(
+        hashlib.blake2b(x, digest_size=digest_size).digest(), 'big')
+
+
+def make_blake2b_hash(digest_size=8):
+    """返回一个指定digest_size的blake2b hash函数，f=64时8个字节即可"""
+    return functools.partial(blake2b_hash, digest_size=digest_size)
+
+
+def cached(hashfunc, maxsize=HASH_CACHE_SIZE):
+    """给hashfunc加上一个有界的LRU缓存(token -> hash)。
+
+    通过返回函数的cache_info()查看命中数(hits)、未命中数(misses)和当前大小，
+    据此调整maxsize；cache_clear()清空缓存。
+
+    :param hashfunc: 接收bytes返回int的hash函数
+    :param maxsize: {int} 缓存的最大条目数
+    :return: 带缓存的hash函数
+    """
+    return functools.lru_cache(maxsize=maxsize)(hashfunc)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+只读的idf词典文件，使用mmap加载。
+JIEBA_IDF_DIC是几十万个str -> float的python dict，每个进程一份，fork出来的worker
+在引用计数修改之后也会各自复制一份。这里把词典写成紧凑的二进制文件，
+所有进程共享同一份page cache，查询时二分查找。
+
+文件格式（小端序，所有数组按8字节对齐）：
+    header: magic(8s) dtype(8s) n(Q) blob_size(Q) mtime_ns(q) size(q)
+        mtime_ns和size是源文件的版本，用于判断缓存是否过期
+    prefixes: uint64[n]，每个词utf-8编码的前8个字节（大端序，不足补0），用于批量查找
+    offsets: uint32[n + 1]，每个词在blob中的起止位置
+    values: dtype[n]，每个词的idf，默认float64，与dict中的值完全相同
+    blob: 所有的词按utf-8编码的字节序排好序后拼接在一起
+"""
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from .mmap_index import _write
+from .resources import is_trusted, make_cache_dir
+
+MAGIC = b'SHIDF001'
+HEADER = struct.Struct('<8s8sQQqq')
+
+
+def prefix(key):
+    """the first 8 bytes of an encoded word as an int, keeps the byte order"""
+    return int.from_bytes(key[:8].ljust(8, b'\0'), 'big')
+
+
+def save_idf_store(path, dic, dtype='<f8', version=(0, 0)):
+    """write a token -> idf dict into an idf store file
+
+    :param path: {str} the file to write
+    :param dic: {dict} token -> idf
+    :param dtype: {str} dtype of the idf values, '<f4' halves their size
+        but the weights, and so the simhashes, may change slightly
+    :param version: {tuple} (mtime_ns, size) of the source file
+    """
+    items = sorted((word.encode('utf-8'), idf) for word, idf in dic.items())
+    keys = [key for key, _ in items]
+    blob = b''.join(keys)
+    if len(blob) >= 1 << 32:
+        raise ValueError(f'too many words: {len(blob)} bytes')
+    offsets = np.zeros(len(keys) + 1, dtype='<u4')
+    np.cumsum([len(key) for key in keys], out=offsets[1:])
+
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, dtype.encode(), len(keys), len(blob),
+                             *version))
+        _write(fp, np.array([prefix(key) for key in keys], dtype='<u8'))
+        _write(fp, offsets)
+        _write(fp, np.array([idf for _, idf in items], dtype=dtype))
+        fp.write(blob)
+
+
+class IdfStore(object):
+
+    def __init__(self, path):
+        """a read-only token -> idf dict over a file written by
+        save_idf_store, the same `get(word, default)` contract as a dict.
+
+        :param path: {str} the idf store file
+        """
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, dtype, n, blob_size, *version = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an idf store file')
+        self.n = n
+        self.version = tuple(version)
+
+        pos = HEADER.size
+
+        def view(dtype, count):
+            nonlocal pos
+            array = np.frombuffer(self.buf, dtype=dtype, count=count,
+                                  offset=pos)
+            pos += array.nbytes + (-array.nbytes % 8)
+            return array
+
+        self.prefixes = view('<u8', n)
+        self.offsets = view('<u4', n + 1)
+        self.values = view(dtype.rstrip(b'\0').decode(), n)
+        self.blob_start = pos
+        if len(self.buf) < pos + blob_size:
+            raise ValueError(f'{path} is truncated')
+
+    def word(self, i):
+        """the i-th encoded word"""
+        start = self.blob_start
+        return self.buf[start + int(self.offsets[i]):
+                        start + int(self.offsets[i + 1])]
+
+    def find(self, key, lo=None, hi=None):
+        """:return: {int} the row of the encoded word, -1 if not found"""
+        if lo is None:
+            p = np.uint64(prefix(key))
+            lo = int(self.prefixes.searchsorted(p, 'left'))
+            hi = int(self.prefixes.searchsorted(p, 'right'))
+        # 前8个字节相同的词一般只有几个，在这个范围内二分查找
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n and self.word(lo) == key:
+            return lo
+        return -1
+
+    def get(self, word, default=None):
+        i = self.find(word.encode('utf-8'))
+        return default if i < 0 else float(self.values[i])
+
+    def get_many(self, words, default=None):
+        """look up several words at once, the prefixes are searched with
+        numpy in one call
+
+        :return: {list} the idf of every word, default if not found
+        """
+        keys = [word.encode('utf-8') for word in words]
+        p = np.array([prefix(key) for key in keys], dtype=np.uint64)
+        los = self.prefixes.searchsorted(p, 'left').tolist()
+        his = self.prefixes.searchsorted(p, 'right').tolist()
+        rows = [self.find(key, lo, hi) for key, lo, hi in zip(keys, los, his)]
+        found = [i for i in rows if i >= 0]
+        values = iter(self.values[found].tolist())
+        return [default if i < 0 else next(values) for i in rows]
+
+    def __getitem__(self, word):
+        i = self.find(word.encode('utf-8'))
+        if i < 0:
+            raise KeyError(word)
+        return float(self.values[i])
+
+    def __contains__(self, word):
+        return self.find(word.encode('utf-8')) >= 0
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.word(i).decode('utf-8')
+
+    def items(self):
+        return zip(self, self.values.tolist())
+
+
+def open_idf_store(path, cache):
+    """open the idf store compiled from the idf text file `path`, compile
+    it into `cache` first if it does not exist or is out of date
+
+    :param path: {str} the idf text file, one `word idf` per line
+    :param cache: {str} the compiled idf store file, only loaded if it is
+        trusted (see resources.is_trusted), recompiled otherwise
+    :return: {IdfStore}
+    """
+    from .sim_hash import load_idf_dic
+
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if is_trusted(cache):
+        try:
+            store = IdfStore(cache)
+            if store.version == version:
+                return store
+        except (OSError, ValueError, TypeError):
+            pass
+
+    make_cache_dir(os.path.dirname(cache))
+    tmp = f'{cache}.{os.getpid()}.tmp'
+    save_idf_store(tmp, load_idf_dic(path), version=version)
+    os.replace(tmp, cache)
+    return IdfStore(cache)
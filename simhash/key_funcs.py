@@ -8,6 +8,7 @@ Created on 2020-03-20
 按照论文的写法，在k较大时，容易出现分桶倾斜，某些桶下的simhash量巨大，导致运行速度极慢
 源代码作者的意见是，更换hashfunc
 """
+import itertools
 
 
 def simple_split(hash_str, k):
@@ -81,3 +82,56 @@ def get_keys0(simhash, f=64, k=3, key_pre=''):
             m = 2 ** (offsets[i + 1] - offset) - 1
         c = simhash.value >> offset & m
         yield '%s%x:%x' % (key_pre, c, i)
+
+
+def get_int_keys(simhash, f=64, k=3, key_pre=''):
+    """与get_keys0的拆分方式相同，但是key为整数：(第i份的序号 << f) | 第i份的值，
+    省去了格式化字符串的开销。key_pre会被忽略，所以只适用于内存存储"""
+    offsets = [f // (k + 1) * i for i in range(k + 1)] + [f]
+    value = simhash.value
+    keys = []
+    for i in range(k + 1):
+        m = (1 << (offsets[i + 1] - offsets[i])) - 1
+        keys.append(i << f | (value >> offsets[i] & m))
+    return keys
+
+
+def split_offsets(f, m):
+    """将f位均匀拆为m份，返回每份的(起始位, 位数)，从最低位开始，任意两份长度差最大为1"""
+    quotient, remainder = divmod(f, m)
+    offsets = []
+    start = 0
+    for i in range(m):
+        size = quotient + 1 if i < remainder else quotient
+        offsets.append((start, size))
+        start += size
+    return offsets
+
+
+def get_keys_mih(simhash, f=64, k=3, key_pre='', m=4):
+    """multi-index hashing，将simhash拆为m份（与k无关），每份生成一个key，用于存储。
+    查询时需要搭配get_query_keys_mih使用，通过functools.partial指定m：
+    SimhashIndex(key_func=partial(get_keys_mih, m=4),
+                 query_key_func=partial(get_query_keys_mih, m=4))
+    """
+    for i, (start, size) in enumerate(split_offsets(f, m)):
+        c = simhash.value >> start & ((1 << size) - 1)
+        yield '%s%x:m%x' % (key_pre, c, i)
+
+
+def get_query_keys_mih(simhash, f=64, k=3, key_pre='', m=4):
+    """multi-index hashing的查询key。
+    距离不超过k的两个simhash，拆为m份后，至少有一份的距离不超过k // m（抽屉原理），
+    所以对每一份，枚举与它距离不超过k // m的所有值（hamming ball）作为查询的key。
+    m越大，每份越短，桶越大；m越小，每份的hamming ball越大，查询的key越多。
+    m = k + 1时退化为get_keys0的精确匹配。
+    """
+    r = k // m
+    for i, (start, size) in enumerate(split_offsets(f, m)):
+        c = simhash.value >> start & ((1 << size) - 1)
+        for radius in range(min(r, size) + 1):
+            for bits in itertools.combinations(range(size), radius):
+                flipped = c
+                for b in bits:
+                    flipped ^= 1 << b
+                yield '%s%x:m%x' % (key_pre, flipped, i)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+磁盘上的只读索引文件，使用mmap加载，不需要逐条add重建。
+多个worker进程打开同一个文件时共享同一份page cache，启动几乎是瞬间完成的。
+
+文件格式（小端序，所有数组按8字节对齐）：
+    header: magic(8s) f(I) k(I) n(Q) with_id(Q)
+    每张表的key数量: u_0 ... u_k (Q)
+    values: uint64[n]，所有的simhash
+    ids: int64[n]，对应的obj_id
+    k+1张表，按get_keys0的方式把simhash拆为k+1份，每份一张表：
+        keys: uint64[u_t]，排好序的不重复的分段值
+        offsets: uint64[u_t + 1]，每个分段值在rows中的起止位置
+        rows: uint32[n]，按分段值排序后的行号
+"""
+import logging
+import os
+import struct
+
+import numpy as np
+
+from .scan_index import ArraySimhashIndex, popcount
+from .sim_hash import F, K
+
+MAGIC = b'SIMHASH1'
+HEADER = struct.Struct('<8sIIQQ')
+
+
+def table_offsets(f, k):
+    """与get_keys0相同的拆分方式，返回每份的(起始位, mask)"""
+    offsets = [f // (k + 1) * i for i in range(k + 1)] + [f]
+    return [(offsets[i], (1 << (offsets[i + 1] - offsets[i])) - 1)
+            for i in range(k + 1)]
+
+
+def _write(fp, array):
+    fp.write(array.tobytes())
+    pad = -array.nbytes % 8
+    if pad:
+        fp.write(b'\0' * pad)
+
+
+def save_index(path, values, ids=None, f=F, k=K):
+    """write the simhash values and their ids into an index file
+
+    :param path: {str} the file to write
+    :param values: {list} int simhash values, at most 64 bits
+    :param ids: {list} int obj_ids of the values, None if without id
+    :param f: {int} the dimensions of fingerprints
+    :param k: {int} the tolerance
+    """
+    if f > 64:
+        raise ValueError(f'f={f} does not fit into uint64')
+    values = np.asarray(values, dtype=np.uint64)
+    n = len(values)
+    if n >= 1 << 32:
+        raise ValueError(f'too many simhashes: {n}')
+    with_id = ids is not None
+    ids = np.asarray(ids if with_id else np.zeros(n), dtype=np.int64)
+
+    tables = []
+    for start, mask in table_offsets(f, k):
+        pieces = (values >> np.uint64(start)) & np.uint64(mask)
+        rows = np.argsort(pieces, kind='stable').astype(np.uint32)
+        keys, counts = np.unique(pieces[rows], return_counts=True)
+        offsets = np.zeros(len(keys) + 1, dtype=np.uint64)
+        np.cumsum(counts, out=offsets[1:])
+        tables.append((keys.astype(np.uint64), offsets, rows))
+
+    # 写入临时文件后替换，已经mmap了旧文件的进程继续读旧的inode，
+    # 不会读到写了一半的索引，也不会因为文件被截断而SIGBUS
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, f, k, n, int(with_id)))
+            _write(fp, np.array([len(keys) for keys, _, _ in tables],
+                                dtype=np.uint64))
+            _write(fp, values)
+            _write(fp, ids)
+            for table in tables:
+                for array in table:
+                    _write(fp, array)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class MmapSimhashIndex(ArraySimhashIndex):
+
+    def __init__(self, path, log=None):
+        """read-only index over a file written by save_index, the arrays
+        are views of a read-only memory map, nothing is copied.
+
+        :param path: {str} the index file
+        :param log: {logger}
+        """
+        # 不调用ArraySimhashIndex.__init__，不需要预分配数组和value -> row的dict
+        self.path = path
+        self.buf = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, f, k, n, with_id = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a simhash index file')
+        self.f = f
+        self.k = k
+        self.mask = (1 << f) - 1
+        self.with_id = bool(with_id)
+        self.size = n
+        self.n_dead = 0
+        if log is None:
+            self.log = logging.getLogger("simhash")
+        else:
+            self.log = log
+
+        pos = HEADER.size
+
+        def view(dtype, count):
+            nonlocal pos
+            array = np.frombuffer(self.buf, dtype=dtype, count=count,
+                                  offset=pos)
+            pos += array.nbytes + (-array.nbytes % 8)
+            return array
+
+        n_keys = view(np.uint64, k + 1).tolist()
+        self.values = view(np.uint64, n)
+        self.ids = view(np.int64, n)
+        self.tables = []
+        for (start, mask), u in zip(table_offsets(f, k), n_keys):
+            keys = view(np.uint64, u)
+            offsets = view(np.uint64, u + 1)
+            rows = view(np.uint32, n)
+            self.tables.append((start, mask, keys, offsets, rows))
+
+    def __len__(self):
+        return self.size
+
+    def add(self, obj_id, simhash):
+        raise TypeError('MmapSimhashIndex is read-only')
+
+    def remove(self, simhash):
+        raise TypeError('MmapSimhashIndex is read-only')
+
+    def compact(self):
+        raise TypeError('MmapSimhashIndex is read-only')
+
+    def search(self, value):
+        candidates = []
+        for start, mask, keys, offsets, rows in self.tables:
+            c = np.uint64(value >> start & mask)
+            i = int(np.searchsorted(keys, c))
+            if i < len(keys) and keys[i] == c:
+                candidates.append(rows[offsets[i]:offsets[i + 1]])
+        if not candidates:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        rows = np.unique(np.concatenate(candidates)).astype(np.int64)
+        d = popcount(self.values[rows] ^ np.uint64(value))
+        hit = d <= self.k
+        return rows[hit], d[hit]
+
+    def get_near_dups2(self, simhash, cur_id):
+        raise TypeError('MmapSimhashIndex is read-only')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+论文(Manku et al. 2007)第3节的做法：把f位拆成B块，任选B-k块放到最高位，
+得到C(B, k)张置换后的表，每张表按置换后的值排序。
+两个simhash距离不超过k时，至少有B-k块完全相同，一定会在某张表的同一前缀区间中，
+查询只需在每张表上二分查找前缀，再扫描一段连续的区间。
+和按桶存储相比，每张表扫描的数量只和数据总量/2^前缀位数有关，不受个别大桶的影响。
+"""
+import itertools
+import math
+
+import numpy as np
+
+from .key_funcs import even_split
+from .scan_index import ArraySimhashIndex, popcount
+from .sim_hash import F, K
+
+
+def split_blocks(f, n_blocks):
+    """将f位均匀拆为n_blocks块，返回每块的(起始位, 位数)，从最低位开始"""
+    blocks = []
+    start = 0
+    for bits in even_split('0' * f, n_blocks - 1):
+        blocks.append((start, len(bits)))
+        start += len(bits)
+    return blocks
+
+
+def plan_tables(f=F, k=K, expected_size=1 << 20, max_tables=64):
+    """根据(f, k, 预计数据量)选择拆分的块数B
+
+    每次查询的代价约为 T * (log2(n) + n / 2^p)，T=C(B, k)为表的数量，
+    p为前缀位数，内存约为T份数据。在T不超过max_tables的前提下选代价最小的B。
+
+    :param f: {int} the dimensions of fingerprints
+    :param k: {int} the tolerance
+    :param expected_size: {int} expected number of simhashes
+    :param max_tables: {int} upper limit of the table count
+    :return: {int} the number of blocks B
+    """
+    n = max(expected_size, 2)
+    best, best_cost = k + 1, None
+    for n_blocks in range(k + 1, f + 1):
+        n_tables = math.comb(n_blocks, k)
+        if n_tables > max_tables and n_blocks > k + 1:
+            break
+        blocks = split_blocks(f, n_blocks)
+        # 最短的B-k块作为前缀，即最差情况下的前缀位数
+        prefix = sum(sorted(bits for _, bits in blocks)[:n_blocks - k])
+        cost = n_tables * (math.log2(n) + n / 2 ** prefix)
+        if best_cost is None or cost < best_cost:
+            best, best_cost = n_blocks, cost
+    return best
+
+
+class PermutedTable(object):
+
+    def __init__(self, blocks, lead, f=F):
+        """one permuted copy of the simhash array, sorted by the permuted value
+
+        :param blocks: {list} (start, bits) of every block
+        :param lead: {tuple} indices of the blocks moved to the leading bits
+        """
+        self.f = f
+        order = list(lead) + [i for i in range(len(blocks)) if i not in lead]
+        # (start, bits, 置换后的起始位)
+        self.moves = []
+        pos = f
+        for i in order:
+            start, bits = blocks[i]
+            pos -= bits
+            self.moves.append((start, bits, pos))
+        self.shift = pos + sum(blocks[i][1] for i in order[len(lead):])
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.order = np.zeros(0, dtype=np.int64)
+
+    def permute(self, values):
+        """permute an uint64 array or a single int"""
+        if isinstance(values, int):
+            out = 0
+            for start, bits, pos in self.moves:
+                out |= ((values >> start) & ((1 << bits) - 1)) << pos
+            return out
+        out = np.zeros(len(values), dtype=np.uint64)
+        for start, bits, pos in self.moves:
+            m = np.uint64((1 << bits) - 1)
+            out |= ((values >> np.uint64(start)) & m) << np.uint64(pos)
+        return out
+
+    def build(self, values):
+        permuted = self.permute(values)
+        self.order = np.argsort(permuted, kind='stable')
+        self.keys = permuted[self.order]
+
+    def probe(self, value):
+        """rows whose permuted value has the same prefix with value"""
+        lo = self.permute(value) >> self.shift << self.shift
+        hi = lo + (1 << self.shift) - 1
+        i0 = np.searchsorted(self.keys, np.uint64(lo), side='left')
+        i1 = np.searchsorted(self.keys, np.uint64(hi), side='right')
+        return self.order[i0:i1]
+
+
+class PermutedSimhashIndex(ArraySimhashIndex):
+
+    def __init__(self, objs=None, f=F, k=K, log=None, with_id=True,
+                 capacity=1024, compact_ratio=0.25,
+                 expected_size=None, n_blocks=None, max_tables=64,
+                 rebuild_ratio=0.1, min_pending=1024):
+        """Manku-style index of C(B, k) permuted and sorted tables.
+
+        New simhashes are appended to the array and scanned brute-force
+        until they exceed `rebuild_ratio` of the indexed ones (and at least
+        `min_pending`), then the tables are rebuilt on the next query.
+        Note that such a query pays for a full rebuild: all the C(B, k)
+        tables are re-sorted, O(C(B, k) * n log n), and a compact() after
+        removals rebuilds them as well.
+
+        :param expected_size: {int} expected number of simhashes, used to plan
+            the number of blocks, defaults to len(objs)
+        :param n_blocks: {int} the number of blocks B, overrides the plan.
+            The table count is C(B, k), the prefix width about f * (B-k) / B
+        :param max_tables: {int} upper limit of the table count when planning
+        :param rebuild_ratio: {float} pending / indexed ratio to rebuild
+        :param min_pending: {int} never rebuild for fewer pending simhashes
+        """
+        if n_blocks is None:
+            if expected_size is None and objs is not None:
+                objs = list(objs)  # 可能是generator，规划需要知道数量
+                expected_size = len(objs)
+            n_blocks = plan_tables(f, k, expected_size or 1 << 20,
+                                   max_tables)
+        if n_blocks <= k:
+            raise ValueError(f'n_blocks={n_blocks} must be larger than k={k}')
+        self.n_blocks = n_blocks
+        self.rebuild_ratio = rebuild_ratio
+        self.min_pending = min_pending
+        blocks = split_blocks(f, n_blocks)
+        self.tables = [PermutedTable(blocks, lead, f) for lead in
+                       itertools.combinations(range(n_blocks), n_blocks - k)]
+        self.built = 0  # rows [0, built) are in the tables
+        super().__init__(objs, f=f, k=k, log=log, with_id=with_id,
+                         capacity=capacity, compact_ratio=compact_ratio)
+        self.rebuild_tables()
+
+    def _compacted(self):
+        self.rebuild_tables()
+
+    def rebuild_tables(self):
+        """(re)build all the C(B, k) tables from the current rows, the
+        pending simhashes are indexed afterwards"""
+        values = self.values[:self.size]
+        for table in self.tables:
+            table.build(values)
+        self.built = self.size
+
+    def search(self, value):
+        pending = self.size - self.built
+        if pending > max(self.min_pending, self.rebuild_ratio * self.built):
+            self.rebuild_tables()  # 这次查询承担全部表的重建
+
+        candidates = [table.probe(value) for table in self.tables]
+        candidates.append(np.arange(self.built, self.size))
+        rows = np.unique(np.concatenate(candidates))
+        d = popcount(self.values[rows] ^ np.uint64(value))
+        hit = (d <= self.k) & self.alive[rows]
+        return rows[hit], d[hit]
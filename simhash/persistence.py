@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+内存索引的持久化：追加写日志 + 定期快照。
+使用MemoryStorage时，get_near_dups2实时插入的数据在重启后会全部丢失，
+之前想要持久化只能用redis，每次插入都要走一次网络。
+这里每次add/remove先追加一条二进制记录到本地日志，批量fsync（group commit），
+日志达到一定条数后切换到新的日志，在后台线程中把整个索引写成快照，
+快照落盘之后才删除旧的日志。
+恢复时先加载快照，再按顺序重放旧的日志和新的日志。add/remove都是幂等的，重放多了也没有关系。
+"""
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+from .sim_hash import Simhash, SimhashIndex, F, K, paused_gc
+from .storage import Storage
+
+MAGIC = b'SHLOG001'
+# crc32, 操作类型, id的类型, id的长度
+RECORD = struct.Struct('<IBBH')
+OP_ADD = 1
+OP_REMOVE = 2
+ID_STR = 0
+ID_INT = 1
+ID_BYTES = 2
+# 恢复时连续的add记录每批最多这么多条，一起交给add_many
+REPLAY_BATCH = 100000
+
+
+def encode_id(obj_id):
+    if isinstance(obj_id, bytes):
+        return ID_BYTES, obj_id
+    if isinstance(obj_id, int):
+        return ID_INT, str(obj_id).encode()
+    return ID_STR, str(obj_id).encode('utf-8')
+
+
+def decode_id(id_type, data):
+    if id_type == ID_BYTES:
+        return data
+    if id_type == ID_INT:
+        return int(data)
+    return data.decode('utf-8')
+
+
+def pack_record(op, value, obj_id, n_bytes):
+    id_type, id_data = encode_id(obj_id)
+    body = bytes([op, id_type]) + struct.pack('<H', len(id_data)) + \
+        value.to_bytes(n_bytes, 'little') + id_data
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+def read_records(path, n_bytes):
+    """yield the (op, value, obj_id, end offset) records of a log or
+    snapshot file, stop at the first incomplete or corrupted record
+    (a torn write)"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a simhash log file')
+        while True:
+            head = fp.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            crc, op, id_type, id_len = RECORD.unpack(head)
+            data = fp.read(n_bytes + id_len)
+            if len(data) < n_bytes + id_len or \
+                    zlib.crc32(head[4:] + data) != crc:
+                return
+            value = int.from_bytes(data[:n_bytes], 'little')
+            yield op, value, decode_id(id_type, data[n_bytes:]), fp.tell()
+
+
+def fsync_dir(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class PersistentSimhashIndex(SimhashIndex):
+
+    def __init__(self, path, storage: Storage = None,
+                 map_storage: Storage = None, key_pre='',
+                 f=F, k=K, log=None, key_func=None, query_key_func=None,
+                 sync_every=100, sync_interval=1.0,
+                 snapshot_every=1000000, pause_gc=False):
+        """SimhashIndex whose add/remove are appended to a log under `path`
+        and recovered from it on start.
+
+        :param path: {str} directory of the log and the snapshot
+        :param sync_every: {int} fsync the log after so many records
+        :param sync_interval: {float} a background thread fsyncs the
+            pending records every so many seconds, None to only fsync
+            every sync_every records. Every record is flushed to the OS
+            when written, so only a crash of the machine within the
+            interval can lose it, not a crash of the process
+        :param snapshot_every: {int} write a snapshot and empty the log
+            after so many records, None to only snapshot by hand. The
+            log is switched at once, the snapshot is written by a
+            background thread
+        :param pause_gc: {bool} pause the gc of the whole process while
+            recovering, see SimhashIndex.build
+        other params are the same with SimhashIndex. with_id is always
+        True, the snapshot is written from the simhash -> obj_id map
+        """
+        super().__init__(storage=storage, map_storage=map_storage,
+                         key_pre=key_pre, f=f, k=k, log=log,
+                         key_func=key_func, with_id=True,
+                         query_key_func=query_key_func)
+        self.path = path
+        self.n_bytes = (f + 7) // 8
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.log_path = os.path.join(path, 'simhash.log')
+        # 正在写快照时，切换前的日志，快照落盘后删除
+        self.old_log_path = self.log_path + '.old'
+        self.snapshot_path = os.path.join(path, 'simhash.snapshot')
+        os.makedirs(path, exist_ok=True)
+
+        has_old_log = self.recover(pause_gc)
+        self.fp = self.open_log('ab')
+        self.n_logged = 0  # records in the log
+        self.n_pending = 0  # records not fsynced yet
+        self.last_sync = time.time()
+        # 写日志、修改storage、切换日志和后台fsync互斥，
+        # 切换日志时storage中正好是旧日志中所有记录的结果
+        self.lock = threading.RLock()
+        self.closed = threading.Event()
+        self.snapshot_thread = None
+        self.snapshot_busy = False  # 正在写快照，同时只写一个
+        self.snapshot_done = threading.Condition(self.lock)
+        if has_old_log:  # 上次写快照时中断了，重新写一次
+            self.snapshot()
+        self.sync_thread = None
+        if sync_interval is not None:
+            self.sync_thread = threading.Thread(target=self.sync_loop,
+                                                daemon=True)
+            self.sync_thread.start()
+
+    def open_log(self, mode):
+        fp = open(self.log_path, mode)
+        if fp.tell() == 0:
+            fp.write(MAGIC)
+            fp.flush()
+        return fp
+
+    def replay(self, records):
+        """apply the records without logging them, the runs of adds are
+        added in batches through SimhashIndex.add_many
+
+        :return: (the number of records, end offset of the last one)
+        """
+        n = 0
+        end = len(MAGIC)
+        batch = []
+        for op, value, obj_id, end in records:
+            n += 1
+            if op == OP_ADD:
+                batch.append((obj_id, Simhash(value, self.f)))
+                if len(batch) < REPLAY_BATCH:
+                    continue
+            if batch:
+                SimhashIndex.add_many(self, batch)
+                batch = []
+            if op == OP_REMOVE:
+                SimhashIndex.remove(self, Simhash(value, self.f))
+        if batch:
+            SimhashIndex.add_many(self, batch)
+        return n, end
+
+    def recover(self, pause_gc=False):
+        """load the snapshot, then replay the logs written after it
+
+        :param pause_gc: {bool} see SimhashIndex.build
+        :return: {bool} whether the log of an unfinished snapshot is left
+        """
+        with paused_gc(pause_gc):
+            n_snapshot, _ = self.replay(
+                read_records(self.snapshot_path, self.n_bytes))
+            n_old, _ = self.replay(
+                read_records(self.old_log_path, self.n_bytes))
+            n_log, end = self.replay(
+                read_records(self.log_path, self.n_bytes))
+        # 截掉末尾写了一半的记录，否则之后追加的记录都读不出来
+        if os.path.exists(self.log_path) and \
+                os.path.getsize(self.log_path) > end:
+            os.truncate(self.log_path, end)
+        self.log.info('Recovered %s records from the snapshot and %s from '
+                      'the logs.', n_snapshot, n_old + n_log)
+        return os.path.exists(self.old_log_path)
+
+    def write(self, records):
+        """append (op, value, obj_id) records and flush them to the OS,
+        fsync once sync_every records are pending"""
+        with self.lock:
+            self.fp.write(b''.join(
+                pack_record(op, value, obj_id, self.n_bytes)
+                for op, value, obj_id in records))
+            self.fp.flush()
+            self.n_logged += len(records)
+            self.n_pending += len(records)
+            if self.n_pending >= self.sync_every:
+                self.fsync()
+
+    def sync_loop(self):
+        """fsync the pending records every sync_interval seconds"""
+        while not self.closed.wait(self.sync_interval):
+            with self.lock:
+                if self.n_pending and not self.fp.closed:
+                    self.fsync()
+
+    def maybe_snapshot(self):
+        """snapshot in the background once the log is long enough, called
+        with the lock held after the logged records have been applied"""
+        if (self.snapshot_every and self.n_logged >= self.snapshot_every and
+                not self.snapshot_busy):
+            self.snapshot_busy = True
+            items = self.switch_log()
+            self.snapshot_thread = threading.Thread(
+                target=self.write_snapshot, args=(items,), daemon=True)
+            self.snapshot_thread.start()
+
+    def fsync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.n_pending = 0
+        self.last_sync = time.time()
+
+    def sync(self):
+        """flush and fsync the pending records (group commit)"""
+        with self.lock:
+            self.fsync()
+
+    def switch_log(self):
+        """move the log aside and start a new one, called with the lock held
+
+        :return: {list} the (member, obj_id) pairs of the index at the
+            moment of the switch, i.e. the result of the moved log
+        """
+        self.fsync()
+        self.fp.close()
+        if os.path.exists(self.old_log_path):
+            # 上一次的快照失败了，旧日志还不能丢，把当前的日志接在后面
+            with open(self.old_log_path, 'ab') as out, \
+                    open(self.log_path, 'rb') as fp:
+                fp.seek(len(MAGIC))
+                shutil.copyfileobj(fp, out)
+                out.flush()
+                os.fsync(out.fileno())
+        else:
+            os.replace(self.log_path, self.old_log_path)
+        self.fp = self.open_log('wb')
+        self.fsync()
+        fsync_dir(self.path)
+        self.n_logged = 0
+        return list(self.hash2id.items())
+
+    def write_snapshot(self, items):
+        """write the items returned by switch_log into the snapshot, then
+        delete the moved log, whose records are all in the snapshot"""
+        try:
+            tmp_path = self.snapshot_path + '.tmp'
+            decode = self.storage.decode
+            with open(tmp_path, 'wb') as fp:
+                fp.write(MAGIC)
+                for member, obj_id in items:
+                    fp.write(pack_record(OP_ADD, decode(member), obj_id,
+                                         self.n_bytes))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            fsync_dir(self.path)
+            os.remove(self.old_log_path)
+        finally:
+            with self.lock:
+                self.snapshot_busy = False
+                self.snapshot_done.notify_all()
+
+    def snapshot(self):
+        """write the whole index into the snapshot and empty the log,
+        waits for the background snapshot if there is one"""
+        with self.lock:
+            self.snapshot_done.wait_for(lambda: not self.snapshot_busy)
+            self.snapshot_busy = True
+            items = self.switch_log()
+        self.write_snapshot(items)
+
+    def close(self):
+        self.closed.set()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        self.sync()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, obj_id, simhash):
+        """log, then add the simhash to the storage"""
+        assert simhash.f == self.f, f"index's f={self.f},simhash's f={simhash.f}"
+        with self.lock:
+            self.write([(OP_ADD, simhash.value & self.mask, obj_id)])
+            super().add(obj_id, simhash)
+            self.maybe_snapshot()
+
+    def add_many(self, objs):
+        """log, then add several (obj_id, simhash) to the storage"""
+        objs = list(objs)
+        for obj_id, simhash in objs:
+            assert simhash.f == self.f, f"index's f={self.f},simhash's f={simhash.f}"
+        with self.lock:
+            self.write([(OP_ADD, simhash.value & self.mask, obj_id)
+                        for obj_id, simhash in objs])
+            super().add_many(objs)
+            self.maybe_snapshot()
+
+    def remove(self, simhash):
+        """log, then remove the simhash from the storage"""
+        assert simhash.f == self.f
+        with self.lock:
+            self.write([(OP_REMOVE, simhash.value & self.mask, '')])
+            super().remove(simhash)
+            self.maybe_snapshot()
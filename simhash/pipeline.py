@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+多进程流式计算simhash。
+分词(jieba)、tf_idf和build_by_features都是单线程的，SimhashIndex(objs=...)还需要先把所有数据读进内存。
+这里把(id, text)的迭代器按块分给进程池，每个worker只初始化一次jieba词典，
+结果按输入的顺序分块返回，同时在途的块数有上限，内存占用与数据总量无关，可以直接写入索引。
+"""
+import collections
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .sim_hash import Simhash, F, JIEBA_IDF_DIC
+from .tokenizer import get_jieba, get_stop_words
+
+
+def read_jsonl(path, id_field='id', text_field='text'):
+    """逐行读取jsonl文件，yield (id, text)"""
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            if line.strip():
+                obj = json.loads(line)
+                yield obj[id_field], obj[text_field]
+
+
+def chunked(iterable, size):
+    """将iterable按size切分为多个list"""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def init_worker(featurizer=None):
+    """每个worker进程只初始化一次jieba、自定义词典、停用词和idf词典，
+    使用featurizer时不需要"""
+    if featurizer is None:
+        get_jieba().initialize()
+        get_stop_words()
+        len(JIEBA_IDF_DIC)
+
+
+def fingerprint_chunk(chunk, f=F, featurizer=None):
+    """:return: {list} [(id, simhash value), ...]"""
+    return [(obj_id, Simhash(text, f, featurizer=featurizer).value)
+            for obj_id, text in chunk]
+
+
+def fingerprint_stream(items, processes=None, chunk_size=1000,
+                       max_pending=None, f=F, featurizer=None):
+    """compute the simhashes of (id, text) pairs in a process pool
+
+    :param items: an iterable of (id, text), e.g. read_jsonl(path)
+    :param processes: {int} worker processes, None for os.cpu_count(),
+        1 to compute in the current process
+    :param chunk_size: {int} (id, text) pairs sent to a worker at a time
+    :param max_pending: {int} chunks submitted but not yielded yet,
+        defaults to 2 * processes, bounds the memory
+    :param f: {int} the dimensions of fingerprints
+    :param featurizer: passed to Simhash, must be picklable,
+        e.g. make_ngram_featurizer(n=2), None to use jieba and tf_idf
+    :return: yield lists of (id, int simhash value), in the input order
+    """
+    if processes == 1:
+        for chunk in chunked(items, chunk_size):
+            yield fingerprint_chunk(chunk, f, featurizer)
+        return
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+    with ProcessPoolExecutor(processes, initializer=init_worker,
+                             initargs=(featurizer,)) as executor:
+        pending = collections.deque()
+        for chunk in chunked(items, chunk_size):
+            pending.append(executor.submit(fingerprint_chunk, chunk, f,
+                                           featurizer))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def index_stream(index, items, processes=None, chunk_size=1000,
+                 max_pending=None, featurizer=None):
+    """fingerprint (id, text) pairs in a process pool and add them to the
+    index chunk by chunk
+
+    :param index: {SimhashIndex} or any index with add_many
+    :param items: an iterable of (id, text), e.g. read_jsonl(path)
+    :param featurizer: passed to Simhash, see fingerprint_stream
+    :return: {int} the number of added items
+    """
+    count = 0
+    for chunk in fingerprint_stream(items, processes, chunk_size,
+                                    max_pending, index.f, featurizer):
+        index.add_many((obj_id, Simhash(value, index.f))
+                       for obj_id, value in chunk)
+        count += len(chunk)
+        index.log.info('%s added.', count)
+    return count
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+在redis服务端计算hamming距离的索引。
+使用RedisStorage时，每次查询都要把k+1个bucket的全部内容（大桶有2000~3000+个hex字符串）
+传回客户端，而其中绝大部分都会被过滤掉。
+这里用一个lua脚本在服务端合并k+1个bucket、计算距离，只返回距离不超过k的simhash及其id，
+get_near_dups2的查询和插入也在同一个脚本中完成，是原子的，并发写入时不会重复插入。
+"""
+from .sim_hash import Simhash, SimhashIndex, F, K
+from .storage import RedisStorage, RedisMapStorage
+
+# 按16进制逐位比较，用查表代替位运算，不依赖redis的bit库
+# KEYS: 查询的key..., 插入的key..., hash2id的key, 所有bucket key的集合
+# ARGV: 查询的hex(补齐到f/4位), k, 查询key的数量, 插入key的数量,
+#       要插入的member, 当前id, 过期时间, 是否返回id, 是否只返回第一个
+NEAR_DUPS_SCRIPT = """
+local pop = {}
+for a = 0, 15 do
+    for b = 0, 15 do
+        local x, y, c = a, b, 0
+        for _ = 1, 4 do
+            if x % 2 ~= y % 2 then c = c + 1 end
+            x = math.floor(x / 2)
+            y = math.floor(y / 2)
+        end
+        pop[a * 16 + b] = c
+    end
+end
+
+local function digit(byte)
+    if byte >= 97 then return byte - 87 end
+    if byte >= 65 then return byte - 55 end
+    return byte - 48
+end
+
+local query = ARGV[1]
+local width = #query
+local q = {}
+for i = 1, width do q[i] = digit(string.byte(query, i)) * 16 end
+local k = tonumber(ARGV[2])
+local n_query = tonumber(ARGV[3])
+local n_add = tonumber(ARGV[4])
+local hash2id = KEYS[n_query + n_add + 1]
+local with_id = ARGV[8] == '1'
+local first_only = ARGV[9] == '1'
+
+local result = {}
+local seen = {}
+local exact = false
+for i = 1, n_query do
+    local members = redis.call('SMEMBERS', KEYS[i])
+    for _, member in ipairs(members) do
+        if not seen[member] then
+            seen[member] = true
+            local offset = width - #member
+            local d = 0
+            for j = 1, offset do d = d + pop[q[j]] end
+            for j = offset + 1, width do
+                d = d + pop[q[j] + digit(string.byte(member, j - offset))]
+                if d > k then break end
+            end
+            if d <= k then
+                if d == 0 then exact = true end
+                result[#result + 1] = member
+                result[#result + 1] = d
+                if with_id then
+                    result[#result + 1] = redis.call('HGET', hash2id, member)
+                else
+                    result[#result + 1] = false
+                end
+                if first_only then return result end
+            end
+        end
+    end
+end
+
+if n_add > 0 and not exact then
+    local member = ARGV[5]
+    local expire = tonumber(ARGV[7])
+    for i = n_query + 1, n_query + n_add do
+        redis.call('SADD', KEYS[i], member)
+        redis.call('EXPIRE', KEYS[i], expire)
+        redis.call('SADD', KEYS[n_query + n_add + 2], KEYS[i])
+    end
+    if with_id then redis.call('HSET', hash2id, member, ARGV[6]) end
+end
+return result
+"""
+
+
+class RedisSimhashIndex(SimhashIndex):
+
+    def __init__(self, objs=None, storage: RedisStorage = None,
+                 map_storage: RedisMapStorage = None, key_pre='',
+                 f=F, k=K, log=None, key_func=None, with_id=True,
+                 query_key_func=None):
+        """SimhashIndex on RedisStorage that filters the buckets on the
+        redis server with a lua script, only the matches and their ids
+        are sent back.
+
+        :param storage: {RedisStorage} the buckets
+        :param map_storage: {RedisMapStorage} the simhash -> obj_id map,
+            on the same redis as storage
+        other params are the same with SimhashIndex
+        """
+        if not isinstance(storage, RedisStorage):
+            raise ValueError('RedisSimhashIndex needs a RedisStorage')
+        if with_id and not isinstance(map_storage, RedisMapStorage):
+            raise ValueError('RedisSimhashIndex needs a RedisMapStorage '
+                             'when with_id is set')
+        super().__init__(objs, storage=storage, map_storage=map_storage,
+                         key_pre=key_pre, f=f, k=k, log=log,
+                         key_func=key_func, with_id=with_id,
+                         query_key_func=query_key_func)
+        self.script = storage.r.register_script(NEAR_DUPS_SCRIPT)
+
+    def run_script(self, simhash, cur_id=None, first_only=False):
+        """run the lua script, add simhash unless an exact duplication
+        found if cur_id is given
+
+        :return: a list of (hex simhash, distance, obj_id) tuples
+        """
+        assert simhash.f == self.f
+
+        v = simhash.value & self.mask
+        query_keys = list(self.get_query_keys(simhash))
+        add_keys = [] if cur_id is None else list(self.get_keys(simhash))
+        hash2id_key = self.hash2id.redis_key if self.with_id else ''
+        keys = query_keys + add_keys + [hash2id_key, self.storage.keys_key]
+        args = ['%0*x' % ((self.f + 3) // 4, v), self.k,
+                len(query_keys), len(add_keys), self.storage.encode(v),
+                '' if cur_id is None else cur_id, self.storage.expire,
+                int(self.with_id), int(first_only)]
+        ans = self.script(keys=keys, args=args)
+        return [(ans[i].decode(), ans[i + 1], ans[i + 2])
+                for i in range(0, len(ans), 3)]
+
+    def get_one_near_dup(self, simhash):
+        """the same as SimhashIndex.get_one_near_dup, computed on the server
+        """
+        for dup_hex, d, obj_id in self.run_script(simhash, first_only=True):
+            if self.with_id:
+                return int(obj_id), d
+            return Simhash(self.storage.decode(dup_hex), self.f), d
+        return None, None
+
+    def get_near_dups(self, simhash):
+        """the same as SimhashIndex.get_near_dups, computed on the server"""
+        return [(int(obj_id), d) if self.with_id else (dup_hex, d)
+                for dup_hex, d, obj_id in self.run_script(simhash)]
+
+    def get_near_dups2(self, simhash, cur_id):
+        """the same as SimhashIndex.get_near_dups2, the query and the
+        insertion are done atomically in one lua script"""
+        return [(int(obj_id), d) if self.with_id else (dup_hex, d)
+                for dup_hex, d, obj_id in self.run_script(simhash, cur_id)]
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+词典等静态资源的路径和缓存。
+文本格式的词典每次都要逐行解析，这里解析一次之后用marshal序列化存到缓存目录，
+之后的进程直接加载缓存，源文件的修改时间或大小变化时自动重新生成。
+"""
+import hashlib
+import logging
+import marshal
+import os
+import stat
+
+BASE_DIR = os.path.split(os.path.realpath(__file__))[0]
+STATIC_DIR = os.path.join(BASE_DIR, '../static')
+# 缓存目录，可通过环境变量SIMHASH_CACHE_DIR修改，默认为当前用户的~/.cache/simhash。
+# 不放在共享的临时目录下：缓存由marshal和mmap直接加载，其他用户可写的文件不可信
+CACHE_DIR = os.environ.get('SIMHASH_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'simhash'))
+
+log = logging.getLogger("simhash")
+
+
+def static_path(name):
+    """static目录下的文件路径，与当前工作目录无关"""
+    return os.path.join(STATIC_DIR, name)
+
+
+def make_cache_dir(directory=None):
+    """create the cache directory, CACHE_DIR by default, accessible by the
+    current user only"""
+    os.makedirs(directory or CACHE_DIR, mode=0o700, exist_ok=True)
+
+
+def is_trusted(path):
+    """whether the cache file and its directory are owned by the current
+    user and not writable by others, only trusted files are loaded"""
+    if not hasattr(os, 'getuid'):  # windows没有uid，依赖目录本身的权限
+        return os.path.isfile(path)
+    uid = os.getuid()
+    try:
+        for p in (path, os.path.dirname(path)):
+            st = os.stat(p)
+            if st.st_uid != uid or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return False
+    except OSError:
+        return False
+    return True
+
+
+def cache_path(path, name, suffix='.marshal'):
+    """the cache file of the source file `path` under CACHE_DIR"""
+    digest = hashlib.md5(os.path.realpath(path).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f'{name}.{digest[:16]}{suffix}')
+
+
+def load_cached(path, loader, name=None):
+    """调用loader(path)解析path，结果用marshal缓存下来，下次直接读取缓存
+
+    :param path: {str} the source file
+    :param loader: function that parses the source file, the result must be
+        supported by marshal (dict, set, str, float, ...)
+    :param name: {str} name of the cache file, defaults to loader.__name__
+    :return: the result of loader(path)
+    """
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cache = cache_path(path, name or loader.__name__)
+    if is_trusted(cache):
+        try:
+            with open(cache, 'rb') as f:
+                cached_version, data = marshal.load(f)
+            if tuple(cached_version) == version:
+                return data
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    else:
+        log.debug('Ignore the untrusted cache %s', cache)
+
+    data = loader(path)
+    try:
+        make_cache_dir()
+        tmp = f'{cache}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            marshal.dump((version, data), f)
+        os.replace(tmp, cache)
+    except OSError as e:
+        log.debug('Fail in writing cache %s: %s', cache, e)
+    return data
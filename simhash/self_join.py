@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+一次找出整个语料中所有的近似重复对，以及由它们连成的簇。
+对每篇文档调用get_near_dups去查同一个语料的索引，每一对都会被找到两次，
+每次查询还要构造结果列表。这里沿用permuted_index的做法：把f位拆成B块，
+每张表按其中B-k块排序，前缀相同的一段内两两比较，每一对只比较一次。
+距离不超过k的一对至少有B-k块相同，会出现在多张表中，
+只在由它最靠前的B-k个相同块组成的那张表里输出，不需要全局的去重集合。
+相同的值先合并为一个，只连接不同的值，相同的值之间的对直接输出。
+整个过程都是numpy的向量运算，结果按批流式输出，也可以直接用并查集合并为簇。
+"""
+import itertools
+import math
+
+import numpy as np
+
+from .permuted_index import PermutedTable, split_blocks
+from .scan_index import ArraySimhashIndex
+from .sim_hash import SimhashIndex, F, K, popcount
+
+
+def fingerprints(source):
+    """the simhash values of an index or an array, and their obj_ids
+
+    :param source: SimhashIndex, ArraySimhashIndex (including the mmap one)
+        or a sequence of int simhash values
+    :return: (uint64 array, list of obj_ids or None for an array)
+    """
+    if isinstance(source, SimhashIndex):
+        values, ids = [], []
+        for value, obj_id in source.items():
+            values.append(value)
+            ids.append(obj_id)
+        return np.array(values, dtype=np.uint64), ids
+    if isinstance(source, ArraySimhashIndex):
+        values = source.values[:source.size]
+        alive = getattr(source, 'alive', None)
+        ids = source.ids if source.with_id else None
+        if alive is not None:
+            rows = np.flatnonzero(alive[:source.size])
+            values = values[rows]
+            ids = [source.ids[i] for i in rows.tolist()]
+        elif ids is not None:
+            ids = ids.tolist()
+        return values, ids
+    return np.asarray(source, dtype=np.uint64), None
+
+
+def lead_masks(x, blocks, n_lead):
+    """bitmask of the first n_lead blocks in which the pairs agree
+
+    :param x: {np.ndarray} xor of the pairs
+    :param blocks: {list} (start, bits) of every block
+    """
+    masks = np.zeros(len(x), dtype=np.uint64)
+    count = np.zeros(len(x), dtype=np.int64)
+    for b, (start, bits) in enumerate(blocks):
+        piece = (x >> np.uint64(start)) & np.uint64((1 << bits) - 1)
+        take = (piece == 0) & (count < n_lead)
+        masks |= take.astype(np.uint64) << np.uint64(b)
+        count += take
+    return masks
+
+
+def plan_join(f=F, k=K, n=1 << 20, max_tables=64, pair_cost=8):
+    """choose the number of blocks B for a self-join of n simhashes
+
+    Every table sorts the n rows and compares about n^2 / 2^(p+1) candidate
+    pairs, p is the prefix bits. Unlike plan_tables a candidate costs far
+    more than a step of the sort, weighted by `pair_cost`.
+
+    :return: {int} the number of blocks B
+    """
+    n = max(n, 2)
+    best, best_cost = k + 1, None
+    for n_blocks in range(k + 1, f + 1):
+        n_tables = math.comb(n_blocks, k)
+        if n_tables > max_tables and n_blocks > k + 1:
+            break
+        blocks = split_blocks(f, n_blocks)
+        prefix = sum(sorted(bits for _, bits in blocks)[:n_blocks - k])
+        cost = n_tables * (math.log2(n) + pair_cost * n / 2 ** (prefix + 1))
+        if best_cost is None or cost < best_cost:
+            best, best_cost = n_blocks, cost
+    return best
+
+
+def distinct_pairs(values, f=F, k=K, n_blocks=None, max_tables=64):
+    """every pair of rows within distance k, each pair exactly once.
+    A prefix group of g rows costs g - 1 numpy passes, the values should be
+    distinct, otherwise a group of equal values is quadratic
+
+    :param values: {np.ndarray} distinct uint64 simhash values of f bits
+    :return: generator of (rows_a, rows_b, distances), rows_a < rows_b
+    """
+    n = len(values)
+    if n < 2:
+        return
+    if n_blocks is None:
+        n_blocks = plan_join(f, k, n, max_tables)
+    blocks = split_blocks(f, n_blocks)
+    n_lead = n_blocks - k
+    for lead in itertools.combinations(range(n_blocks), n_lead):
+        table = PermutedTable(blocks, lead, f)
+        table.build(values)
+        prefix = table.keys >> np.uint64(table.shift)
+        order = table.order
+        ordered = values[order]
+        table_mask = np.uint64(sum(1 << b for b in lead))
+        # 排序后前缀相同的行是连续的，active为与后面第d行前缀相同的行
+        active = np.flatnonzero(prefix[1:] == prefix[:-1])
+        d = 1
+        while len(active):
+            x = ordered[active] ^ ordered[active + d]
+            dist = popcount(x)
+            hit = np.flatnonzero(dist <= k)
+            if len(hit):
+                rows = active[hit]
+                a, b = order[rows], order[rows + d]
+                x, dist = x[hit], dist[hit]
+                keep = lead_masks(x, blocks, n_lead) == table_mask
+                if keep.any():
+                    a, b = a[keep], b[keep]
+                    yield np.minimum(a, b), np.maximum(a, b), dist[keep]
+            d += 1
+            active = active[active + d < n]
+            active = active[prefix[active + d] == prefix[active]]
+
+
+def equal_pairs(order, starts, counts):
+    """every pair of rows in the groups of equal values, at distance 0
+
+    :param order: {np.ndarray} the rows sorted by group
+    :param starts: {np.ndarray} the start of every group in order
+    :param counts: {np.ndarray} the size of every group
+    :return: generator of (rows_a, rows_b, distances)
+    """
+    # 同样大小的组一起处理，组的大小种类很少
+    for size in np.unique(counts[counts > 1]).tolist():
+        i, j = np.triu_indices(size, 1)
+        group_starts = starts[counts == size][:, None]
+        a, b = order[group_starts + i].ravel(), order[group_starts + j].ravel()
+        yield np.minimum(a, b), np.maximum(a, b), np.zeros(len(a), np.int64)
+
+
+def expand_pairs(ua, ub, dist, order, starts, counts):
+    """the pairs of rows of the pairs of groups (ua[i], ub[i])"""
+    ca, cb = counts[ua], counts[ub]
+    sizes = ca * cb
+    pair = np.repeat(np.arange(len(ua)), sizes)
+    offset = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes,
+                                                 sizes)
+    a = order[starts[ua][pair] + offset // cb[pair]]
+    b = order[starts[ub][pair] + offset % cb[pair]]
+    return np.minimum(a, b), np.maximum(a, b), dist[pair]
+
+
+def near_dup_pairs(values, f=F, k=K, n_blocks=None, max_tables=64):
+    """every pair of rows within distance k, each pair exactly once
+
+    The equal values are collapsed first, the distinct values are joined
+    and the pairs of rows are expanded from the pairs of distinct values,
+    the pairs among equal values are generated directly.
+
+    :param values: {np.ndarray} uint64 simhash values
+    :param n_blocks: {int} the number of blocks B, None to choose by
+        plan_join, more blocks, longer prefixes and fewer candidates but
+        C(B, k) sorts of the whole array
+    :param max_tables: {int} upper limit of the table count for plan_join
+    :return: generator of (rows_a, rows_b, distances) numpy arrays,
+        rows_a < rows_b
+    """
+    values = np.asarray(values, dtype=np.uint64) & np.uint64((1 << f) - 1)
+    if len(values) < 2:
+        return
+    uniq, inverse, counts = np.unique(values, return_inverse=True,
+                                      return_counts=True)
+    if len(uniq) == len(values):
+        yield from distinct_pairs(values, f, k, n_blocks, max_tables)
+        return
+    order = np.argsort(inverse.ravel(), kind='stable')
+    starts = np.cumsum(counts) - counts
+    yield from equal_pairs(order, starts, counts)
+    for ua, ub, dist in distinct_pairs(uniq, f, k, n_blocks, max_tables):
+        yield expand_pairs(ua, ub, dist, order, starts, counts)
+
+
+def find_all_near_dup_pairs(source, f=None, k=None, n_blocks=None,
+                            max_tables=64):
+    """all the near duplicate pairs of a corpus in one pass
+
+    :param source: SimhashIndex, ArraySimhashIndex or a sequence of int
+        simhash values, f and k default to the ones of an index
+    :return: generator of (a, b, distance), a and b are the obj_ids for an
+        index, the positions for an array, every pair is generated once
+    """
+    f = getattr(source, 'f', F) if f is None else f
+    k = getattr(source, 'k', K) if k is None else k
+    values, ids = fingerprints(source)
+    for rows_a, rows_b, dist in near_dup_pairs(values, f, k, n_blocks,
+                                               max_tables):
+        for a, b, d in zip(rows_a.tolist(), rows_b.tolist(), dist.tolist()):
+            if ids is None:
+                yield a, b, d
+            else:
+                yield ids[a], ids[b], d
+
+
+def find_roots(parent, x):
+    """roots of the rows x, the rows are pointed to their roots directly"""
+    r = parent[x]
+    while True:
+        p = parent[r]
+        if np.array_equal(p, r):
+            parent[x] = r
+            return r
+        r = p
+
+
+def union(parent, a, b):
+    """merge the sets of every pair (a[i], b[i]), the root of a set is its
+    smallest row"""
+    while len(a):
+        a = find_roots(parent, a)
+        b = find_roots(parent, b)
+        diff = a != b
+        a, b = a[diff], b[diff]
+        # 同一个根可能被合并到多个根上，只保留最小的，其余的下一轮再合并
+        np.minimum.at(parent, np.maximum(a, b), np.minimum(a, b))
+
+
+def cluster(source, f=None, k=None, n_blocks=None, max_tables=64):
+    """group the corpus into clusters of near duplicates, two simhashes are
+    in the same cluster if they are linked by a chain of pairs within
+    distance k
+
+    :param source: the same with find_all_near_dup_pairs
+    :return: for an array, {np.ndarray} the label of every position, the
+        smallest position of its cluster; for an index, {dict} obj_id ->
+        the obj_id of the first simhash of its cluster
+    """
+    f = getattr(source, 'f', F) if f is None else f
+    k = getattr(source, 'k', K) if k is None else k
+    values, ids = fingerprints(source)
+    values = np.asarray(values, dtype=np.uint64) & np.uint64((1 << f) - 1)
+    # 相同的值一定在同一个簇，只合并不同的值，再通过inverse映射回每个位置
+    uniq, first, inverse = np.unique(values, return_index=True,
+                                     return_inverse=True)
+    inverse = inverse.ravel()
+    parent = np.arange(len(uniq), dtype=np.int64)
+    for rows_a, rows_b, _ in distinct_pairs(uniq, f, k, n_blocks,
+                                            max_tables):
+        union(parent, rows_a, rows_b)
+    while True:
+        p = parent[parent]
+        if np.array_equal(p, parent):
+            break
+        parent = p
+    # 簇的标签为簇中最小的位置
+    smallest = np.full(len(uniq), len(values), dtype=np.int64)
+    np.minimum.at(smallest, parent, first)
+    parent = smallest[parent][inverse]
+    if ids is None:
+        return parent
+    return {obj_id: ids[root] for obj_id, root in zip(ids, parent.tolist())}
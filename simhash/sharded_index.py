@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+把simhash分散到N个分片的索引。
+单个SimhashIndex受限于一个进程的内存和一个核的计算速度。这里按simhash的值
+用jump consistent hash(Lamping & Veach 2014)选择分片，每个simhash只存在一个分片中，
+完全相同的simhash一定落在同一个分片。查询并行地发给所有分片，再合并结果。
+分片可以是同一进程中的SimhashIndex、worker进程中的SimhashIndex(start_process_shards)，
+或者同一个redis上使用不同key_pre的RedisSimhashIndex(redis_shards)。
+分片数从n变为m时，jump hash只移动约|m-n|/max(m, n)的simhash，reshard只搬运这些。
+"""
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+from .redis_index import RedisSimhashIndex
+from .sim_hash import Simhash, SimhashIndex, add_batch_dups, F, K
+from .storage import RedisStorage, RedisMapStorage
+
+MASK64 = (1 << 64) - 1
+
+
+def jump_hash(key, n_buckets):
+    """jump consistent hash, maps an int key to [0, n_buckets),
+    only 1/(n+1) of the keys move when a bucket is added"""
+    key &= MASK64
+    b, j = -1, 0
+    while j < n_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & MASK64
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+class ShardedSimhashIndex(object):
+
+    def __init__(self, shards, objs=None, f=F, k=K, with_id=True,
+                 workers=None):
+        """split the simhashes across shards, every query is sent to all
+        the shards in parallel and their results are merged.
+
+        Only the exact duplication check of get_near_dups2 is atomic (it is
+        done by the shard owning the simhash), two near duplications added
+        to different shards at the same time may not find each other.
+
+        :param shards: {list} the shards, SimhashIndex or anything with its
+            methods, e.g. the proxies of start_process_shards, all with the
+            same f, k and with_id
+        :param objs: an iterable of (obj_id, simhash), added by `build`
+        :param workers: {int} threads sending the queries, defaults to the
+            number of shards, 1 to query the shards one by one
+        """
+        self.f = f
+        self.k = k
+        self.mask = (1 << f) - 1
+        self.with_id = with_id
+        self.shards = list(shards)
+        self.workers = workers
+        self.executor = None
+        if workers != 1 and len(self.shards) > 1:
+            self.executor = ThreadPoolExecutor(workers or len(self.shards))
+        if objs is not None:
+            self.build(objs)
+
+    def shard_id(self, simhash):
+        return jump_hash(simhash.value & self.mask, len(self.shards))
+
+    def shard_of(self, simhash):
+        return self.shards[self.shard_id(simhash)]
+
+    def fan_out(self, calls):
+        """run the (function, args) calls in parallel, in order"""
+        if self.executor is None:
+            return [func(*args) for func, args in calls]
+        futures = [self.executor.submit(func, *args) for func, args in calls]
+        return [future.result() for future in futures]
+
+    def group(self, objs):
+        """split (obj_id, simhash) pairs by their shards
+
+        :return: a list of [(obj_id, simhash), ...] per shard
+        """
+        groups = [[] for _ in self.shards]
+        for obj in objs:
+            groups[self.shard_id(obj[1])].append(obj)
+        return groups
+
+    def get_one_near_dup(self, simhash):
+        """the nearest of the ones found by every shard"""
+        found = [(d, dup) for dup, d in self.fan_out(
+            (shard.get_one_near_dup, (simhash,)) for shard in self.shards)
+            if d is not None]
+        if not found:
+            return None, None
+        d, dup = min(found, key=lambda x: x[0])
+        return dup, d
+
+    def get_near_dups(self, simhash):
+        return list(itertools.chain.from_iterable(self.fan_out(
+            (shard.get_near_dups, (simhash,)) for shard in self.shards)))
+
+    def get_near_dups2(self, simhash, cur_id):
+        """the shard owning the simhash runs get_near_dups2, the others
+        get_near_dups"""
+        owner = self.shard_of(simhash)
+        return list(itertools.chain.from_iterable(self.fan_out(
+            (shard.get_near_dups2, (simhash, cur_id)) if shard is owner else
+            (shard.get_near_dups, (simhash,)) for shard in self.shards)))
+
+    def get_near_dups_many(self, simhashes):
+        simhashes = list(simhashes)
+        results = self.fan_out((shard.get_near_dups_many, (simhashes,))
+                               for shard in self.shards)
+        return [list(itertools.chain.from_iterable(dups))
+                for dups in zip(*results)] if results else []
+
+    def get_near_dups2_many(self, simhashes, cur_ids):
+        """the same as calling get_near_dups2 for every simhash in order,
+        see SimhashIndex.get_near_dups2_many"""
+        simhashes = list(simhashes)
+        cur_ids = list(cur_ids)
+        results = self.get_near_dups_many(simhashes)
+        added = add_batch_dups(
+            results, simhashes, cur_ids,
+            [any(d == 0 for _, d in dups) for dups in results],
+            self.k, self.f, self.with_id)
+        self.add_many((cur_ids[i], simhashes[i]) for i in added)
+        return results
+
+    def add(self, obj_id, simhash):
+        self.shard_of(simhash).add(obj_id, simhash)
+
+    def add_many(self, objs):
+        """add the (obj_id, simhash) pairs, every shard adds its own part
+        in parallel"""
+        groups = self.group(objs)
+        self.fan_out((shard.add_many, (group,))
+                     for shard, group in zip(self.shards, groups) if group)
+
+    def build(self, objs, batch_size=100000):
+        """bulk add an iterable of (obj_id, simhash), batch_size of them at
+        a time
+
+        :return: {int} the number of simhashes added
+        """
+        objs = ((obj_id, Simhash(simhash, self.f) if type(simhash) is int
+                 else simhash) for obj_id, simhash in objs)
+        count = 0
+        while True:
+            batch = list(itertools.islice(objs, batch_size))
+            if not batch:
+                return count
+            self.add_many(batch)
+            count += len(batch)
+
+    def remove(self, simhash):
+        self.shard_of(simhash).remove(simhash)
+
+    def items(self):
+        """iterate over the (int simhash, obj_id) pairs of all the shards"""
+        for shard in self.shards:
+            yield from shard.items()
+
+    def reshard(self, shards):
+        """move the simhashes to a new list of shards, e.g. the current
+        shards plus a new one. With jump hash only the simhashes whose
+        shard changes are moved, adding a shard to n moves about 1/(n+1)
+        of them. needs with_id
+
+        :param shards: {list} the new shards, the shards kept from the
+            current list should stay at the same positions
+        :return: {int} the number of moved simhashes
+        """
+        n = len(shards)
+        moved = 0
+        for shard in self.shards:
+            groups = [[] for _ in shards]
+            for value, obj_id in list(shard.items()):
+                i = jump_hash(value, n)
+                if shards[i] is not shard:
+                    groups[i].append((obj_id, Simhash(value, self.f)))
+            # 先写入新分片再从原分片删除，写入失败时不会丢数据
+            for target, group in zip(shards, groups):
+                if group:
+                    target.add_many(group)
+                    for _, simhash in group:
+                        shard.remove(simhash)
+                    moved += len(group)
+        self.shards = list(shards)
+        self.close()
+        if self.workers != 1 and n > 1:
+            self.executor = ThreadPoolExecutor(self.workers or n)
+        return moved
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class RemoteShard(SimhashIndex):
+    """SimhashIndex in a worker process, items() returns a list which can
+    be sent back"""
+
+    def items(self):
+        return list(super().items())
+
+
+class ShardManager(BaseManager):
+    pass
+
+
+ShardManager.register('RemoteShard', RemoteShard, exposed=(
+    'get_one_near_dup', 'get_near_dups', 'get_near_dups2',
+    'get_near_dups_many', 'get_near_dups2_many', 'add', 'add_many',
+    'build', 'remove', 'items'))
+
+
+def start_process_shards(n_shards, **kwargs):
+    """start a worker process for every shard, so that the shards search
+    on all the cores. The simhashes are sent to the workers as (value, f).
+
+    :param n_shards: {int} the number of worker processes
+    :param kwargs: the params of SimhashIndex for every shard
+    :return: (managers, shards), call manager.shutdown() of every manager
+        to stop the workers
+    """
+    managers, shards = [], []
+    for _ in range(n_shards):
+        manager = ShardManager()
+        manager.start()
+        managers.append(manager)
+        shards.append(manager.RemoteShard(**kwargs))
+    return managers, shards
+
+
+def redis_shards(r, n_shards, key_pre='', **kwargs):
+    """RedisSimhashIndex shards on one redis, told apart by key_pre
+
+    :param r: {redis.client.Redis}
+    :param key_pre: {str} shard i uses the prefix f'{key_pre}{i}:' for its
+        buckets, its hash2id map and its set of bucket keys
+    :param kwargs: other params of RedisSimhashIndex
+    :return: {list} the shards
+    """
+    shards = []
+    for i in range(n_shards):
+        pre = f'{key_pre}{i}:'
+        shards.append(RedisSimhashIndex(
+            storage=RedisStorage(r, keys_key=f'{pre}bucket_keys'),
+            map_storage=RedisMapStorage(r, f'{pre}hash2id'),
+            key_pre=pre, **kwargs))
+    return shards
@@ -6,16 +6,36 @@ Created on 2020-03-03
 @author: Chant
 """
 import collections
+import collections.abc
+import contextlib
+import functools
+import gc
 import hashlib
+import itertools
 import logging
 import numbers
+import os
+import threading
 
-from .key_funcs import get_keys0
+from .hash_funcs import cached, md5_hash
+from .key_funcs import get_keys0, get_int_keys
+from .resources import cache_path, static_path, load_cached
 from .tokenizer import tokenize
-from .storage import Storage, MemoryStorage, RedisStorage, MemoryMapStorage
+from .storage import (Storage, MemoryStorage, RedisStorage, MemoryMapStorage,
+                      RedisMapStorage, AsyncOnlyStorage, get_numpy)
 
 F = 64  # `f` is the dimensions of fingerprints
 K = 7  # `k` is the tolerance
+# query x member pairs of a bucket above which the distances are computed
+# with numpy in the batched queries
+MATCH_NUMPY_THRESHOLD = 64
+
+
+def __getattr__(name):
+    # 兼容之前的模块变量np，访问时才导入numpy
+    if name == 'np':
+        return get_numpy()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def write_idf_dic(d, path):
@@ -38,16 +58,268 @@ def load_idf_dic(path):
         return dict()
 
 
-JIEBA_IDF_DIC = load_idf_dic('static/idf.txt.big')
+class LazyIdfDic(object):
+
+    def __init__(self, path):
+        """a read-only token -> idf dict loaded on first use.
+        With numpy it is an IdfStore compiled into the cache dir and shared
+        by all the processes through mmap, otherwise a dict cached by
+        `load_cached`.
+
+        :param path: {str} the idf text file, one `word idf` per line
+        """
+        self.path = path
+        self._dic = None
+
+    @property
+    def dic(self):
+        if self._dic is None:
+            self._dic = self.load()
+            # 之后的get直接调用dict.get，省掉一层函数调用
+            self.get = self._dic.get
+        return self._dic
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return load_idf_dic(self.path)
+        if get_numpy() is not None:
+            from .idf_store import open_idf_store
+            try:
+                return open_idf_store(
+                    self.path, cache_path(self.path, 'idf_store', '.bin'))
+            except OSError as e:
+                logging.getLogger("simhash").warning(
+                    'Fail in compiling the idf store: %s', e)
+        return load_cached(self.path, load_idf_dic)
+
+    def get(self, word, default=None):
+        return self.dic.get(word, default)
+
+    def get_many(self, words, default=None):
+        """the idf of several words, bulk looked up by the IdfStore"""
+        dic = self.dic
+        if hasattr(dic, 'get_many'):
+            return dic.get_many(words, default)
+        return [dic.get(word, default) for word in words]
+
+    def __getitem__(self, word):
+        return self.dic[word]
+
+    def __contains__(self, word):
+        return word in self.dic
+
+    def __len__(self):
+        return len(self.dic)
+
+    def __iter__(self):
+        return iter(self.dic)
+
+    def items(self):
+        return self.dic.items()
+
+
+# 与当前工作目录无关，第一次计算tf_idf时才加载
+JIEBA_IDF_DIC = LazyIdfDic(static_path('idf.txt.big'))
+
+
+# md5 with a token -> hash LRU cache shared by all Simhash instances,
+# `hash_func.cache_info()` reports the hits and misses
+hash_func = cached(md5_hash)
+
+
+def accumulate_py(hashes, weights, f=F):
+    """sum up +w/-w for every bit of every token hash and keep the bits
+    whose sum is positive, one bit at a time.
+
+    :param hashes: {list} token hashes, only the lowest `f` bits are used
+    :param weights: {list} token weights, same length as `hashes`
+    :param f: {int} the dimensions of fingerprints
+    :return: {int} the simhash value
+    """
+    v = [0] * f
+    masks = [1 << i for i in range(f)]
+    for h, w in zip(hashes, weights):
+        for i in range(f):
+            v[i] += w if h & masks[i] else -w
+    ans = 0
+    for i in range(f):
+        if v[i] > 0:
+            ans |= masks[i]
+    return ans
+
+
+def accumulate_np(hashes, weights, f=F):
+    """the same as `accumulate_py`, but unpacks the hashes into a
+    (n_tokens, f) bit matrix and reduces the +w/-w matrix with numpy.
+
+    The rows are accumulated in order (add.accumulate rather than the
+    pairwise summation of sum), so float weights round exactly the same
+    way as in the python loop and the result is bit-identical.
+
+    :return: {int} the simhash value, or None if the weights can not be
+        summed exactly by numpy (e.g. python ints beyond int64), in which
+        case the caller should fall back to `accumulate_py`
+    """
+    np = get_numpy()
+    n = len(hashes)
+    w = np.asarray(weights)
+    if w.ndim != 1 or w.dtype.kind not in 'iuf':
+        return None
+    if w.dtype.kind in 'iu':
+        # python ints never overflow, make sure int64 does not either
+        if n and max(-int(w.min()), int(w.max())) * n >= 2 ** 63:
+            return None
+        w = w.astype(np.int64)
+
+    mask = (1 << f) - 1
+    n_bytes = (f + 7) // 8
+    buf = b''.join((h & mask).to_bytes(n_bytes, 'little') for h in hashes)
+    bits = np.unpackbits(np.frombuffer(buf, dtype=np.uint8).reshape(n, n_bytes),
+                         axis=1, bitorder='little')[:, :f]
+    contrib = np.where(bits, w[:, None], -w[:, None])
+    v = np.add.accumulate(contrib, axis=0, out=contrib)[-1]
+    packed = np.packbits(v > 0, bitorder='little')
+    return int.from_bytes(packed.tobytes(), 'little')
+
+
+@functools.lru_cache(maxsize=None)
+def popcount_table():
+    np = get_numpy()
+    return np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(x):
+    """count the set bits of every element of an uint64 array, needs numpy"""
+    np = get_numpy()
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(x)
+    return popcount_table()[x.view(np.uint8)].reshape(x.shape + (8,)).sum(
+        axis=-1, dtype=np.uint8)
+
+
+def accumulate(hashes, weights, f=F):
+    """compute the simhash value from token hashes and weights,
+    vectorized with numpy when it is installed."""
+    if not hashes:
+        return 0
+    if get_numpy() is not None:
+        ans = accumulate_np(hashes, weights, f)
+        if ans is not None:
+            return ans
+    return accumulate_py(hashes, weights, f)
+
+
+def group_int_keys(values, f=F, k=K):
+    """the same keys as get_int_keys for many int values at once, the
+    values are sorted by every piece with numpy and split into buckets.
+
+    :param values: {list} int simhash values, at most 64 bits
+    :return: a {int key: [value, ...]} dict
+    """
+    np = get_numpy()
+    vs = np.array(values, dtype=np.uint64)
+    offsets = [f // (k + 1) * i for i in range(k + 1)] + [f]
+    buckets = dict()
+    for i in range(k + 1):
+        m = (1 << (offsets[i + 1] - offsets[i])) - 1
+        pieces = (vs >> np.uint64(offsets[i])) & np.uint64(m)
+        order = np.argsort(pieces, kind='stable')
+        keys, starts = np.unique(pieces[order], return_index=True)
+        for piece, members in zip(keys.tolist(),
+                                  np.split(vs[order], starts[1:])):
+            buckets[i << f | piece] = members.tolist()
+    return buckets
+
+
+if hasattr(int, 'bit_count'):  # python >= 3.10
+    bit_count = int.bit_count
+else:
+    def bit_count(x):
+        return bin(x).count('1')
+
+
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class FeatureCache(object):
+
+    def __init__(self, maxsize=4096, max_namespaces=16):
+        """a bounded LRU cache of text digest -> (word, weight) features.
+        相同的文本（转发、模板回复）重复出现时，直接使用缓存的特征，不再分词和计算tf_idf。
+        只保存文本的摘要，不保存文本本身。
+
+        :param maxsize: {int} the number of texts kept, a long text takes
+            tens of KB
+        :param max_namespaces: {int} the number of idf dicts kept, the
+            features of the least recently used one are dropped with it
+        """
+        self.maxsize = maxsize
+        self.max_namespaces = max_namespaces
+        self.cache = collections.OrderedDict()
+        # id -> the idf dicts used in the keys, LRU.
+        # 持有引用使得id不会被回收后重用，淘汰时一起删除它的特征
+        self.objects = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def namespace(self, obj):
+        """the id of obj for the keys, obj is kept alive by the cache so
+        that a new object never gets the same id while the keys exist.
+        For the objects that can't be hashed, e.g. the idf dicts"""
+        key = id(obj)
+        with self.lock:
+            if key in self.objects:
+                self.objects.move_to_end(key)
+                return key
+            self.objects[key] = obj
+            if len(self.objects) > self.max_namespaces:
+                old, _ = self.objects.popitem(last=False)
+                for k in [k for k in self.cache if k[-1] == old]:
+                    del self.cache[k]
+        return key
+
+    def get(self, key):
+        with self.lock:
+            features = self.cache.get(key)
+            if features is None:
+                self.misses += 1
+            else:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            return features
+
+    def put(self, key, features):
+        with self.lock:
+            self.cache[key] = features
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
 
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.objects.clear()
+            self.hits = self.misses = 0
 
-def hash_func(x):
-    return int(hashlib.md5(x).hexdigest(), 16)
+    def __len__(self):
+        return len(self.cache)
 
 
 class Simhash(object):
+    __slots__ = ('f', 'idf_dic', 'hashfunc', 'tokenizer', 'featurizer',
+                 'feature_cache', 'value')
 
-    def __init__(self, value, f=F, hashfunc=hash_func, idf_dic=JIEBA_IDF_DIC):
+    def __init__(self, value, f=F, hashfunc=hash_func, idf_dic=JIEBA_IDF_DIC,
+                 tokenizer=tokenize, featurizer=None, feature_cache=None):
         """
 
         :param value: might be an instance of Simhash,
@@ -60,16 +332,28 @@ class Simhash(object):
         :param hashfunc: accepts a utf-8 encoded string and returns a
             unsigned integer in at least `f` bits.
         :param idf_dic: a token -> idf_weight dict.
+        :param tokenizer: accepts a string text and returns a list of words
+        :param featurizer: accepts a string text and returns its features
+            as accepted by build_by_features, replaces tokenizer and tf_idf,
+            e.g. make_ngram_featurizer(n=2) for short texts. None to use
+            tf_idf
+        :param feature_cache: {FeatureCache} reuse the features of the texts
+            seen recently, skipping tokenization and tf_idf, None to disable
         """
         self.f = f
         self.idf_dic = idf_dic
         self.hashfunc = hashfunc
+        self.tokenizer = tokenizer
+        self.featurizer = featurizer
+        self.feature_cache = feature_cache
 
-        if isinstance(value, Simhash):
+        if type(value) is int:  # 最常见的情况，跳过下面较慢的abc检查
+            self.value = value
+        elif isinstance(value, Simhash):
             self.value = value.value
         elif isinstance(value, str):
             self.build_by_text(value)
-        elif isinstance(value, collections.Iterable):
+        elif isinstance(value, collections.abc.Iterable):
             self.build_by_features(value)
         elif isinstance(value, numbers.Integral):
             self.value = value
@@ -80,6 +364,12 @@ class Simhash(object):
         """Compare two simhashes by their value"""
         return self.value == other.value
 
+    def __reduce__(self):
+        """pickled as its value and f only, e.g. sent to a worker process,
+        the hashfunc, idf_dic and tokenizer are only used to build a
+        simhash from text"""
+        return Simhash, (self.value, self.f)
+
     def tf_idf(self, text="处处闻啼鸟，why are you so diao ?"):
         """cut the text and calculate the tf_idf value of each word
         可以考虑使用jieba自带的tf_idf提取器。可导入自己的idf文件。
@@ -88,15 +378,39 @@ class Simhash(object):
         :param text: {str} text content
         :return: a dict of word and weight
         """
-        words = tokenize(text)
+        words = self.tokenizer(text)
         # count = {k: sum(1 for _ in g) for k, g in groupby(sorted(words))}
         count = collections.Counter(words)  # tf
+        if hasattr(self.idf_dic, 'get_many'):  # IdfStore, bulk lookup
+            idfs = self.idf_dic.get_many(list(count), 5)
+            for i, idf in zip(list(count), idfs):
+                count[i] = count[i] * idf
+            return count
         for i in count:
             count[i] = count[i] * self.idf_dic.get(i, 5)  # multiplied by idf
         return count
 
+    def features(self, content):
+        """the features of a text, by the featurizer or tf_idf"""
+        if self.featurizer is None:
+            return self.tf_idf(content)
+        return self.featurizer(content)
+
     def build_by_text(self, content):
-        return self.build_by_features(self.tf_idf(content))
+        cache = self.feature_cache
+        if cache is None:
+            return self.build_by_features(self.features(content))
+        # 不同的分词器、featurizer和idf词典得到的特征不同，一起作为key
+        key = (cache.digest(content), self.featurizer or self.tokenizer,
+               cache.namespace(self.idf_dic))
+        features = cache.get(key)
+        if features is None:
+            features = self.features(content)
+            if isinstance(features, dict):
+                features = features.items()
+            features = tuple(features)
+            cache.put(key, features)
+        return self.build_by_features(features)
 
     def build_by_features(self, features):
         """
@@ -105,72 +419,126 @@ class Simhash(object):
             will be assumed), a list of (token, weight) tuples or
             a token -> weight dict.
         """
-        v = [0] * self.f
-        masks = [1 << i for i in range(self.f)]
+        hashes = []
+        weights = []
         if isinstance(features, dict):
             features = features.items()
         for f in features:
             if isinstance(f, str):
-                h = self.hashfunc(f.encode('utf-8'))
-                w = 1
+                hashes.append(self.hashfunc(f.encode('utf-8')))
+                weights.append(1)
             else:
-                assert isinstance(f, collections.Iterable)
-                h = self.hashfunc(f[0].encode('utf-8'))
-                w = f[1]
-            for i in range(self.f):
-                v[i] += w if h & masks[i] else -w
-        ans = 0
-        for i in range(self.f):
-            if v[i] > 0:
-                ans |= masks[i]
-        self.value = ans
+                assert isinstance(f, collections.abc.Iterable)
+                hashes.append(self.hashfunc(f[0].encode('utf-8')))
+                weights.append(f[1])
+        self.value = accumulate(hashes, weights, self.f)
 
     def distance(self, another):
         """hamming distance between self and another Simhash"""
         assert self.f == another.f
-        x = (self.value ^ another.value) & ((1 << self.f) - 1)
-        ans = 0
-        while x:
-            ans += 1
-            x &= x - 1
-        return ans
+        return bit_count((self.value ^ another.value) & ((1 << self.f) - 1))
 
 
 def to_simhash(text):
     return str(Simhash(text).value)
 
 
-class SimhashIndex(object):
-
-    def __init__(self, objs=None,
-                 storage: Storage = MemoryStorage(),
-                 map_storage: Storage = MemoryMapStorage(),
-                 key_pre='',
-                 f=F, k=K, log=None, key_func=get_keys0, with_id=True):
-        """split simhash into keys, index them into buckets,
-        provide the function to find near duplications.
+@contextlib.contextmanager
+def paused_gc(pause=True):
+    """pause the cyclic gc while loading many objects without reference
+    cycles. The generational passes rescan every object created so far, so
+    the cost grows quadratically with the corpus size.
+    gc is switched off for the whole process, including the other threads,
+    so it is only done when asked for.
 
-        :param objs: a list of (obj_id, simhash)
-            obj_id is a string, simhash is an instance of Simhash
-        :param map_storage: {Storage} the storage for simhash -> obj_id map
-        :param storage: {Storage} the storage backend
-        :param key_pre: {str} prefix to add ahead of the key,
-            when you're dealing with more than 2 corpus with redis storage,
-            you'll need this prefix to prevent the mixture of the keys
-        :param f: {int} the same with the one for Simhash
-        :param k: {int} the tolerance
-        :param log: {logger}
-        :param key_func: function for keys generation
-            `key_func` accepts a Simhash and returns a list of keys,
-            which is split from Simhash.value by bits
+    :param pause: {bool} False to leave gc alone
+    """
+    enabled = pause and gc.isenabled()
+    if enabled:
+        gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def add_batch_dups(results, simhashes, cur_ids, exact, k=K, f=F,
+                   with_id=True):
+    """the intra-batch part of get_near_dups2_many: walking the batch in
+    order, append the earlier simhashes that will be added to the results
+    of every later one within distance k
+
+    The added simhashes are put into temporary buckets of get_int_keys, so
+    every simhash is only compared with the earlier ones sharing a bucket,
+    never with the whole batch.
+
+    :param results: {list} the near duplications found in the index for
+        every simhash, appended in place
+    :param simhashes: {list} instances of Simhash
+    :param cur_ids: {list} ids of the simhashes
+    :param exact: {list} whether an exact duplication of every simhash is
+        already in the index
+    :return: {list} positions of the simhashes to add, the ones without an
+        exact duplication in the index or earlier in the batch
+    """
+    mask = (1 << f) - 1
+    buckets = collections.defaultdict(list)  # key -> the added values
+    positions = dict()  # added value -> position in the batch
+    added = []
+    for i, simhash in enumerate(simhashes):
+        v = simhash.value & mask
+        keys = get_int_keys(simhash, f, k)
+        # 要添加的simhash不在索引中（否则有完全相同的），也不会和已找到的结果重复
+        candidates = set()
+        for key in keys:
+            candidates.update(buckets.get(key, ()))
+        flag = not exact[i]
+        for u in candidates:
+            d = bit_count(v ^ u)
+            if d <= k:
+                if with_id:
+                    results[i].append((int(cur_ids[positions[u]]), d))
+                else:
+                    results[i].append(('%x' % u, d))
+                if d == 0:
+                    flag = False
+        if flag:
+            added.append(i)
+            positions[v] = i
+            for key in keys:
+                buckets[key].append(v)
+    return added
+
+
+class BaseSimhashIndex(object):
+
+    def __init__(self, storage: Storage, map_storage: Storage, key_pre='',
+                 f=F, k=K, log=None, key_func=None, with_id=True,
+                 query_key_func=None):
+        """the key functions, the storages and the helpers that never touch
+        the storages, shared by SimhashIndex and AsyncSimhashIndex.
+        The params are the same with SimhashIndex, the storages must be
+        given.
         """
+        if key_func is None:
+            # int key没有前缀，共用一个storage的多个key_pre需要字符串key
+            key_func = (get_int_keys if storage.int_native and not key_pre
+                        else get_keys0)
+
         self.k = k
         self.f = f
+        self.mask = (1 << f) - 1
         self.key_pre = key_pre
+        self.key_func = key_func
         self.get_keys = lambda x: key_func(x, f, k, key_pre)
+        if query_key_func is None:
+            self.get_query_keys = self.get_keys
+        else:
+            self.get_query_keys = lambda x: query_key_func(x, f, k, key_pre)
         self.storage = storage
+        self.with_id = with_id
         if with_id:
-            self.with_id = with_id
             self.hash2id = map_storage
 
         if log is None:
@@ -178,39 +546,118 @@ class SimhashIndex(object):
         else:
             self.log = log
 
-        if objs:
-            count = len(objs)
-            self.log.info('Initializing %s data.', count)
+    def decode(self, dups):
+        """the members of a bucket as int simhash values"""
+        if self.storage.int_native:
+            return dups
+        return map(self.storage.decode, dups)
+
+    def match(self, values, dups):
+        """hamming distances between several query values and one bucket
 
-            for i, q in enumerate(objs):
-                if i % 10000 == 0 or i == count - 1:
-                    self.log.info('%s/%s', i + 1, count)
-                self.add(*q)
+        :param values: {list} int simhash values of the queries
+        :param dups: members of the bucket
+        :return: a list of (query position, int simhash, distance) tuples
+            for the pairs within distance k
+        """
+        k = self.k
+        members = list(self.decode(dups))
+        np = get_numpy()
+        if (np is None or self.f > 64 or
+                len(values) * len(members) < MATCH_NUMPY_THRESHOLD):
+            return [(i, dup, d) for i, v in enumerate(values)
+                    for dup in members for d in (bit_count(v ^ dup),)
+                    if d <= k]
+        qs = np.array(values, dtype=np.uint64)
+        ms = np.array(members, dtype=np.uint64)
+        ds = popcount(qs[:, None] ^ ms[None, :])
+        qi, mi = np.nonzero(ds <= k)
+        return [(i, members[j], d) for i, j, d in
+                zip(qi.tolist(), mi.tolist(), ds[qi, mi].tolist())]
+
+
+class SimhashIndex(BaseSimhashIndex):
+
+    def __init__(self, objs=None,
+                 storage: Storage = None,
+                 map_storage: Storage = None,
+                 key_pre='',
+                 f=F, k=K, log=None, key_func=None, with_id=True,
+                 query_key_func=None):
+        """split simhash into keys, index them into buckets,
+        provide the function to find near duplications.
+
+        :param objs: an iterable of (obj_id, simhash), obj_id is a string,
+            simhash is an instance of Simhash or an int simhash value,
+            added in batches by `build`
+        :param map_storage: {Storage} the storage for simhash -> obj_id map,
+            defaults to a new MemoryMapStorage
+        :param storage: {Storage} the storage backend,
+            defaults to a new MemoryStorage
+        :param key_pre: {str} prefix to add ahead of the key,
+            when you're dealing with more than 2 corpus with redis storage,
+            you'll need this prefix to prevent the mixture of the keys
+        :param f: {int} the same with the one for Simhash
+        :param k: {int} the tolerance
+        :param log: {logger}
+        :param key_func: function for keys generation
+            `key_func` accepts a Simhash and returns a list of keys,
+            which is split from Simhash.value by bits.
+            defaults to get_int_keys for the storages that keep ints
+            (`storage.int_native`) when key_pre is empty, otherwise
+            get_keys0, get_int_keys ignores key_pre
+        :param query_key_func: function for the keys to probe when querying,
+            same signature with `key_func`, defaults to `key_func`.
+            e.g. multi-index hashing probes a hamming ball around every
+            substring, see `key_funcs.get_query_keys_mih`
+        """
+        if storage is None:
+            storage = MemoryStorage()
+        if map_storage is None:
+            map_storage = MemoryMapStorage()
+        for s in (storage, map_storage):
+            if isinstance(s, AsyncOnlyStorage):
+                raise TypeError(f'{type(s).__name__} only has async methods, '
+                                f'use it with AsyncSimhashIndex')
+        super().__init__(storage, map_storage, key_pre=key_pre, f=f, k=k,
+                         log=log, key_func=key_func, with_id=with_id,
+                         query_key_func=query_key_func)
+        # 两个storage在同一个redis上时，map和bucket的写入放在一个pipeline里
+        self.pipe_map = (with_id and isinstance(storage, RedisStorage) and
+                         isinstance(map_storage, RedisMapStorage) and
+                         map_storage.r is storage.r)
+
+        if objs is not None:
+            self.build(objs)
+
+    def get_id(self, value):
+        return int(self.hash2id.get(self.storage.encode(value)))
 
     def get_one_near_dup(self, simhash):
         """find one near duplication under the distance tolerance k
 
         :param simhash: an instance of Simhash
         :return: return a (obj_id, distance) tuple if self.with_id set
-            to True else return a (hex simhash, distance) tuple
+            to True else return a (Simhash, distance) tuple
         """
         assert simhash.f == self.f
 
-        for key in self.get_keys(simhash):
-            dups = self.storage.get(key)
+        v = simhash.value & self.mask
+        k = self.k
+        keys = list(self.get_query_keys(simhash))
+        for key, dups in zip(keys, self.storage.get_many(keys)):
             self.log.debug('key:%s', key)
             if len(dups) > 2000:
                 self.log.warning('Big bucket found. key:%s, len:%s', key,
                                  len(dups))
 
-            for dup_hex in dups:
-                dup_hash = Simhash(int(dup_hex, 16), self.f)
-                d = simhash.distance(dup_hash)
-                if d <= self.k:
+            for dup in self.decode(dups):
+                d = bit_count(v ^ dup)
+                if d <= k:
                     if self.with_id:
-                        return int(self.hash2id.get(dup_hex)), d
+                        return self.get_id(dup), d
                     else:
-                        return dup_hash, d
+                        return Simhash(dup, self.f), d
         return None, None
 
     def get_near_dups(self, simhash):
@@ -223,27 +670,26 @@ class SimhashIndex(object):
         """
         assert simhash.f == self.f
 
+        v = simhash.value & self.mask
+        k = self.k
         unique = set()  # to distinct the result
         id_dist = []  # [(id, distance),...]
 
-        for key in self.get_keys(simhash):
-            dups = self.storage.get(key)
+        keys = list(self.get_query_keys(simhash))
+        for key, dups in zip(keys, self.storage.get_many(keys)):
             self.log.debug('key:%s', key)
             if len(dups) > 2000:
                 self.log.warning('Big bucket found. key:%s, len:%s', key,
                                  len(dups))
 
-            for dup_hex in dups:
-                dup_hash = Simhash(int(dup_hex, 16), self.f)
-
-                d = simhash.distance(dup_hash)
-                if d <= self.k:
-                    if dup_hex not in unique:
-                        unique.add(dup_hex)
-                        if self.with_id:
-                            id_dist.append((int(self.hash2id.get(dup_hex)), d))
-                        else:
-                            id_dist.append((dup_hex, d))
+            for dup in self.decode(dups):
+                d = bit_count(v ^ dup)
+                if d <= k and dup not in unique:
+                    unique.add(dup)
+                    if self.with_id:
+                        id_dist.append((self.get_id(dup), d))
+                    else:
+                        id_dist.append(('%x' % dup, d))
         return id_dist
 
     def get_near_dups2(self, simhash, cur_id):
@@ -258,28 +704,28 @@ class SimhashIndex(object):
         """
         assert simhash.f == self.f
 
+        v = simhash.value & self.mask
+        k = self.k
         id_dist = list()  # [(id, distance),...]
         unique = set()  # to distinct the result
         flag = 1
 
-        for key in self.get_keys(simhash):
-            dups = self.storage.get(key)
+        keys = list(self.get_query_keys(simhash))
+        for key, dups in zip(keys, self.storage.get_many(keys)):
             self.log.debug('key:%s', key)
             if len(dups) > 3000:
                 self.log.warning(
                     f'Big bucket found. key:{key}, len:{len(dups)}')
 
-            for dup_hex in dups:
-                dup_hash = Simhash(int(dup_hex, 16), self.f)
-                d = simhash.distance(dup_hash)
-
-                if d <= self.k:
-                    if dup_hex not in unique:
-                        unique.add(dup_hex)
+            for dup in self.decode(dups):
+                d = bit_count(v ^ dup)
+                if d <= k:
+                    if dup not in unique:
+                        unique.add(dup)
                         if self.with_id:
-                            id_dist.append((int(self.hash2id.get(dup_hex)), d))
+                            id_dist.append((self.get_id(dup), d))
                         else:
-                            id_dist.append((dup_hex, d))
+                            id_dist.append(('%x' % dup, d))
                     if d == 0:
                         flag = 0
         # No completely duplicate simhash found,
@@ -292,21 +738,198 @@ class SimhashIndex(object):
         """adding the simhash to the storage"""
         assert simhash.f == self.f, f"index's f={self.f},simhash's f={simhash.f}"
 
-        v = '%x' % simhash.value  # format to hex
+        v = self.storage.encode(simhash.value & self.mask)
+        pairs = [(key, v) for key in self.get_keys(simhash)]
+        if self.pipe_map:  # hset和所有的sadd一次往返
+            pipe = self.storage.r.pipeline(transaction=False)
+            self.hash2id.add(v, obj_id, pipe=pipe)
+            self.storage.add_many(pairs, pipe=pipe)
+            return
         if self.with_id:
             self.hash2id.add(v, obj_id)
-        for key in self.get_keys(simhash):
-            self.storage.add(key, v)
+        self.storage.add_many(pairs)
 
     def remove(self, simhash):
         """remove the simhash from the storage"""
         assert simhash.f == self.f
 
-        v = '%x' % simhash.value  # format to hex
+        v = self.storage.encode(simhash.value & self.mask)
+        pairs = [(key, v) for key in self.get_keys(simhash)]
+        if self.pipe_map:  # hdel和所有的srem一次往返
+            pipe = self.storage.r.pipeline(transaction=False)
+            self.hash2id.remove(v, 0, pipe=pipe)
+            self.storage.remove_many(pairs, pipe=pipe)
+            return
         if self.with_id:
             self.hash2id.remove(v, 0)
-        for key in self.get_keys(simhash):
-            self.storage.remove(key, v)
+        self.storage.remove_many(pairs)
+
+    def results(self, found):
+        """turn the {int simhash: distance} dicts into the results of
+        get_near_dups, looking up all the ids at once"""
+        if not self.with_id:
+            return [[('%x' % dup, d) for dup, d in dups.items()]
+                    for dups in found]
+        values = list(set(dup for dups in found for dup in dups))
+        ids = self.hash2id.get_many([self.storage.encode(v) for v in values])
+        value2id = dict(zip(values, ids))
+        return [[(int(value2id[dup]), d) for dup, d in dups.items()]
+                for dups in found]
+
+    def search_many(self, simhashes):
+        """fetch every bucket once for all the queries
+
+        :return: a list of {int simhash: distance} dicts, one per simhash
+        """
+        key2queries = collections.defaultdict(list)
+        values = []
+        for i, simhash in enumerate(simhashes):
+            assert simhash.f == self.f
+            values.append(simhash.value & self.mask)
+            for key in self.get_query_keys(simhash):
+                key2queries[key].append(i)
+
+        found = [dict() for _ in values]
+        keys = list(key2queries)
+        for key, dups in zip(keys, self.storage.get_many(keys)):
+            if not dups:
+                continue
+            if len(dups) > 2000:
+                self.log.warning('Big bucket found. key:%s, len:%s', key,
+                                 len(dups))
+            queries = key2queries[key]
+            for i, dup, d in self.match([values[q] for q in queries], dups):
+                found[queries[i]][dup] = d
+        return found
+
+    def get_near_dups_many(self, simhashes):
+        """batched get_near_dups. The queries are grouped by bucket key,
+        every bucket is fetched once, and the distances between a bucket
+        and all the queries sharing it are computed in one step.
+
+        :param simhashes: {list} instances of Simhash
+        :return: a list with the result of get_near_dups for every simhash
+        """
+        return self.results(self.search_many(list(simhashes)))
+
+    def get_near_dups2_many(self, simhashes, cur_ids):
+        """batched get_near_dups2, the same as calling get_near_dups2 for
+        every simhash in order: a simhash also finds the ones before it in
+        the same batch, and is only added if no exact duplication found.
+
+        :param simhashes: {list} instances of Simhash
+        :param cur_ids: {list} ids of the simhashes
+        :return: a list with the result of get_near_dups2 for every simhash
+        """
+        simhashes = list(simhashes)
+        cur_ids = list(cur_ids)
+        found = self.search_many(simhashes)
+        results = self.results(found)
+        added = add_batch_dups(results, simhashes, cur_ids,
+                               [0 in dups.values() for dups in found],
+                               self.k, self.f, self.with_id)
+        self.add_many((cur_ids[i], simhashes[i]) for i in added)
+        return results
+
+    def build(self, objs, batch_size=100000, pause_gc=False):
+        """bulk add an iterable of (obj_id, simhash), e.g. a generator over
+        a historical corpus, batch_size of them at a time through add_many
+
+        :param objs: an iterable of (obj_id, Simhash or int simhash value)
+        :param batch_size: {int} the number of simhashes added at a time
+        :param pause_gc: {bool} pause the gc of the whole process while
+            building, much faster for millions of simhashes, see paused_gc
+        :return: {int} the number of added simhashes
+        """
+        count = 0
+        it = iter(objs)
+        with paused_gc(pause_gc):
+            while True:
+                batch = [(obj_id, simhash if isinstance(simhash, Simhash)
+                          else Simhash(simhash, self.f))
+                         for obj_id, simhash in itertools.islice(it, batch_size)]
+                if not batch:
+                    break
+                self.add_many(batch)
+                count += len(batch)
+                self.log.info('%s added.', count)
+        return count
+
+    def group_by_bucket(self, simhashes, members):
+        """the keys of all the simhashes grouped by bucket
+
+        :param simhashes: {list} instances of Simhash
+        :param members: {list} the encoded values of the simhashes
+        :return: a {key: [member, ...]} dict
+        """
+        if (self.key_func is get_int_keys and get_numpy() is not None and
+                self.f <= 64 and self.storage.int_native):
+            return group_int_keys(members, self.f, self.k)
+        buckets = collections.defaultdict(list)
+        for simhash, v in zip(simhashes, members):
+            for key in self.get_keys(simhash):
+                buckets[key].append(v)
+        return buckets
+
+    def add_many(self, objs):
+        """adding several (obj_id, simhash) to the storage, the members are
+        grouped by bucket and every bucket is written once"""
+        ids = []
+        simhashes = []
+        for obj_id, simhash in objs:
+            assert simhash.f == self.f, f"index's f={self.f},simhash's f={simhash.f}"
+            ids.append(obj_id)
+            simhashes.append(simhash)
+        encode = self.storage.encode
+        mask = self.mask
+        members = [encode(simhash.value & mask) for simhash in simhashes]
+        if self.with_id:
+            self.hash2id.add_many(zip(members, ids))
+        self.storage.add_buckets(self.group_by_bucket(simhashes, members))
+
+    def items(self):
+        """iterate over the (int simhash, obj_id) pairs of the index,
+        read from the simhash -> obj_id map"""
+        if not self.with_id:
+            raise ValueError('the simhash -> obj_id map is needed, '
+                             'set with_id=True')
+        for member, obj_id in self.hash2id.items():
+            yield self.storage.decode(member), obj_id
+
+    def save(self, path):
+        """write the index into a file that can be memory-mapped by
+        SimhashIndex.open, the obj_ids must be integers. needs numpy"""
+        from .mmap_index import save_index
+
+        values = []
+        ids = []
+        for value, obj_id in self.items():
+            values.append(value)
+            ids.append(int(obj_id))
+        save_index(path, values, ids, self.f, self.k)
+
+    def find_all_near_dup_pairs(self, n_blocks=None):
+        """all the (obj_id, obj_id, distance) pairs within distance k in the
+        index, each pair once, see self_join.find_all_near_dup_pairs.
+        needs numpy"""
+        from .self_join import find_all_near_dup_pairs
+
+        return find_all_near_dup_pairs(self, n_blocks=n_blocks)
+
+    def cluster(self, n_blocks=None):
+        """obj_id -> the obj_id representing its cluster of near
+        duplicates, see self_join.cluster. needs numpy"""
+        from .self_join import cluster
+
+        return cluster(self, n_blocks=n_blocks)
+
+    @staticmethod
+    def open(path, log=None):
+        """open a file written by SimhashIndex.save as a read-only
+        MmapSimhashIndex, the file is memory-mapped instead of loaded"""
+        from .mmap_index import MmapSimhashIndex
+
+        return MmapSimhashIndex(path, log)
 
 
 def test2():
@@ -5,14 +5,52 @@ Created on 2020-03-20
 
 @author: Chant
 """
+import array
+import bisect
 import collections
-import redis
+import functools
+import heapq
+import logging
+import operator
+import typing
+
+if typing.TYPE_CHECKING:  # 只有redis存储用到，不在import simhash时导入
+    import redis
+    import redis.asyncio
+
+log = logging.getLogger("simhash")
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    """第一次用到时才导入numpy，import simhash时不导入，numpy未安装时返回None"""
+    try:
+        import numpy
+    except ImportError:  # numpy is optional, fall back to the pure python
+        return None
+    return numpy
+
+EMPTY = frozenset()  # returned for the buckets that don't exist
+# ArrayStorage.add_buckets中新增的元素达到这个数量时，整个bucket合并重建
+ARRAY_MERGE_MIN = 16
 
 
 class Storage(object):
+    # True if the members are kept as int simhash values,
+    # otherwise they are encoded into hex strings
+    int_native = False
+
     def __init__(self):
         pass
 
+    def encode(self, value):
+        """int simhash value -> member stored in the buckets"""
+        return '%x' % value
+
+    def decode(self, member):
+        """member stored in the buckets -> int simhash value"""
+        return int(member, 16)
+
     def get(self, k):
         pass
 
@@ -25,6 +63,28 @@ class Storage(object):
     def clear(self):
         pass
 
+    def get_many(self, keys):
+        """get several keys at once, returns a list in the order of keys"""
+        return [self.get(k) for k in keys]
+
+    def add_many(self, pairs):
+        """add an iterable of (k, v) pairs"""
+        for k, v in pairs:
+            self.add(k, v)
+
+    def remove_many(self, pairs):
+        """remove an iterable of (k, v) pairs"""
+        for k, v in pairs:
+            self.remove(k, v)
+
+    def add_buckets(self, buckets):
+        """add the members grouped by bucket, a {k: [v, ...]} dict"""
+        self.add_many((k, v) for k, vs in buckets.items() for v in vs)
+
+    def items(self):
+        """iterate over all the (k, v) pairs, only for the map storages"""
+        raise NotImplementedError
+
 
 class MemoryMapStorage(Storage):
     def __init__(self):
@@ -38,6 +98,9 @@ class MemoryMapStorage(Storage):
     def add(self, k, v):
         self.map[k] = v
 
+    def add_many(self, pairs):
+        self.map.update(pairs)
+
     def remove(self, k, v):
         if k in self.map:
             self.map.pop(k)
@@ -45,9 +108,12 @@ class MemoryMapStorage(Storage):
     def clear(self):
         self.map.clear()
 
+    def items(self):
+        return iter(self.map.items())
+
 
 class RedisMapStorage(Storage):
-    def __init__(self, r: redis.client.Redis, redis_key):
+    def __init__(self, r: 'redis.client.Redis', redis_key):
         """use a redis map to store the simhash -> obj_id map"""
         super().__init__()
         self.redis_key = redis_key
@@ -56,64 +122,494 @@ class RedisMapStorage(Storage):
     def get(self, k):
         return self.r.hget(self.redis_key, k)
 
-    def add(self, k, v):
-        self.r.hset(self.redis_key, k, v)
+    def add(self, k, v, pipe=None):
+        """pipe: {redis.client.Pipeline} only queue the command into it"""
+        (pipe or self.r).hset(self.redis_key, k, v)
 
-    def remove(self, k, v):
-        self.r.hdel(self.redis_key, k)
+    def remove(self, k, v, pipe=None):
+        (pipe or self.r).hdel(self.redis_key, k)
 
     def clear(self):
         self.r.expire(self.redis_key, 0)
 
+    def items(self):
+        return self.r.hscan_iter(self.redis_key)
+
+    def get_many(self, keys):
+        """one hmget for all the keys"""
+        keys = list(keys)
+        if not keys:
+            return []
+        return self.r.hmget(self.redis_key, keys)
+
+    def add_many(self, pairs, batch_size=10000):
+        """hset with a mapping, batch_size fields per round trip"""
+        pipe = self.r.pipeline(transaction=False)
+        mapping = dict()
+        for k, v in pairs:
+            mapping[k] = v
+            if len(mapping) >= batch_size:
+                pipe.hset(self.redis_key, mapping=mapping)
+                mapping = dict()
+        if mapping:
+            pipe.hset(self.redis_key, mapping=mapping)
+        pipe.execute()
+
 
 class MemoryStorage(Storage):
+    int_native = True
+
     def __init__(self):
+        """use a python dict of sets to store the buckets,
+        the members are int simhash values"""
         super().__init__()
         self.bucket = collections.defaultdict(set)
 
+    def encode(self, value):
+        return value
+
+    def decode(self, member):
+        return member
+
     def get(self, k):
-        return self.bucket.get(k)
+        return self.bucket.get(k, EMPTY)
 
     def add(self, k, v):
         self.bucket[k].add(v)
 
+    def add_buckets(self, buckets):
+        for k, vs in buckets.items():
+            self.bucket[k].update(vs)
+
     def remove(self, k, v):
-        if v in self.bucket[k]:
-            self.bucket[k].remove(v)
+        bucket = self.bucket.get(k)
+        if bucket is not None:
+            bucket.discard(v)
+            if not bucket:  # 不保留空的bucket
+                del self.bucket[k]
 
     def clear(self):
         self.bucket.clear()
 
 
+class ArrayStorage(MemoryStorage):
+
+    def __init__(self):
+        """use a python dict of sorted array('Q') to store the buckets,
+        the members are int simhash values, 8 bytes per member instead of a
+        set entry and an int object. f must be at most 64.
+        add and remove binary search the bucket and shift the members after
+        the position (a memmove), no python object per member is kept.
+        """
+        Storage.__init__(self)
+        self.bucket = dict()
+
+    def add(self, k, v):
+        members = self.bucket.get(k)
+        if members is None:
+            self.bucket[k] = array.array('Q', (v,))
+            return
+        i = bisect.bisect_left(members, v)
+        if i == len(members) or members[i] != v:
+            members.insert(i, v)
+
+    def add_buckets(self, buckets):
+        """a bucket receiving many members is rebuilt once from the merged
+        members instead of inserting them one by one"""
+        for k, vs in buckets.items():
+            members = self.bucket.get(k)
+            if members is not None and len(vs) < ARRAY_MERGE_MIN:
+                for v in vs:
+                    self.add(k, v)
+                continue
+            merged = array.array('Q')
+            np = get_numpy()
+            if np is not None:
+                new = np.array(vs, dtype=np.uint64)
+                if members is not None:
+                    new = np.concatenate(
+                        [np.frombuffer(members, dtype=np.uint64), new])
+                new.sort()
+                keep = np.ones(len(new), dtype=bool)
+                np.not_equal(new[1:], new[:-1], out=keep[1:])
+                merged.frombytes(new[keep].tobytes())
+            else:
+                merged.extend(sorted(set(vs).union(members or ())))
+            self.bucket[k] = merged
+
+    def remove(self, k, v):
+        members = self.bucket.get(k)
+        if members is None:
+            return
+        i = bisect.bisect_left(members, v)
+        if i < len(members) and members[i] == v:
+            del members[i]
+            if not members:
+                del self.bucket[k]
+
+
+class ArrayMapStorage(Storage):
+    int_native = True
+
+    def __init__(self, typecode='q', merge_ratio=0.1, merge_min=4096):
+        """use two sorted parallel arrays to store the simhash -> obj_id map,
+        about 16 bytes per pair instead of a dict entry and two int objects.
+        The keys must be int simhash values (use it with an int_native
+        storage, e.g. ArrayStorage), the obj_ids must be integers.
+        New pairs go into a small dict and removed keys into a set, they
+        are merged into the arrays once they grow beyond merge_ratio of the
+        arrays, so the sorting is amortised.
+
+        :param typecode: {str} array typecode of the obj_ids, 'q' for int64
+        :param merge_ratio: {float} merge when the pending changes reach
+            this ratio of the arrays
+        :param merge_min: {int} and at least so many
+        """
+        super().__init__()
+        self.keys = array.array('Q')
+        self.ids = array.array(typecode)
+        self.pending = dict()  # 新插入的simhash -> obj_id
+        self.deleted = set()  # 已从keys中删除的simhash
+        self.merge_ratio = merge_ratio
+        self.merge_min = merge_min
+
+    def encode(self, value):
+        return value
+
+    def decode(self, member):
+        return member
+
+    def find(self, k):
+        """the position of k in the sorted keys, -1 if not found"""
+        i = bisect.bisect_left(self.keys, k)
+        if i < len(self.keys) and self.keys[i] == k:
+            return i
+        return -1
+
+    def get(self, k):
+        obj_id = self.pending.get(k)
+        if obj_id is not None or k in self.deleted:
+            return obj_id
+        i = self.find(k)
+        return None if i < 0 else self.ids[i]
+
+    def add(self, k, v):
+        self.pending[k] = operator.index(v)
+        self.deleted.discard(k)
+        self.maybe_merge()
+
+    def add_many(self, pairs):
+        for k, v in pairs:
+            self.pending[k] = operator.index(v)
+            self.deleted.discard(k)
+        self.maybe_merge()
+
+    def remove(self, k, v):
+        self.pending.pop(k, None)
+        if self.find(k) >= 0:
+            self.deleted.add(k)
+            self.maybe_merge()
+
+    def clear(self):
+        self.keys = array.array('Q')
+        self.ids = array.array(self.ids.typecode)
+        self.pending.clear()
+        self.deleted.clear()
+
+    def maybe_merge(self):
+        if len(self.pending) + len(self.deleted) >= max(
+                self.merge_min, self.merge_ratio * len(self.keys)):
+            self.merge()
+
+    def merge(self):
+        """merge the pending pairs and the deleted keys into the arrays"""
+        keys = array.array('Q')
+        ids = array.array(self.ids.typecode)
+        np = get_numpy()
+        if np is not None:
+            old_keys = np.frombuffer(self.keys, dtype=np.uint64)
+            old_ids = np.frombuffer(self.ids, dtype=self.ids.typecode)
+            drop = np.array(list(self.pending) + list(self.deleted),
+                            dtype=np.uint64)
+            keep = ~np.isin(old_keys, drop)
+            new_keys = np.concatenate([
+                old_keys[keep],
+                np.array(list(self.pending), dtype=np.uint64)])
+            new_ids = np.concatenate([
+                old_ids[keep],
+                np.array(list(self.pending.values()), dtype=old_ids.dtype)])
+            order = np.argsort(new_keys, kind='stable')
+            keys.frombytes(new_keys[order].tobytes())
+            ids.frombytes(new_ids[order].tobytes())
+        else:
+            old = ((k, v) for k, v in zip(self.keys, self.ids)
+                   if k not in self.pending and k not in self.deleted)
+            for k, v in heapq.merge(old, sorted(self.pending.items())):
+                keys.append(k)
+                ids.append(v)
+        self.keys = keys
+        self.ids = ids
+        self.pending.clear()
+        self.deleted.clear()
+
+    def items(self):
+        self.merge()
+        return zip(self.keys, self.ids)
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending) - len(self.deleted) - \
+            sum(1 for k in self.pending if self.find(k) >= 0)
+
+
 class RedisStorage(Storage):
 
-    def __init__(self, r: redis.client.Redis,
+    def __init__(self, r: 'redis.client.Redis',
                  expire=7 * 24 * 60 * 60,
                  keys_key='bucket_keys'):
+        """use redis sets to store the buckets, the members are hex strings.
+        add_many and get_many are sent in one pipeline, so adding a simhash
+        to all its buckets or fetching all the buckets of a query is one
+        round trip.
+        """
         super().__init__()
         self.r = r
-        self.pipe = r.pipeline()
         self.expire = expire
-        self.bucket_keys = set()
         self.keys_key = keys_key
 
     def get(self, k):
         return self.r.smembers(k)
 
     def add(self, k, v):
-        self.r.sadd(k, v)
-        self.r.expire(k, self.expire)
-        # 记录下所有的bucket的key，方便统一删除
-        self.r.sadd(self.keys_key, k)
+        self.add_many([(k, v)])
 
     def remove(self, k, v):
         self.r.srem(k, v)
 
+    def get_many(self, keys):
+        """smembers of all the keys in one round trip"""
+        pipe = self.r.pipeline(transaction=False)
+        for k in keys:
+            pipe.smembers(k)
+        return pipe.execute()
+
+    def remove_many(self, pairs, pipe=None):
+        """srem all the pairs in one round trip
+
+        :param pipe: {redis.client.Pipeline} send the srems together with the
+            commands already queued in it
+        """
+        if pipe is None:
+            pipe = self.r.pipeline(transaction=False)
+        for k, v in pairs:
+            pipe.srem(k, v)
+        pipe.execute()
+
+    def add_many(self, pairs, batch_size=10000, pipe=None):
+        """add the (k, v) pairs grouped by key, batch_size keys per round trip"""
+        buckets = collections.defaultdict(list)
+        for k, v in pairs:
+            buckets[k].append(v)
+        self.add_buckets(buckets, batch_size, pipe)
+
+    def add_buckets(self, buckets, batch_size=10000, pipe=None):
+        """one sadd per bucket, batch_size buckets per round trip
+
+        :param pipe: {redis.client.Pipeline} send the first batch together
+            with the commands already queued in it
+        """
+        if pipe is None:
+            pipe = self.r.pipeline(transaction=False)
+        keys = []
+        for k, vs in buckets.items():
+            pipe.sadd(k, *vs)
+            pipe.expire(k, self.expire)
+            keys.append(k)
+            if len(keys) >= batch_size:
+                # 记录下所有的bucket的key，方便统一删除
+                pipe.sadd(self.keys_key, *keys)
+                pipe.execute()
+                keys = []
+        if keys:
+            pipe.sadd(self.keys_key, *keys)
+        if len(pipe):
+            pipe.execute()
+
     def clear(self, batch_size=1000):
-        keys = self.r.smembers(self.keys_key)
+        pipe = self.r.pipeline(transaction=False)
+        i = 0
+        for i, key in enumerate(self.r.sscan_iter(self.keys_key), 1):
+            pipe.delete(key)
+            if i % batch_size == 0:
+                pipe.execute()
+                log.debug('批量删除redis中数据，删除至%s条', i)
+        pipe.delete(self.keys_key)
+        pipe.execute()
+        log.info('批量删除redis中数据，共删除%s条', i)
+
 
-        for i, key in enumerate(keys):
-            self.pipe.expire(key, 0)
+class AsyncStorage(Storage):
+    """the asyncio storage interface, the defaults call the sync methods,
+    so a storage that never blocks (in memory) only needs to mix it in"""
+
+    async def aget(self, k):
+        return self.get(k)
+
+    async def aadd(self, k, v):
+        self.add(k, v)
+
+    async def aremove(self, k, v):
+        self.remove(k, v)
+
+    async def aclear(self):
+        self.clear()
+
+    async def aget_many(self, keys):
+        """get several keys concurrently, returns a list in the order of keys"""
+        import asyncio  # 已经在事件循环中，导入不花时间
+
+        return await asyncio.gather(*[self.aget(k) for k in keys])
+
+    async def aadd_many(self, pairs):
+        """add an iterable of (k, v) pairs"""
+        for k, v in pairs:
+            await self.aadd(k, v)
+
+    async def aremove_many(self, pairs):
+        """remove an iterable of (k, v) pairs"""
+        for k, v in pairs:
+            await self.aremove(k, v)
+
+
+class AsyncMemoryStorage(MemoryStorage, AsyncStorage):
+    async def aget_many(self, keys):
+        return self.get_many(keys)
+
+    async def aadd_many(self, pairs):
+        self.add_many(pairs)
+
+    async def aremove_many(self, pairs):
+        self.remove_many(pairs)
+
+
+class AsyncMemoryMapStorage(MemoryMapStorage, AsyncStorage):
+    async def aget_many(self, keys):
+        return self.get_many(keys)
+
+    async def aadd_many(self, pairs):
+        self.add_many(pairs)
+
+    async def aremove_many(self, pairs):
+        self.remove_many(pairs)
+
+
+class AsyncOnlyStorage(AsyncStorage):
+    """an AsyncStorage that can only be used through its async methods,
+    e.g. one on the asyncio redis client, the sync methods raise instead of
+    silently doing nothing"""
+
+    def sync_method(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} only has async methods, '
+                        f'use it with AsyncSimhashIndex')
+
+    get = add = remove = clear = get_many = add_many = remove_many = \
+        add_buckets = items = sync_method
+
+
+class AsyncRedisMapStorage(AsyncOnlyStorage):
+    def __init__(self, r: 'redis.asyncio.Redis', redis_key):
+        """use a redis map to store the simhash -> obj_id map, with the
+        asyncio redis client"""
+        super().__init__()
+        self.redis_key = redis_key
+        self.r = r
+
+    async def aget(self, k):
+        return await self.r.hget(self.redis_key, k)
+
+    async def aadd(self, k, v):
+        await self.r.hset(self.redis_key, k, v)
+
+    async def aremove(self, k, v):
+        await self.r.hdel(self.redis_key, k)
+
+    async def aclear(self):
+        await self.r.expire(self.redis_key, 0)
+
+    async def aget_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        return await self.r.hmget(self.redis_key, keys)
+
+    async def aadd_many(self, pairs):
+        mapping = dict(pairs)
+        if mapping:
+            await self.r.hset(self.redis_key, mapping=mapping)
+
+    async def aremove_many(self, pairs):
+        """hdel all the keys in one command"""
+        keys = [k for k, _ in pairs]
+        if keys:
+            await self.r.hdel(self.redis_key, *keys)
+
+
+class AsyncRedisStorage(AsyncOnlyStorage):
+
+    def __init__(self, r: 'redis.asyncio.Redis',
+                 expire=7 * 24 * 60 * 60,
+                 keys_key='bucket_keys'):
+        """the same as RedisStorage, with the asyncio redis client.
+        Many queries in flight share the connection pool of `r`."""
+        super().__init__()
+        self.r = r
+        self.expire = expire
+        self.keys_key = keys_key
+
+    async def aget(self, k):
+        return await self.r.smembers(k)
+
+    async def aadd(self, k, v):
+        await self.aadd_many([(k, v)])
+
+    async def aremove(self, k, v):
+        await self.r.srem(k, v)
+
+    async def aget_many(self, keys):
+        """smembers of all the keys in one round trip"""
+        pipe = self.r.pipeline(transaction=False)
+        for k in keys:
+            pipe.smembers(k)
+        return await pipe.execute()
+
+    async def aadd_many(self, pairs):
+        buckets = collections.defaultdict(list)
+        for k, v in pairs:
+            buckets[k].append(v)
+        if not buckets:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for k, vs in buckets.items():
+            pipe.sadd(k, *vs)
+            pipe.expire(k, self.expire)
+        # 记录下所有的bucket的key，方便统一删除
+        pipe.sadd(self.keys_key, *buckets)
+        await pipe.execute()
+
+    async def aremove_many(self, pairs):
+        """srem of all the pairs in one round trip"""
+        pipe = self.r.pipeline(transaction=False)
+        for k, v in pairs:
+            pipe.srem(k, v)
+        if len(pipe):
+            await pipe.execute()
+
+    async def aclear(self, batch_size=1000):
+        pipe = self.r.pipeline(transaction=False)
+        i = 0
+        async for key in self.r.sscan_iter(self.keys_key):
+            i += 1
+            pipe.delete(key)
             if i % batch_size == 0:
-                self.pipe.execute()
-                print(f'批量删除redis中数据，删除至{i}条')
+                await pipe.execute()
+        pipe.delete(self.keys_key)
+        await pipe.execute()
@@ -5,17 +5,19 @@ Created on 2020-03-20
 
 @author: Chant
 """
+import collections
+import functools
 import os
 import re
-import urllib.request
 
-import jieba
+from .resources import load_cached
 
 BASE_DIR = os.path.split(os.path.realpath(__file__))[0]
 
 MATCH_CH = re.compile('^[\u4e00-\u9fa5]*$')  # 匹配中文
 MATCH_CH_EN = re.compile('^[\u4e00-\u9fcca-zA-Z]*$')  # 匹配中英文
 HTML_TAG_PATTERN = re.compile(r'<[^>]+>', re.S)  # html标签正则
+NON_WORD_PATTERN = re.compile(r'[\W_]+')  # 标点、空白等非文字字符
 
 # 用户自定义词典
 DIR_OF_MEDICAL_BEAUTY = os.path.join(BASE_DIR, '../static/userdict.dic')
@@ -27,23 +29,55 @@ DIR_OF_STOP_WORDS = os.path.join(BASE_DIR, '../static/stop_words.txt')
 
 def load_user_dict_for_jieba(user_dicts=DICTS):
     """使用jieba加载用户自定义词典"""
+    import jieba
+
     for user_dict in user_dicts:
         jieba.load_userdict(user_dict)
         print(f'loading user define dict from {user_dict}')
 
 
+def read_stop_words(path):
+    with open(path, encoding='utf8') as f:
+        stop_words = set(i.rstrip('\n') for i in f.readlines())
+    print(f'loading stop words from {path}')
+    return stop_words
+
+
+@functools.lru_cache(maxsize=None)
 def get_stop_words():
-    """读取停用词表，返回一个包含停用词的set
+    """读取停用词表，返回一个包含停用词的set，只在第一次调用时读取
 
-    :return: {set} 停用词集合
+    :return: {frozenset} 停用词集合
     """
-    with open(DIR_OF_STOP_WORDS, encoding='utf8') as f:
-        stop_words = set(i.rstrip('\n') for i in f.readlines())
-    print(f'loading stop words from {DIR_OF_STOP_WORDS}')
-    return stop_words
+    return frozenset(load_cached(DIR_OF_STOP_WORDS, read_stop_words))
+
+
+@functools.lru_cache(maxsize=None)
+def get_jieba():
+    """第一次分词时才导入jieba并加载自定义词典"""
+    import jieba
+
+    if not jieba.dt.initialized:
+        load_user_dict_for_jieba()  # 加载自定义词典
+    return jieba
+
 
+def __getattr__(name):
+    # 兼容之前的模块变量STOP_WORDS，访问时才加载
+    if name == 'STOP_WORDS':
+        return get_stop_words()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-STOP_WORDS = get_stop_words()  # 加载停用词
+
+# 分词结果中的词高度重复，每个词是否保留只判断一次
+KEEP_CACHE_SIZE = 2 ** 17
+
+
+@functools.lru_cache(maxsize=KEEP_CACHE_SIZE)
+def keep_token(token):
+    """只保留中英文，且不是停用词的词"""
+    return MATCH_CH_EN.match(token) is not None and \
+        token not in get_stop_words()
 
 
 def tokenize(content):
@@ -52,12 +86,44 @@ def tokenize(content):
     :param content: {str} 要分词的字符串
     :return: {list} [word, word, ...] 分词后的单词集合
     """
-    if not jieba.dt.initialized:
-        load_user_dict_for_jieba()  # 加载自定义词典
+    if '<' in content:
+        content = remove_html_tags(content)
+    return [i for i in get_jieba().cut(content) if keep_token(i)]
+
 
-    content = remove_html_tags(content)
-    return [i for i in jieba.cut(content) if
-            is_ch_en(i) and i not in STOP_WORDS]
+def char_ngrams(content, n=3):
+    """不分词，去除html标签、标点和空白并转为小写后，按n个字符滑动切分(shingle)
+
+    :param content: {str} 要切分的字符串
+    :param n: {int} 每个n-gram的字符数
+    :return: {list} [n-gram, n-gram, ...]，短于n的文本整体作为一个n-gram
+    """
+    if '<' in content:
+        content = remove_html_tags(content)
+    content = NON_WORD_PATTERN.sub('', content.lower())
+    if not content:
+        return []
+    return [content[i:i + n] for i in range(max(len(content) - n + 1, 1))]
+
+
+def ngram_features(content, n=3, weighted=True):
+    """字符n-gram特征，可直接作为Simhash的featurizer，不需要jieba分词和idf词典。
+    短文本（评论、回复）分词的耗时远大于计算simhash，用这个代替tokenize + tf_idf
+
+    :param content: {str} 文本
+    :param n: {int} 每个n-gram的字符数
+    :param weighted: {bool} True以出现次数为权重，False每个n-gram的权重都为1
+    :return: {dict} n-gram -> weight
+    """
+    grams = char_ngrams(content, n)
+    if weighted:
+        return collections.Counter(grams)
+    return dict.fromkeys(grams, 1)
+
+
+def make_ngram_featurizer(n=3, weighted=True):
+    """返回一个指定n和weighted的ngram_features"""
+    return functools.partial(ngram_features, n=n, weighted=weighted)
 
 
 def remove_html_tags(content):
@@ -77,6 +143,8 @@ def is_ch_en(content):
 
 
 def get_html(url):
+    import urllib.request
+
     _html = urllib.request.urlopen(url).read()
     return str(_html)
 
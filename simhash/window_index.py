@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-17
+
+只保留最近一段时间或最近若干条的内存索引。
+RedisStorage的bucket会在7天后过期，但MemoryStorage和MemoryMapStorage会一直增长，
+实时查重其实只需要最近N小时或最近M条数据。这里按插入顺序记录每个simhash的插入时间，
+把最老的simhash从所有bucket和hash2id中删除。每次add和查询只顺带淘汰几条，
+不会有一次性的全量清理，持续写入时内存保持平稳。
+"""
+import collections
+import time
+
+from .sim_hash import Simhash, SimhashIndex, F, K
+from .storage import Storage
+
+
+class SlidingWindowSimhashIndex(SimhashIndex):
+
+    def __init__(self, objs=None, storage: Storage = None,
+                 map_storage: Storage = None, key_pre='',
+                 f=F, k=K, log=None, key_func=None, with_id=True,
+                 query_key_func=None, max_age=None, max_size=None,
+                 evict_batch=8, clock=time.monotonic):
+        """SimhashIndex keeping only the simhashes added in the last
+        `max_age` seconds and at most the last `max_size` of them.
+
+        :param max_age: {float} seconds a simhash is kept, None for no limit
+        :param max_size: {int} the number of simhashes kept, None for no limit
+        :param evict_batch: {int} the most simhashes evicted by a query, or
+            by an add for every simhash added, the size never goes beyond
+            max_size as long as evict_batch >= 1
+        :param clock: function returning the current time in seconds
+        other params are the same with SimhashIndex
+        """
+        self.max_age = max_age
+        self.max_size = max_size
+        self.evict_batch = evict_batch
+        self.clock = clock
+        self.times = collections.OrderedDict()  # simhash -> 插入时间，按插入顺序
+        super().__init__(objs=objs, storage=storage, map_storage=map_storage,
+                         key_pre=key_pre, f=f, k=k, log=log,
+                         key_func=key_func, with_id=with_id,
+                         query_key_func=query_key_func)
+
+    def __len__(self):
+        return len(self.times)
+
+    def expired(self, now, added_at):
+        return ((self.max_size is not None and
+                 len(self.times) > self.max_size) or
+                (self.max_age is not None and now - added_at > self.max_age))
+
+    def evict(self, limit=None):
+        """remove the oldest simhashes beyond max_size or max_age
+
+        :param limit: {int} evict at most so many, None for all of them
+        :return: {int} the number of evicted simhashes
+        """
+        now = self.clock()
+        n = 0
+        while self.times and (limit is None or n < limit):
+            value, added_at = next(iter(self.times.items()))
+            if not self.expired(now, added_at):
+                break
+            self.times.popitem(last=False)
+            SimhashIndex.remove(self, Simhash(value, self.f))
+            n += 1
+        if n:
+            self.log.debug('%s simhashes evicted.', n)
+        return n
+
+    def touch(self, simhash):
+        value = simhash.value & self.mask
+        self.times[value] = self.clock()
+        self.times.move_to_end(value)
+
+    def get_one_near_dup(self, simhash):
+        self.evict(self.evict_batch)
+        return super().get_one_near_dup(simhash)
+
+    def get_near_dups(self, simhash):
+        self.evict(self.evict_batch)
+        return super().get_near_dups(simhash)
+
+    def get_near_dups_many(self, simhashes):
+        self.evict(self.evict_batch)
+        return super().get_near_dups_many(simhashes)
+
+    def get_near_dups2(self, simhash, cur_id):
+        self.evict(self.evict_batch)
+        return super().get_near_dups2(simhash, cur_id)
+
+    def get_near_dups2_many(self, simhashes, cur_ids):
+        self.evict(self.evict_batch)
+        return super().get_near_dups2_many(simhashes, cur_ids)
+
+    def add(self, obj_id, simhash):
+        """add the simhash, refresh its time if it is already in the index,
+        then evict the expired ones"""
+        super().add(obj_id, simhash)
+        self.touch(simhash)
+        self.evict(self.evict_batch)
+
+    def add_many(self, objs):
+        objs = list(objs)
+        super().add_many(objs)
+        for _, simhash in objs:
+            self.touch(simhash)
+        self.evict(self.evict_batch * len(objs))
+
+    def remove(self, simhash):
+        super().remove(simhash)
+        self.times.pop(simhash.value & self.mask, None)
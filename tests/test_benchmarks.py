@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from unittest import main, TestCase
+
+from benchmarks.corpus import make_fingerprints
+from benchmarks.run import Suite, compare, result_id
+
+
+class TestBenchmarks(TestCase):
+
+    def test_fingerprints(self):
+        values = make_fingerprints(2000, dup_rate=0.5, skew=1.0, hot_bits=8,
+                                   n_hot=2, seed=1)
+        self.assertEqual(values, make_fingerprints(
+            2000, dup_rate=0.5, skew=1.0, hot_bits=8, n_hot=2, seed=1))
+        # 新生成的值的低8位只有2种，近似重复的值最多翻转3位
+        self.assertLessEqual(len(set(v & 0xff for v in values)), 2 * 8 ** 3)
+        self.assertLess(len(set(values)), 2000)
+
+    def test_suite(self):
+        suite = Suite(n=200, n_queries=10, n_texts=3, ks=(3,),
+                      key_funcs=('get_int_keys', 'get_keys2'),
+                      storages=('memory',), log=lambda *args: None)
+        results = suite.run()
+        names = {result['name'] for result in results}
+        self.assertTrue({'tokenize', 'simhash_text', 'add', 'get_near_dups',
+                         'get_near_dups2', 'build'} <= names)
+        self.assertEqual(sorted(r['params']['pause_gc'] for r in results
+                                if r['name'] == 'build'),
+                         [False, False, True, True])
+        found = [r['mean_results'] for r in results
+                 if r['name'] == 'get_near_dups']
+        # 两种key_func的结果相同，至少能找到被查询的那个simhash
+        self.assertEqual(found[0], found[1])
+        self.assertGreaterEqual(found[0], 1)
+
+        baseline = [dict(r, median_us=r['median_us'] * 2) for r in results]
+        baseline[0]['median_us'] = results[0]['median_us'] / 2
+        rows = compare(results, baseline[:-1] + [dict(baseline[-1],
+                                                      name='gone')])
+        status = {row[0]: row[-1] for row in rows}
+        self.assertEqual(status[result_id(results[0])], 'regression')
+        self.assertEqual(status[result_id(results[1])], 'improvement')
+        self.assertEqual(status[result_id(results[-1])], 'new')
+        self.assertIn('missing', status.values())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,745 @@
+# -*- coding: utf-8 -*-
+import collections
+import gc
+import itertools
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from unittest import main, TestCase
+
+from simhash import Simhash, SimhashIndex
+from simhash.adaptive_index import AdaptiveSimhashIndex
+from simhash.concurrent_index import ThreadSafeSimhashIndex
+from simhash.key_funcs import get_keys_mih, get_query_keys_mih
+from simhash.persistence import PersistentSimhashIndex, read_records
+from simhash.permuted_index import PermutedSimhashIndex, plan_tables
+from simhash.scan_index import ScanSimhashIndex
+from simhash.self_join import cluster, find_all_near_dup_pairs
+from simhash.sharded_index import ShardedSimhashIndex, start_process_shards
+from simhash.key_funcs import get_keys0
+from simhash.storage import (MemoryStorage, MemoryMapStorage, ArrayStorage,
+                             ArrayMapStorage, Storage)
+from simhash.window_index import SlidingWindowSimhashIndex
+
+
+def make_objs(n=500, f=64, seed=0):
+    """random simhashes, every 5th one is a near duplication of the last"""
+    rnd = random.Random(seed)
+    objs = []
+    for i in range(n):
+        if i % 5 and objs:
+            value = objs[-1][1].value
+            for _ in range(rnd.randint(0, 6)):
+                value ^= 1 << rnd.randrange(f)
+        else:
+            value = rnd.getrandbits(f)
+        objs.append((i, Simhash(value, f)))
+    return objs
+
+
+class IndexTestMixin(object):
+    k = 6
+
+    def make_index(self, objs):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.objs = make_objs()
+        self.index = self.make_index(self.objs)
+        self.expected = SimhashIndex(self.objs, storage=MemoryStorage(),
+                                     map_storage=MemoryMapStorage(), k=self.k)
+
+    def test_get_near_dups(self):
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+    def test_add_remove(self):
+        for _, simhash in self.objs[:300]:
+            self.index.remove(simhash)
+            self.expected.remove(simhash)
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+        obj_id, simhash = self.objs[0]
+        self.assertEqual(self.index.get_near_dups2(simhash, obj_id),
+                         self.expected.get_near_dups2(simhash, obj_id))
+        self.assertIn((obj_id, 0), self.index.get_near_dups(simhash))
+        self.assertEqual(self.index.get_one_near_dup(simhash), (obj_id, 0))
+
+
+class TestScanSimhashIndex(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        index = ScanSimhashIndex(objs, k=self.k, capacity=16, chunk_size=64,
+                                 workers=4)
+        self.addCleanup(index.close)
+        return index
+
+    def test_iterable(self):
+        # 接受任意的iterable，包括generator和int simhash
+        with ScanSimhashIndex(((i, s.value) for i, s in self.objs), k=self.k,
+                              chunk_size=64, workers=2) as index:
+            executor = index.executor
+            for _, simhash in self.objs[::7]:
+                self.assertEqual(sorted(index.get_near_dups(simhash)),
+                                 sorted(self.expected.get_near_dups(simhash)))
+        self.assertIsNone(index.executor)
+        with self.assertRaises(RuntimeError):  # 线程池已经关闭
+            executor.submit(print)
+        self.assertEqual(len(index.get_near_dups(self.objs[0][1])),
+                         len(self.expected.get_near_dups(self.objs[0][1])))
+
+        index = PermutedSimhashIndex(iter(self.objs), k=self.k)
+        self.assertEqual(len(index), len(set(s.value for _, s in self.objs)))
+
+    def test_compact(self):
+        for _, simhash in self.objs[:100]:
+            self.index.remove(simhash)
+        removed = set(simhash.value for _, simhash in self.objs[:100])
+        total = set(simhash.value for _, simhash in self.objs)
+        self.assertEqual(len(self.index), len(total - removed))
+        self.assertLess(self.index.n_dead, 100)
+
+
+class TestPermutedSimhashIndex(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        # 只索引一部分，剩下的通过add进入待重建区
+        index = PermutedSimhashIndex(objs[:200], k=self.k, min_pending=50)
+        for obj in objs[200:]:
+            index.add(*obj)
+        return index
+
+    def test_plan_tables(self):
+        self.assertEqual(plan_tables(64, 3, 1 << 20), 4)
+        n_small = plan_tables(64, 6, 1 << 10)
+        n_large = plan_tables(64, 6, 1 << 30)
+        self.assertGreater(n_large, n_small)
+        self.assertEqual(len(self.index.tables),
+                         math.comb(self.index.n_blocks, self.k))
+
+    def test_rebuild_tables(self):
+        self.assertLess(self.index.built, self.index.size)
+        self.index.rebuild_tables()
+        self.assertEqual(self.index.built, self.index.size)
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+
+class TestMihSimhashIndex(IndexTestMixin, TestCase):
+    m = 3
+
+    def make_index(self, objs):
+        return SimhashIndex(objs, storage=MemoryStorage(),
+                            map_storage=MemoryMapStorage(), k=self.k,
+                            key_func=partial(get_keys_mih, m=self.m),
+                            query_key_func=partial(get_query_keys_mih, m=self.m))
+
+    def test_query_keys(self):
+        simhash = self.objs[0][1]
+        keys = list(get_keys_mih(simhash, k=self.k, m=self.m))
+        query_keys = list(get_query_keys_mih(simhash, k=self.k, m=self.m))
+        self.assertEqual(len(keys), self.m)
+        self.assertTrue(set(keys) <= set(query_keys))
+        # 22 + 21 + 21 bits, radius 6 // 3 = 2
+        self.assertEqual(len(query_keys), sum(
+            1 + size + math.comb(size, 2) for size in (22, 21, 21)))
+
+
+class TestAdaptiveSimhashIndex(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        return AdaptiveSimhashIndex(objs, k=self.k, threshold=5)
+
+    def test_skew(self):
+        # 低位全部相同，最低位的桶严重倾斜
+        rnd = random.Random(1)
+        objs = [(i, Simhash(rnd.getrandbits(40) << 24)) for i in range(300)]
+        index = AdaptiveSimhashIndex(objs, k=self.k, threshold=20)
+        self.assertTrue(index.splits)
+        self.assertLessEqual(max(index.counts.values()), 20)
+        expected = SimhashIndex(objs, storage=MemoryStorage(),
+                                map_storage=MemoryMapStorage(), k=self.k)
+        for _, simhash in objs[::10]:
+            self.assertEqual(sorted(index.get_near_dups(simhash)),
+                             sorted(expected.get_near_dups(simhash)))
+
+        # 使用同一个storage重新打开，路由到同样的子桶
+        reopened = AdaptiveSimhashIndex(storage=index.storage,
+                                        map_storage=index.hash2id, k=self.k,
+                                        split_storage=index.split_storage)
+        self.assertEqual(reopened.splits, index.splits)
+        for _, simhash in objs[::10]:
+            self.assertEqual(sorted(reopened.get_near_dups(simhash)),
+                             sorted(expected.get_near_dups(simhash)))
+
+    def test_shared_splits(self):
+        # 另一个实例拆分了共享的桶，这个实例重新加载拆分记录后路由到子桶
+        rnd = random.Random(2)
+        objs = [(i, Simhash(rnd.getrandbits(40) << 24)) for i in range(300)]
+        other = AdaptiveSimhashIndex(k=self.k, threshold=10**6,
+                                     refresh_interval=0)
+        index = AdaptiveSimhashIndex(storage=other.storage,
+                                     map_storage=other.hash2id, k=self.k,
+                                     split_storage=other.split_storage,
+                                     threshold=20)
+        self.assertFalse(other.splits)
+        index.add_many(objs)
+        self.assertTrue(index.splits)
+        expected = SimhashIndex(objs, storage=MemoryStorage(),
+                                map_storage=MemoryMapStorage(), k=self.k)
+        for _, simhash in objs[::10]:
+            self.assertEqual(sorted(other.get_near_dups(simhash)),
+                             sorted(expected.get_near_dups(simhash)))
+        self.assertEqual(other.splits, index.splits)
+
+
+class TestAdaptiveArraySimhashIndex(TestAdaptiveSimhashIndex):
+
+    def make_index(self, objs):
+        index = AdaptiveSimhashIndex(objs, storage=ArrayStorage(),
+                                     map_storage=ArrayMapStorage(), k=self.k,
+                                     threshold=5)
+        self.assertTrue(index.splits)
+        # 拆分记录不写入分桶，分桶里只有simhash
+        self.assertNotIn(index.splits_key, index.storage.bucket)
+        return index
+
+
+class TestThreadSafeSimhashIndex(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        return ThreadSafeSimhashIndex(objs, k=self.k, n_stripes=16)
+
+    def run_threads(self, target, n=8):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # 频繁切换线程，更容易出现竞争
+        errors = []
+
+        def run(i):
+            try:
+                target(i)
+            except Exception as e:
+                errors.append(e)
+        try:
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(n)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
+    def test_atomic_get_near_dups2(self):
+        index = ThreadSafeSimhashIndex(k=self.k, n_stripes=16)
+        objs = self.objs[:100]
+        inserted = []
+
+        def target(i):
+            shuffled = list(objs)
+            random.Random(i).shuffle(shuffled)
+            for obj_id, simhash in shuffled:
+                result = index.get_near_dups2(simhash, obj_id)
+                if all(d for _, d in result):
+                    inserted.append(simhash.value)
+        self.run_threads(target)
+        # 每个不同的simhash只被插入一次
+        self.assertEqual(sorted(inserted),
+                         sorted(set(simhash.value for _, simhash in objs)))
+
+    def test_concurrent_readers(self):
+        objs = self.objs
+        counts = collections.Counter(simhash.value for _, simhash in objs)
+        # 值重复的simhash重新插入后id可能不同，只对不重复的做删除和插入
+        unique = [obj for obj in objs if counts[obj[1].value] == 1]
+
+        def target(i):
+            if i % 2:
+                for obj_id, simhash in unique[i::8]:
+                    self.index.remove(simhash)
+                    self.index.add(obj_id, simhash)
+            else:
+                for _ in range(3):
+                    for _, simhash in objs[::7]:
+                        for obj_id, _ in self.index.get_near_dups(simhash):
+                            self.assertIsInstance(obj_id, int)
+                    self.index.get_near_dups_many(
+                        [simhash for _, simhash in objs[::11]])
+        self.run_threads(target)
+        for _, simhash in objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+
+class TestThreadSafeArraySimhashIndex(TestThreadSafeSimhashIndex):
+
+    def make_index(self, objs):
+        return ThreadSafeSimhashIndex(objs, storage=ArrayStorage(),
+                                      map_storage=ArrayMapStorage(), k=self.k,
+                                      n_stripes=16)
+
+
+class TestSlidingWindowSimhashIndex(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        return SlidingWindowSimhashIndex(objs, k=self.k, max_age=3600,
+                                         max_size=len(objs))
+
+    def test_max_size(self):
+        index = SlidingWindowSimhashIndex(k=self.k, max_size=50)
+        unique = list({simhash.value: (obj_id, simhash)
+                       for obj_id, simhash in self.objs}.values())
+        for obj_id, simhash in unique[:100]:
+            index.add(obj_id, simhash)
+            self.assertLessEqual(len(index), 50)
+        index.add_many(unique[100:200])
+        self.assertEqual(len(index), 50)
+        self.assertEqual(len(index.hash2id.map), 50)
+
+        kept = unique[150:200]
+        self.assertEqual(sorted(value for value, _ in index.items()),
+                         sorted(simhash.value for _, simhash in kept))
+        buckets = set(v for dups in index.storage.bucket.values() for v in dups)
+        self.assertEqual(buckets, set(simhash.value for _, simhash in kept))
+
+    def test_max_age(self):
+        now = [0.0]
+        index = SlidingWindowSimhashIndex(k=self.k, max_age=10, evict_batch=2,
+                                          clock=lambda: now[0])
+        obj_id, simhash = self.objs[0]
+        index.add(obj_id, simhash)
+        index.add_many(self.objs[1:20])
+        now[0] = 5
+        self.assertIn((obj_id, 0), index.get_near_dups(simhash))
+
+        # 重新插入刷新时间
+        index.add(obj_id, simhash)
+        now[0] = 12
+        # 每次查询最多淘汰evict_batch条
+        n = len(index)
+        index.get_near_dups(self.objs[30][1])
+        self.assertEqual(len(index), n - 2)
+        self.assertEqual(index.evict(), n - 3)
+        self.assertEqual(len(index), 1)
+        self.assertIn((obj_id, 0), index.get_near_dups(simhash))
+
+        now[0] = 16
+        self.assertEqual(index.get_near_dups(simhash), [])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index.storage.bucket), 0)
+        self.assertEqual(len(index.hash2id.map), 0)
+
+
+class TestSlidingWindowArraySimhashIndex(TestSlidingWindowSimhashIndex):
+
+    def make_index(self, objs):
+        return SlidingWindowSimhashIndex(objs, storage=ArrayStorage(),
+                                         map_storage=ArrayMapStorage(),
+                                         k=self.k, max_age=3600,
+                                         max_size=len(objs))
+
+
+class TestShardedSimhashIndex(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        return ShardedSimhashIndex([SimhashIndex(k=self.k) for _ in range(4)],
+                                   objs, k=self.k)
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_get_near_dups2_many(self):
+        index = self.make_index(self.objs[:250])
+        expected = SimhashIndex(self.objs[:250], k=self.k)
+        batch = self.objs[200:]
+        results = index.get_near_dups2_many(
+            [simhash for _, simhash in batch], [i for i, _ in batch])
+        for (obj_id, simhash), result in zip(batch, results):
+            self.assertEqual(sorted(result),
+                             sorted(expected.get_near_dups2(simhash, obj_id)))
+        self.assertEqual(sorted(index.items()), sorted(expected.items()))
+        index.close()
+
+    def test_reshard(self):
+        n = len(list(self.index.items()))
+        moved = self.index.reshard(self.index.shards + [SimhashIndex(k=self.k)])
+        # 只有约1/5的simhash移动到新的分片
+        self.assertEqual(len(list(self.index.shards[-1].items())), moved)
+        self.assertLess(moved, n * 0.4)
+        self.assertEqual(len(list(self.index.items())), n)
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+    def test_reshard_failure(self):
+        class BrokenShard(SimhashIndex):
+            def add_many(self, objs):
+                raise OSError('shard is down')
+
+        n = len(list(self.index.items()))
+        with self.assertRaises(OSError):
+            self.index.reshard(self.index.shards + [BrokenShard(k=self.k)])
+        # 写入新分片失败时，原分片中的数据还在
+        self.assertEqual(len(list(self.index.items())), n)
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+    def test_process_shards(self):
+        managers, shards = start_process_shards(2, k=self.k)
+        try:
+            index = ShardedSimhashIndex(shards, self.objs, k=self.k)
+            for _, simhash in self.objs[::25]:
+                self.assertEqual(sorted(index.get_near_dups(simhash)),
+                                 sorted(self.expected.get_near_dups(simhash)))
+            index.close()
+        finally:
+            for manager in managers:
+                manager.shutdown()
+
+
+class HexMemoryStorage(MemoryStorage):
+    int_native = False
+    encode = Storage.encode
+    decode = Storage.decode
+
+
+class TestBuild(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.objs = make_objs()
+        self.expected = SimhashIndex(k=self.k)
+        for obj in self.objs:
+            self.expected.add(*obj)
+
+    def assertSameIndex(self, index):
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+    def test_pause_gc(self):
+        # 默认不关闭整个进程的gc，只有pause_gc=True时构建期间暂停
+        states = []
+
+        class Index(SimhashIndex):
+            def add_many(self, objs):
+                states.append(gc.isenabled())
+                super().add_many(objs)
+
+        index = Index(k=self.k)
+        index.build(self.objs, batch_size=100)
+        index.build(self.objs, batch_size=100, pause_gc=True)
+        self.assertEqual(states, [True] * 5 + [False] * 5)
+        self.assertTrue(gc.isenabled())
+
+    def test_build(self):
+        for storage, map_storage, key_func in [
+                (MemoryStorage(), MemoryMapStorage(), None),
+                (MemoryStorage(), MemoryMapStorage(), get_keys0),
+                (ArrayStorage(), ArrayMapStorage(), None),
+                (HexMemoryStorage(), MemoryMapStorage(), None)]:
+            with self.subTest(storage=type(storage).__name__,
+                              key_func=key_func):
+                index = SimhashIndex(k=self.k, storage=storage,
+                                     map_storage=map_storage,
+                                     key_func=key_func)
+                # 生成器，Simhash和int混合，分多批
+                objs = ((obj_id, simhash if obj_id % 2 else simhash.value)
+                        for obj_id, simhash in self.objs)
+                self.assertEqual(index.build(objs, batch_size=64),
+                                 len(self.objs))
+                self.assertSameIndex(index)
+
+                # 已有数据的bucket中继续批量插入
+                index.remove(self.objs[0][1])
+                index.build(self.objs[:100])
+                self.assertSameIndex(index)
+
+    def test_init_from_generator(self):
+        index = SimhashIndex((obj for obj in self.objs), k=self.k)
+        self.assertSameIndex(index)
+
+
+class TestBatchedQueries(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.objs = make_objs()
+        self.index = SimhashIndex(self.objs[:250], k=self.k)
+
+    def test_get_near_dups_many(self):
+        simhashes = [simhash for _, simhash in self.objs]
+        results = self.index.get_near_dups_many(simhashes)
+        for simhash, result in zip(simhashes, results):
+            self.assertEqual(sorted(result),
+                             sorted(self.index.get_near_dups(simhash)))
+
+    def test_get_near_dups2_many(self):
+        expected = SimhashIndex(self.objs[:250], k=self.k)
+        batch = self.objs[200:]
+        results = self.index.get_near_dups2_many(
+            [simhash for _, simhash in batch], [i for i, _ in batch])
+        for (obj_id, simhash), result in zip(batch, results):
+            self.assertEqual(sorted(result),
+                             sorted(expected.get_near_dups2(simhash, obj_id)))
+        self.assertEqual(self.index.hash2id.map, expected.hash2id.map)
+        self.assertEqual(self.index.storage.bucket, expected.storage.bucket)
+
+    def test_large_batch(self):
+        # 批内只和共享bucket的simhash比较，不会生成n*n的距离矩阵(8000个约500MB)
+        objs = make_objs(8000, seed=1)
+        index = SimhashIndex(k=self.k)
+        expected = SimhashIndex(k=self.k)
+        tracemalloc.start()
+        try:
+            results = index.get_near_dups2_many(
+                [simhash for _, simhash in objs], [i for i, _ in objs])
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 64 << 20)
+        for (obj_id, simhash), result in zip(objs, results):
+            self.assertEqual(sorted(result),
+                             sorted(expected.get_near_dups2(simhash, obj_id)))
+        self.assertEqual(index.storage.bucket, expected.storage.bucket)
+
+
+class TestMmapSimhashIndex(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.objs = make_objs()
+        self.expected = SimhashIndex(self.objs, k=self.k)
+        fd, self.path = tempfile.mkstemp(suffix='.simhash')
+        os.close(fd)
+        self.expected.save(self.path)
+        self.index = SimhashIndex.open(self.path)
+
+    def tearDown(self):
+        del self.index
+        os.remove(self.path)
+
+    def test_get_near_dups(self):
+        self.assertEqual(len(self.index), len(self.expected.hash2id.map))
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+        obj_id, simhash = self.objs[0]
+        self.assertEqual(self.index.get_one_near_dup(simhash), (obj_id, 0))
+        with self.assertRaises(TypeError):
+            self.index.add(obj_id, simhash)
+
+    def test_save_while_mapped(self):
+        # 覆盖正在被mmap的文件，已打开的索引依旧读到完整的旧数据
+        inode = os.stat(self.path).st_ino
+        small = SimhashIndex(self.objs[:10], k=self.k)
+        small.save(self.path)
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+        self.assertEqual(len(SimhashIndex.open(self.path)),
+                         len(small.hash2id.map))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)).count(
+            os.path.basename(self.path) + '.%s.tmp' % os.getpid()), 0)
+
+
+class TestSelfJoin(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.index = SimhashIndex(make_objs(), k=self.k)
+        items = list(self.index.items())
+        self.expected = set()
+        for (v1, id1), (v2, id2) in itertools.combinations(items, 2):
+            d = bin(v1 ^ v2).count('1')
+            if d <= self.k:
+                self.expected.add((min(id1, id2), max(id1, id2), d))
+
+    def test_find_all_near_dup_pairs(self):
+        for n_blocks in (None, self.k + 1, self.k + 3):
+            with self.subTest(n_blocks=n_blocks):
+                pairs = [(min(a, b), max(a, b), d) for a, b, d in
+                         self.index.find_all_near_dup_pairs(n_blocks)]
+                self.assertEqual(len(pairs), len(set(pairs)))
+                self.assertEqual(set(pairs), self.expected)
+
+    def test_array(self):
+        values = [v for v, _ in self.index.items()]
+        pairs = set(find_all_near_dup_pairs(values, k=self.k))
+        self.assertEqual(len(pairs), len(self.expected))
+        for a, b, d in pairs:
+            self.assertLess(a, b)
+            self.assertEqual(bin(values[a] ^ values[b]).count('1'), d)
+
+    def test_cluster(self):
+        labels = self.index.cluster()
+        self.assertEqual(set(labels), {obj_id for _, obj_id in
+                                       self.index.items()})
+        for a, b, _ in self.expected:
+            self.assertEqual(labels[a], labels[b])
+        linked = {a for a, _, _ in self.expected} | \
+            {b for _, b, _ in self.expected}
+        for obj_id, label in labels.items():
+            if obj_id not in linked:
+                self.assertEqual(label, obj_id)
+
+    def test_equal_values(self):
+        values = [v for v, _ in self.index.items()]
+        # 大量相同的值，每组相同的值之间两两输出，标签为簇中最小的位置
+        dups = values[:5] * 100 + values + [values[0]] * 300
+        start = time.time()
+        pairs = list(find_all_near_dup_pairs(dups, k=self.k))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(len(pairs), len(set(pairs)))
+        expected = set()
+        positions = collections.defaultdict(list)
+        for i, v in enumerate(dups):
+            positions[v].append(i)
+        for rows in positions.values():
+            expected.update((a, b, 0) for a, b in
+                            itertools.combinations(rows, 2))
+        for v1, v2 in itertools.combinations(positions, 2):
+            d = bin(v1 ^ v2).count('1')
+            if d <= self.k:
+                expected.update((min(a, b), max(a, b), d)
+                                for a in positions[v1]
+                                for b in positions[v2])
+        self.assertEqual(set(pairs), expected)
+
+        labels = cluster(dups, k=self.k).tolist()
+        parent = list(range(len(dups)))
+
+        def find(x):
+            while parent[x] != x:
+                x = parent[x]
+            return x
+        for a, b, _ in expected:
+            ra, rb = find(a), find(b)
+            parent[max(ra, rb)] = min(ra, rb)
+        self.assertEqual(labels, [find(i) for i in range(len(dups))])
+
+
+class TestPersistentSimhashIndex(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.objs = make_objs(200)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_recover(self):
+        expected = SimhashIndex(k=self.k)
+        with PersistentSimhashIndex(self.path, k=self.k, sync_every=10,
+                                    snapshot_every=70) as index:
+            for obj_id, simhash in self.objs:
+                index.get_near_dups2(simhash, obj_id)
+                expected.get_near_dups2(simhash, obj_id)
+            for _, simhash in self.objs[:30]:
+                index.remove(simhash)
+                expected.remove(simhash)
+            self.assertLess(index.n_logged, 70)
+        self.assertTrue(os.path.exists(index.snapshot_path))
+
+        recovered = PersistentSimhashIndex(self.path, k=self.k)
+        self.assertEqual(recovered.hash2id.map, expected.hash2id.map)
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(recovered.get_near_dups(simhash)),
+                             sorted(expected.get_near_dups(simhash)))
+        recovered.close()
+
+    def test_torn_write(self):
+        index = PersistentSimhashIndex(self.path, k=self.k)
+        index.add_many(self.objs[:10])
+        index.close()
+        with open(index.log_path, 'ab') as fp:
+            fp.write(b'\x01\x02\x03')
+        recovered = PersistentSimhashIndex(self.path, k=self.k)
+        self.assertEqual(len(recovered.hash2id.map),
+                         len(set(s.value for _, s in self.objs[:10])))
+        recovered.add_many(self.objs[10:20])
+        recovered.close()
+        recovered = PersistentSimhashIndex(self.path, k=self.k)
+        self.assertEqual(len(recovered.hash2id.map),
+                         len(set(s.value for _, s in self.objs[:20])))
+        recovered.close()
+
+    def test_concurrent_snapshot(self):
+        # 后台写快照的同时其他线程继续add，任何一条记录都不会丢失
+        objs = make_objs(4000, seed=2)
+        index = PersistentSimhashIndex(self.path, k=self.k,
+                                       snapshot_every=200)
+
+        def run(i):
+            for obj_id, simhash in objs[i::4]:
+                index.add(obj_id, simhash)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        index.close()
+        self.assertFalse(os.path.exists(index.old_log_path))
+
+        recovered = PersistentSimhashIndex(self.path, k=self.k)
+        self.assertEqual(recovered.hash2id.map, index.hash2id.map)
+        recovered.close()
+
+    def test_failed_snapshot(self):
+        index = PersistentSimhashIndex(self.path, k=self.k,
+                                       snapshot_every=None)
+        index.add_many(self.objs[:50])
+        write_snapshot = index.write_snapshot
+        index.write_snapshot = lambda items: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            index.snapshot()
+        # 快照失败时切换出去的日志还在，之后的日志接在它后面
+        self.assertTrue(os.path.exists(index.old_log_path))
+        index.snapshot_busy = False
+        index.add_many(self.objs[50:100])
+        with index.lock:
+            index.switch_log()
+        index.add_many(self.objs[100:150])
+        index.close()
+        index.write_snapshot = write_snapshot
+
+        recovered = PersistentSimhashIndex(self.path, k=self.k)
+        self.assertEqual(recovered.hash2id.map, index.hash2id.map)
+        # 恢复时补写快照，删除旧的日志
+        self.assertFalse(os.path.exists(recovered.old_log_path))
+        recovered.close()
+        recovered = PersistentSimhashIndex(self.path, k=self.k)
+        self.assertEqual(recovered.hash2id.map, index.hash2id.map)
+        recovered.close()
+
+    def test_flush(self):
+        index = PersistentSimhashIndex(self.path, k=self.k, sync_every=100,
+                                       sync_interval=0.05)
+        index.add(*self.objs[0])
+        index.add_many(self.objs[1:3])
+        # 记录立即写到OS，进程被kill也不会丢失
+        self.assertEqual(len(list(read_records(index.log_path,
+                                               index.n_bytes))), 3)
+        time.sleep(0.3)  # 后台线程按sync_interval完成fsync
+        self.assertEqual(index.n_pending, 0)
+        index.close()
+        self.assertFalse(index.sync_thread.is_alive())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,24 @@
 # -*- coding: utf-8 -*-
-from unittest import main, TestCase
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from unittest import main, TestCase, skipIf
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 from simhash import Simhash, SimhashIndex
+from simhash.hash_funcs import cached, make_blake2b_hash, md5_hash
+from simhash.key_funcs import get_int_keys, get_keys0
+from simhash import resources
+from simhash.pipeline import fingerprint_stream, index_stream, read_jsonl
+from simhash.sim_hash import (JIEBA_IDF_DIC, FeatureCache, LazyIdfDic,
+                              accumulate_np, accumulate_py, load_idf_dic, np)
+from simhash.storage import MemoryStorage
+from simhash.tokenizer import char_ngrams, make_ngram_featurizer, tokenize
 
 
 class TestSimhash(TestCase):
@@ -82,6 +97,201 @@ class TestSimhash(TestCase):
         self.assertNotEqual(Simhash(dict_features).value,
                             Simhash(data[0]).value)
 
+    @skipIf(np is None, 'numpy is not installed')
+    def test_accumulate_np(self):
+        rnd = random.Random(0)
+        for n in (1, 7, 300):
+            hashes = [rnd.getrandbits(128) for _ in range(n)]
+            float_weights = [rnd.random() * 10 for _ in range(n)]
+            int_weights = [rnd.randint(-5, 5) for _ in range(n)]
+            for weights in (float_weights, int_weights):
+                for f in (13, 64, 128):
+                    self.assertEqual(accumulate_np(hashes, weights, f),
+                                     accumulate_py(hashes, weights, f))
+        # out of int64 range, let the caller fall back to python ints
+        self.assertIsNone(accumulate_np([1, 2], [2 ** 70, 1]))
+
+    def test_hash_funcs(self):
+        for token in (b'', b'aaa', '你好'.encode('utf-8')):
+            self.assertEqual(md5_hash(token),
+                             int(hashlib.md5(token).hexdigest(), 16))
+
+        blake2b_hash = make_blake2b_hash(8)
+        self.assertLess(blake2b_hash(b'aaa'), 1 << 64)
+        self.assertEqual(Simhash(['aaa', 'bbb'], hashfunc=blake2b_hash).value,
+                         Simhash(['aaa', 'bbb'], hashfunc=blake2b_hash).value)
+
+        hashfunc = cached(md5_hash, maxsize=2)
+        for token in (b'a', b'a', b'b', b'c', b'a'):
+            hashfunc(token)
+        info = hashfunc.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 4, 2))
+
+    def test_lazy_idf_dic(self):
+        cwd = os.getcwd()
+        try:
+            os.chdir(tempfile.gettempdir())
+            self.assertGreater(len(JIEBA_IDF_DIC), 0)
+        finally:
+            os.chdir(cwd)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_dir = resources.CACHE_DIR
+            resources.CACHE_DIR = os.path.join(tmp, 'cache')
+            try:
+                path = os.path.join(tmp, 'idf.txt')
+                with open(path, 'w') as f:
+                    f.write('鸟 3.5\nwhy 1.25\n')
+                dic = LazyIdfDic(path)
+                self.assertEqual(dic.get('鸟'), 3.5)
+                self.assertEqual(dic.get('鱼', 5), 5)
+                self.assertEqual(dic.get_many(['why', '鱼'], 5), [1.25, 5])
+
+                calls = []
+
+                def loader(p):
+                    calls.append(p)
+                    return load_idf_dic(p)
+                self.assertEqual(resources.load_cached(path, loader),
+                                 {'鸟': 3.5, 'why': 1.25})
+                # 缓存命中时不再解析源文件
+                self.assertEqual(resources.load_cached(path, loader),
+                                 {'鸟': 3.5, 'why': 1.25})
+                self.assertEqual(calls, [path])
+
+                # 源文件修改后重新解析
+                with open(path, 'w') as f:
+                    f.write('鸟 3.5\nwhy 1.25\nare 2.0\n')
+                self.assertEqual(len(resources.load_cached(path, loader)), 3)
+                self.assertEqual(calls, [path, path])
+                self.assertEqual(LazyIdfDic(path).get('are'), 2.0)
+
+                # 缓存目录只有当前用户可以访问，其他人可写的缓存不会被加载
+                self.assertEqual(
+                    os.stat(resources.CACHE_DIR).st_mode & 0o777, 0o700)
+                cache = resources.cache_path(path, loader.__name__)
+                os.chmod(cache, 0o666)
+                self.assertEqual(len(resources.load_cached(path, loader)), 3)
+                self.assertEqual(calls, [path, path, path])
+            finally:
+                resources.CACHE_DIR = cache_dir
+
+    def test_lazy_import(self):
+        # import simhash时不导入numpy和jieba，第一次用到时才导入
+        code = ('import sys, simhash; '
+                'print(sorted({"numpy", "jieba"} & set(sys.modules)))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             capture_output=True, text=True,
+                             cwd=root).stdout
+        self.assertEqual(out.strip(), '[]')
+
+    @skipIf(np is None, 'numpy is not installed')
+    def test_idf_store(self):
+        from simhash.idf_store import IdfStore, save_idf_store
+
+        dic = {'鸟': 3.5, '鸟鸣': 7.25, 'why': 1.25, 'whyyyyyyyy': 2.0,
+               'whyyyyyyyz': 2.5, 'are': 0.1}
+        text = '处处闻啼鸟，鸟鸣 why are you so diao ? whyyyyyyyy'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'idf.bin')
+            save_idf_store(path, dic)
+            store = IdfStore(path)
+            self.assertEqual(len(store), len(dic))
+            self.assertEqual(dict(store.items()), dic)
+            for word, idf in dic.items():
+                self.assertEqual(store.get(word), idf)
+                self.assertEqual(store[word], idf)
+                self.assertIn(word, store)
+            self.assertIsNone(store.get('whyyyyyyyyy'))
+            self.assertEqual(store.get('鱼', 5), 5)
+            self.assertNotIn('wh', store)
+            with self.assertRaises(KeyError):
+                store['鱼']
+            words = list(dic) + ['鱼', 'wh', 'whyyyyyyyyy']
+            self.assertEqual(store.get_many(words, 5),
+                             [dic.get(word, 5) for word in words])
+
+            self.assertEqual(Simhash(text, idf_dic=store).value,
+                             Simhash(text, idf_dic=dic).value)
+
+            save_idf_store(path, dic, dtype='<f4')
+            self.assertEqual(IdfStore(path).get('鸟鸣'), 7.25)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('<p>处处闻啼鸟，</p>why are you so diao ?'),
+                         tokenize('处处闻啼鸟，why are you so diao ?'))
+        words = tokenize('处处闻啼鸟，why are you so diao ? 123 ...')
+        self.assertTrue(words)
+        for word in words:
+            self.assertRegex(word, '^[\u4e00-\u9fcca-zA-Z]+$')
+
+    def test_ngram_features(self):
+        self.assertEqual(char_ngrams('<p>How are</p> 你好！', 3),
+                         ['how', 'owa', 'war', 'are', 're你', 'e你好'])
+        self.assertEqual(char_ngrams('你好', 3), ['你好'])
+        self.assertEqual(char_ngrams(' ，', 3), [])
+
+        featurizer = make_ngram_featurizer(n=2, weighted=False)
+        self.assertEqual(featurizer('哈哈哈'), {'哈哈': 1})
+        self.assertEqual(make_ngram_featurizer(n=2)('哈哈哈'), {'哈哈': 2})
+
+        sh1 = Simhash('这家店的服务态度真的很好，下次还来', featurizer=featurizer)
+        sh2 = Simhash('这家店的服务态度真的很好！下次还会来', featurizer=featurizer)
+        sh3 = Simhash('物流太慢了，等了一个星期才到', featurizer=featurizer)
+        self.assertEqual(sh1.value, Simhash(
+            ['这家', '家店', '店的', '的服', '服务', '务态', '态度', '度真',
+             '真的', '的很', '很好', '好下', '下次', '次还', '还来']).value)
+        self.assertLess(sh1.distance(sh2), sh1.distance(sh3))
+
+        cache = FeatureCache()
+        for _ in range(2):
+            self.assertEqual(Simhash('哈哈哈', featurizer=featurizer,
+                                     feature_cache=cache).value,
+                             Simhash({'哈哈': 1}).value)
+        self.assertEqual(cache.cache_info()[:2], (1, 1))
+
+    def test_feature_cache(self):
+        texts = ['处处闻啼鸟，why are you so diao ?', '夜来风雨声，花落知多少',
+                 '处处闻啼鸟，why are you so diao ?']
+        calls = []
+
+        def tokenizer(text):
+            calls.append(text)
+            return tokenize(text)
+
+        cache = FeatureCache(maxsize=1)
+        for text in texts:
+            self.assertEqual(
+                Simhash(text, tokenizer=tokenizer, feature_cache=cache).value,
+                Simhash(text).value)
+        # maxsize=1，第一个文本已经被淘汰
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(cache.cache_info().currsize, 1)
+
+        cache = FeatureCache()
+        for text in texts:
+            Simhash(text, tokenizer=tokenizer, feature_cache=cache)
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(cache.cache_info()[:2], (1, 2))
+        # 不同的idf词典不共用缓存
+        Simhash(texts[0], tokenizer=tokenizer, feature_cache=cache,
+                idf_dic={})
+        self.assertEqual(len(calls), 6)
+
+        # 临时的idf词典被回收后，新词典即使id相同也不会命中旧的特征
+        cache = FeatureCache()
+        for i in range(1, 20):
+            idf_dic = {word: (i * j) % 7 + 1
+                       for j, word in enumerate(tokenize(texts[0]))}
+            self.assertEqual(
+                Simhash(texts[0], idf_dic=idf_dic, feature_cache=cache).value,
+                Simhash(texts[0], idf_dic=idf_dic).value)
+            del idf_dic
+        # 只保留最近的max_namespaces个idf词典，淘汰的词典的特征一起删除
+        self.assertEqual(len(cache.objects), cache.max_namespaces)
+        self.assertEqual(len(cache), cache.max_namespaces)
+
     def test_equality_comparison(self):
         a = Simhash('My name is John')
         b = Simhash('My name is John')
@@ -124,6 +334,67 @@ class TestSimhashIndex(TestCase):
         dups = self.index.get_near_dups(s1)
         self.assertEqual(len(dups), 3)
 
+    def test_int_native(self):
+        s1 = Simhash(self.data[1])
+        # the buckets of MemoryStorage keep int simhash values
+        for key in get_int_keys(s1, k=10):
+            self.assertIn(s1.value, self.index.storage.get(key))
+        self.assertEqual(len(set(get_int_keys(Simhash(0), k=10))), 11)
+        self.assertEqual(self.index.get_one_near_dup(s1), (1, 0))
+
+        index = SimhashIndex(k=10, with_id=False, key_func=get_keys0)
+        index.add('1', s1)
+        self.assertEqual(index.get_near_dups(s1), [('%x' % s1.value, 0)])
+        with self.assertRaises(AttributeError):
+            s1.tokens = []
+
+    def test_shared_storage(self):
+        # 两个key_pre共用一个storage，bucket互不影响
+        storage = MemoryStorage()
+        objs = [(str(k), Simhash(v)) for k, v in self.data.items()]
+        index1 = SimhashIndex(objs, storage=storage, key_pre='a:', k=10)
+        index2 = SimhashIndex(storage=storage, key_pre='b:', k=10)
+        for _, simhash in objs:
+            self.assertEqual(index2.get_near_dups(simhash), [])
+            self.assertTrue(index1.get_near_dups(simhash))
+
+
+class TestPipeline(TestCase):
+    data = TestSimhashIndex.data
+
+    def test_fingerprint_stream(self):
+        items = list(self.data.items()) * 3
+        expected = [(obj_id, Simhash(text).value) for obj_id, text in items]
+        for processes in (1, 2):
+            chunks = list(fingerprint_stream(items, processes=processes,
+                                             chunk_size=5))
+            self.assertEqual([len(chunk) for chunk in chunks], [5, 5, 2])
+            self.assertEqual(sum(chunks, []), expected)
+
+    def test_featurizer(self):
+        featurizer = make_ngram_featurizer(n=2)
+        items = list(self.data.items())
+        expected = [(obj_id, Simhash(text, featurizer=featurizer).value)
+                    for obj_id, text in items]
+        for processes in (1, 2):
+            chunks = fingerprint_stream(items, processes=processes,
+                                        featurizer=featurizer)
+            self.assertEqual(sum(chunks, []), expected)
+
+    def test_index_stream(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            for obj_id, text in self.data.items():
+                f.write(json.dumps({'id': obj_id, 'text': text}) + '\n')
+        try:
+            index = SimhashIndex(k=10)
+            self.assertEqual(index_stream(index, read_jsonl(path),
+                                          processes=1), 4)
+        finally:
+            os.remove(path)
+        s1 = Simhash(u'How are you i am fine.ablar ablar xyz blar blar blar blar blar blar blar thank')
+        self.assertEqual(len(index.get_near_dups(s1)), 3)
+
 
 def console_test():
     from simhash import Simhash, SimhashIndex
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from unittest import main, TestCase, skipIf
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from simhash import Simhash, SimhashIndex
+from simhash.async_index import AsyncSimhashIndex
+from simhash.redis_index import RedisSimhashIndex
+from simhash import storage
+from simhash.storage import (MemoryStorage, MemoryMapStorage, RedisStorage,
+                             RedisMapStorage, AsyncRedisStorage,
+                             AsyncRedisMapStorage, ArrayStorage,
+                             ArrayMapStorage)
+
+from .test_index import IndexTestMixin, make_objs
+
+
+class TestArrayStorage(IndexTestMixin, TestCase):
+
+    def make_index(self, objs):
+        return SimhashIndex(objs, storage=ArrayStorage(), k=self.k,
+                            map_storage=ArrayMapStorage(merge_min=64))
+
+    def test_storage(self):
+        s = ArrayStorage()
+        big = [(1 << 64) - 1 - i for i in range(100)]
+        s.add_many([('a', v) for v in big + big[:10]])
+        s.add_many([('a', big[0]), ('a', 1), ('b', 2), ('b', 2)])
+        s.add('b', 3)
+        s.add('b', 2)
+        self.assertEqual(sorted(s.get('a')), sorted([1] + big))
+        self.assertEqual(list(s.get('b')), [2, 3])
+        self.assertEqual(list(s.get('a')), sorted([1] + big))
+        self.assertEqual(s.get('x'), frozenset())
+        s.remove('a', big[50])
+        s.remove('a', 12345)
+        self.assertEqual(len(s.get('a')), 100)
+        self.assertNotIn(big[50], s.get('a'))
+        s.remove('b', 2)
+        s.remove('b', 3)
+        self.assertNotIn('b', s.bucket)
+
+    def test_map_storage(self):
+        for np in (storage.get_numpy(), None):
+            with self.subTest(numpy=np is not None):
+                old, storage.get_numpy = storage.get_numpy, lambda: np
+                try:
+                    m = ArrayMapStorage(merge_min=8)
+                    expected = dict()
+                    for i in range(100):
+                        m.add((i * 7919) % 1000 + (1 << 63), i)
+                        expected[(i * 7919) % 1000 + (1 << 63)] = i
+                        if i % 3 == 0:
+                            k = ((i // 2) * 7919) % 1000 + (1 << 63)
+                            m.remove(k, 0)
+                            expected.pop(k, None)
+                    m.add(1 << 63, -1)
+                    expected[1 << 63] = -1
+                    self.assertEqual(len(m), len(expected))
+                    self.assertEqual(m.get_many(list(expected) + [5]),
+                                     list(expected.values()) + [None])
+                    self.assertEqual(dict(m.items()), expected)
+                    self.assertEqual(list(m.keys), sorted(expected))
+                    with self.assertRaises(TypeError):
+                        m.add(1, 'a')
+                finally:
+                    storage.get_numpy = old
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisStorage(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.r = fakeredis.FakeRedis()
+        self.storage = RedisStorage(self.r)
+        self.map_storage = RedisMapStorage(self.r, 'hash2id')
+
+    def test_storage(self):
+        self.storage.add_many([('a', '1'), ('a', '2'), ('b', '3')])
+        self.storage.add('c', '4')
+        self.assertEqual(self.storage.get_many(['a', 'b', 'x']),
+                         [{b'1', b'2'}, {b'3'}, set()])
+        self.assertEqual(self.r.smembers('bucket_keys'), {b'a', b'b', b'c'})
+        self.assertGreater(self.r.ttl('a'), 0)
+
+        self.map_storage.add_many([('1', 10), ('2', 20)])
+        self.assertEqual(self.map_storage.get_many(['2', 'x']), [b'20', None])
+
+    def test_clear(self):
+        self.storage.add_many(('key%s' % i, '1') for i in range(25))
+        # the last partial batch used to be left behind
+        self.storage.clear(batch_size=10)
+        self.assertEqual(self.r.keys('*'), [])
+
+    def test_index(self):
+        objs = make_objs(200)
+        index = SimhashIndex(objs, storage=self.storage,
+                             map_storage=self.map_storage, k=self.k)
+        expected = SimhashIndex(objs, storage=MemoryStorage(),
+                                map_storage=MemoryMapStorage(), k=self.k)
+        for _, simhash in objs[::7]:
+            self.assertEqual(sorted(index.get_near_dups(simhash)),
+                             sorted(expected.get_near_dups(simhash)))
+        simhashes = [simhash for _, simhash in objs]
+        for result, expected_result in zip(
+                index.get_near_dups_many(simhashes),
+                expected.get_near_dups_many(simhashes)):
+            self.assertEqual(sorted(result), sorted(expected_result))
+        self.assertEqual(index.get_one_near_dup(Simhash(0, 64)), (None, None))
+
+    def test_round_trips(self):
+        index = SimhashIndex(storage=self.storage,
+                             map_storage=self.map_storage, k=self.k)
+        executed = []
+        pipeline = self.r.pipeline
+
+        def counting_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            pipe.execute = lambda: executed.append(len(pipe)) or execute()
+            return pipe
+        self.r.pipeline = counting_pipeline
+        self.r.hset = self.r.hdel = self.r.srem = None  # 不允许单独发送
+
+        simhash = Simhash(0x1234567890abcdef, 64)
+        index.add(1, simhash)
+        # hset + k+1个(sadd, expire) + 记录bucket的key，一次往返
+        self.assertEqual(executed, [1 + 2 * (self.k + 1) + 1])
+        self.assertEqual(index.get_near_dups(simhash), [(1, 0)])
+        del executed[:]
+        index.remove(simhash)
+        self.assertEqual(executed, [1 + self.k + 1])
+        self.assertEqual(index.get_near_dups(simhash), [])
+        self.assertIsNone(self.map_storage.get(self.storage.encode(
+            simhash.value)))
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisSimhashIndex(TestCase):
+    k = 6
+
+    def setUp(self):
+        self.r = fakeredis.FakeRedis()
+        try:
+            self.r.eval('return 1', 0)
+        except Exception:
+            self.skipTest('fakeredis is installed without lua support')
+        self.objs = make_objs(200)
+        self.index = RedisSimhashIndex(
+            self.objs[:150], storage=RedisStorage(self.r),
+            map_storage=RedisMapStorage(self.r, 'hash2id'), k=self.k)
+        self.expected = SimhashIndex(self.objs[:150], k=self.k)
+
+    def test_get_near_dups(self):
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+        obj_id, simhash = self.objs[0]
+        self.assertEqual(self.index.get_one_near_dup(simhash), (obj_id, 0))
+        self.assertEqual(self.index.get_one_near_dup(Simhash(1 << 63)),
+                         (None, None))
+
+    def test_get_near_dups2(self):
+        for obj_id, simhash in self.objs[140:]:
+            self.assertEqual(
+                sorted(self.index.get_near_dups2(simhash, obj_id)),
+                sorted(self.expected.get_near_dups2(simhash, obj_id)))
+        for _, simhash in self.objs[::7]:
+            self.assertEqual(sorted(self.index.get_near_dups(simhash)),
+                             sorted(self.expected.get_near_dups(simhash)))
+
+
+class TestAsyncSimhashIndex(TestCase):
+    k = 6
+
+    def make_index(self):
+        return AsyncSimhashIndex(k=self.k)
+
+    def test_index(self):
+        objs = make_objs(200)
+        expected = SimhashIndex(objs[:150], k=self.k)
+
+        async def run():
+            index = self.make_index()
+            await index.add_many(objs[:150])
+            for _, simhash in objs[::7]:
+                self.assertEqual(sorted(await index.get_near_dups(simhash)),
+                                 sorted(expected.get_near_dups(simhash)))
+            results = await asyncio.gather(
+                *[index.get_near_dups(simhash) for _, simhash in objs])
+            for (_, simhash), result in zip(objs, results):
+                self.assertEqual(sorted(result),
+                                 sorted(expected.get_near_dups(simhash)))
+            many = await index.get_near_dups_many(s for _, s in objs)
+            self.assertEqual([sorted(r) for r in many],
+                             [sorted(r) for r in results])
+
+            for obj_id, simhash in objs[150:]:
+                self.assertEqual(
+                    sorted(await index.get_near_dups2(simhash, obj_id)),
+                    sorted(expected.get_near_dups2(simhash, obj_id)))
+            obj_id, simhash = objs[0]
+            self.assertEqual(await index.get_one_near_dup(simhash),
+                             (obj_id, 0))
+            await index.remove(simhash)
+            expected.remove(simhash)
+            self.assertEqual(sorted(await index.get_near_dups(simhash)),
+                             sorted(expected.get_near_dups(simhash)))
+
+        asyncio.run(run())
+
+    def test_no_sync_methods(self):
+        # 不继承SimhashIndex的同步方法，调用了也不会静默地返回coroutine
+        index = self.make_index()
+        for name in ('get_near_dups2_many', 'search_many', 'build', 'items',
+                     'save', 'find_all_near_dup_pairs', 'cluster'):
+            self.assertFalse(hasattr(index, name), name)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestAsyncRedisSimhashIndex(TestAsyncSimhashIndex):
+
+    def make_index(self):
+        r = fakeredis.FakeAsyncRedis(max_connections=1000)
+        return AsyncSimhashIndex(AsyncRedisStorage(r),
+                                 AsyncRedisMapStorage(r, 'hash2id'), k=self.k)
+
+    def test_sync_storage_methods(self):
+        r = fakeredis.FakeAsyncRedis()
+        storage = AsyncRedisStorage(r)
+        with self.assertRaises(TypeError):
+            storage.get_many(['a'])
+        with self.assertRaises(TypeError):
+            AsyncRedisMapStorage(r, 'hash2id').add('a', 1)
+        with self.assertRaises(TypeError):
+            SimhashIndex(storage=storage)
+
+    def test_remove_round_trips(self):
+        objs = make_objs(20)
+
+        async def run():
+            index = self.make_index()
+            await index.add_many(objs)
+            r = index.storage.r
+            calls = []
+            execute_command = r.execute_command
+
+            async def counted(*args, **kwargs):
+                calls.append(args[0])
+                return await execute_command(*args, **kwargs)
+            r.execute_command = counted
+            pipelines = []
+            pipeline = r.pipeline
+
+            def counted_pipeline(*args, **kwargs):
+                pipe = pipeline(*args, **kwargs)
+                pipelines.append(pipe)
+                return pipe
+            r.pipeline = counted_pipeline
+
+            obj_id, simhash = objs[0]
+            await index.remove(simhash)
+            # 一次hdel，所有的srem在一个pipeline中
+            self.assertEqual(calls, ['HDEL'])
+            self.assertEqual(len(pipelines), 1)
+            self.assertNotIn((obj_id, 0), await index.get_near_dups(simhash))
+            self.assertIn((objs[1][0], 0),
+                          await index.get_near_dups(objs[1][1]))
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()